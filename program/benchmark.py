@@ -0,0 +1,153 @@
+# Headless benchmark of the display pipeline: runs run_display offscreen (SDL dummy driver) for a number of
+# frames against a synthetic library, using the hole layout of the real config.cfg
+# Reports fps, p50/p99 frame time, decode throughput, cache hit rate and peak RSS (text or --json)
+# Run with ./run.sh bench [options] or python3 program/benchmark.py --help
+# Depends on program/display.py (run_display), program/media_index.py and program/renditions.py;
+# the library, renditions and database live in a temporary directory selected through TVFRAME_CONFIG
+
+import argparse
+import configparser
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+
+def make_library(uploads_dir, items, width, height, seed):
+    # Noise over a gradient: JPEGs that cost about as much to decode as photos. Every third one is portrait.
+    rng = random.Random(seed)
+    directory = os.path.join(uploads_dir, 'bench', '2026', '01', '01')
+    os.makedirs(directory, exist_ok=True)
+    for i in range(items):
+        w, h = (height, width) if i % 3 == 2 else (width, height)
+        noise = Image.effect_noise((w, h), rng.randint(20, 80))
+        gradient = Image.linear_gradient('L').resize((w, h))
+        img = Image.merge('RGB', (noise, gradient, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+        img.save(os.path.join(directory, f'{i:05d}.jpg'), quality=90)
+
+
+def write_config(path, work_dir, interval, overlay):
+    # The real config (hole layout, screen size, cache budget) with everything it writes moved to work_dir
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(__file__), '..', 'config.cfg'))
+    config['paths']['uploads_dir'] = os.path.join(work_dir, 'uploads')
+    config['paths']['renditions_dir'] = os.path.join(work_dir, 'renditions')
+    config['paths']['database'] = os.path.join(work_dir, 'media.db')
+    config['display']['mode'] = 'media'
+    for section in ('schedule', 'interval', 'metrics', 'ipc'):
+        if not config.has_section(section):
+            config.add_section(section)
+    config['schedule']['interval_seconds'] = str(interval)
+    for key in list(config['interval']):
+        config.remove_option('interval', key)
+    config['metrics']['overlay'] = 'true' if overlay else 'false'
+    config['metrics']['push_seconds'] = '3600'
+    config['ipc']['socket_path'] = os.path.join(work_dir, 'display.sock')
+    with open(path, 'w') as f:
+        config.write(f)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='tvframe-bench-')
+    try:
+        width, height = (int(v) for v in args.resolution.lower().split('x'))
+        config_path = os.path.join(work_dir, 'config.cfg')
+        write_config(config_path, work_dir, args.interval, args.overlay)
+        os.environ['TVFRAME_CONFIG'] = config_path
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+        started = time.perf_counter()
+        make_library(os.path.join(work_dir, 'uploads'), args.items, width, height, args.seed)
+        from settings import db, init_db, uploads_dir, renditions_dir, renditions_options, layout_service, rendition_targets
+        from media_index import MediaIndex
+        init_db()
+        index = MediaIndex(db, uploads_dir)
+        index.reconcile()
+        index.load()
+        if args.renditions:
+            # Steady state: what the web server would have built after upload
+            options = dict(renditions_options, workers=os.cpu_count() or 1)
+            from renditions import RenditionPipeline
+            pipeline = RenditionPipeline(db, renditions_dir, rendition_targets(layout_service.current.holes), **options)
+            pipeline.backfill(index.iter_paths(), index.transform_for)
+            pipeline.close()
+        setup_seconds = time.perf_counter() - started
+
+        random.seed(args.seed)
+        import display
+        display.load_library()  # measure the steady state, not the staged startup
+        frame_times = []
+        started = time.perf_counter()
+        display.run_display(fullscreen=False, max_frames=args.frames + args.warmup, on_frame=frame_times.append)
+        elapsed = time.perf_counter() - started
+        display.sample_metrics()
+
+        measured = frame_times[args.warmup:]
+        decode_seconds, decodes = display.metrics.total('display_decode_seconds')
+        scale_seconds, _ = display.metrics.total('display_scale_seconds')
+        hits = display.metrics.total('display_surface_cache_hits_total')
+        misses = display.metrics.total('display_surface_cache_misses_total')
+        return {
+            'holes': len(display.holes),
+            'screen': list(display.layout.screen_size),
+            'items': args.items,
+            'resolution': [width, height],
+            'renditions': args.renditions,
+            'setup_seconds': round(setup_seconds, 2),
+            'first_frame_seconds': round(display.metrics.total('display_first_frame_seconds'), 3),
+            'frames': len(frame_times),
+            'seconds': round(elapsed, 3),
+            'fps': round(len(frame_times) / elapsed, 2) if elapsed else 0.0,
+            'frame_ms_p50': round(percentile(measured, 0.50) * 1000, 3),
+            'frame_ms_p99': round(percentile(measured, 0.99) * 1000, 3),
+            'frame_ms_max': round(max(measured, default=0.0) * 1000, 3),
+            'decodes': decodes,
+            'decodes_per_second': round(decodes / elapsed, 2) if elapsed else 0.0,
+            'decode_ms_mean': round(decode_seconds / decodes * 1000, 2) if decodes else 0.0,
+            'scale_ms_mean': round(scale_seconds / decodes * 1000, 2) if decodes else 0.0,
+            'cache_hit_rate': round(hits / (hits + misses), 3) if hits + misses else 0.0,
+            'swaps': display.prefetcher.swaps,
+            'missed_deadlines': display.prefetcher.missed_deadlines,
+            'slow_frames': display.metrics.total('display_slow_frames_total'),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+    finally:
+        if args.keep:
+            print(f"Benchmark files kept in {work_dir}", file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless benchmark of the 80s TV Frame display pipeline')
+    parser.add_argument('--frames', type=int, default=300, help='frames to measure (default 300)')
+    parser.add_argument('--warmup', type=int, default=10, help='frames left out of the frame time percentiles')
+    parser.add_argument('--items', type=int, default=40, help='synthetic library size (default 40)')
+    parser.add_argument('--resolution', default='4000x3000', help='synthetic image size (default 4000x3000)')
+    parser.add_argument('--interval', type=float, default=0.1, help='seconds between changes of each hole')
+    parser.add_argument('--renditions', action='store_true', help='build per-hole renditions first (steady state)')
+    parser.add_argument('--overlay', action='store_true', help='draw the debug overlay while measuring')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--keep', action='store_true', help='keep the temporary library and database')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+    if args.items < 1 or args.frames < 1:
+        parser.error('--items and --frames must be at least 1')
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for key, value in results.items():
+            print(f'{key:20} {value}')
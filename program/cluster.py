@@ -0,0 +1,413 @@
+# Cluster mode: several frames in the house showing one library, uploaded once
+# The hub is an ordinary frame with [cluster] token set; uploads, media.db and users.json live there only.
+# Its web server lists the library on /cluster/library, announces changes on /cluster/events (Server-Sent
+# Events) and serves renditions in whatever hole sizes a node asks for on /cluster/file.
+# A node is a frame with [cluster] hub_url set: program/app.py runs only its display, and ClusterClient
+# mirrors the hub's library into the node's own media table. Only the renditions the node's config.cfg
+# holes need are downloaded (the original for videos), into cache_dir; past cache_mb the least recently
+# shown older items are evicted. While the hub is unreachable the display keeps playing from the cache.
+# Used by program/library.py and program/cluster_routes.py (ClusterHub) and program/app.py (ClusterClient next to program/display.py)
+# Depends on program/renditions.py (rendition names, rendition_for), program/media_index.py and the
+# media table of program/settings.py; settings come from the [cluster] section of config.cfg
+
+import hmac
+import json
+import os
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from renditions import parse_size_name, size_name, transform_json
+from surface_cache import effective_fit
+from video import is_video
+
+ORIGINAL = 'original'  # file name a node asks for to get a video itself
+MAX_SIDE = 8192  # largest rendition side a node may ask for
+READ_SIZE = 256 * 1024
+
+
+class ClusterHub:
+    # Hub side, in the web server: the library listing and the files nodes download
+
+    def __init__(self, media_index, renditions, uploads_dir, token, event_bus):
+        self.media_index = media_index
+        self.renditions = renditions
+        self.uploads_dir = uploads_dir
+        self.token = token
+        self.event_bus = event_bus  # nodes only, separate from the media pages' bus
+        self._instance = f'{int(time.time()):x}'  # so a restarted hub never repeats a version
+        self._generation = 0
+        self._listing = None  # (version, JSON body), built once per version
+        self._lock = threading.Lock()
+
+    def authorized(self, headers):
+        # Every cluster route needs the shared token; without one configured the routes stay closed
+        given = headers.get('X-Cluster-Token', '')
+        return bool(self.token) and hmac.compare_digest(given.encode(), self.token.encode())
+
+    def version(self):
+        return f'{self._instance}-{self._generation}'
+
+    def changed(self):
+        # The library or an item's metadata changed: connected nodes sync
+        with self._lock:
+            self._generation += 1
+            self._listing = None
+            version = self.version()
+        self.event_bus.publish('library', {'version': version})
+
+    def listing(self):
+        # (version, JSON body): every item newest first, with what a node needs to mirror its row
+        with self._lock:
+            if self._listing is not None:
+                return self._listing
+            version = self.version()
+        items = []
+        for media_id in self.media_index.ids():
+            filepath = self.media_index.path_for(media_id)
+            item_version = self.media_index.version(filepath) if filepath is not None else None
+            if item_version is None:
+                continue  # removed while listing
+            items.append({'id': media_id,
+                          'path': os.path.relpath(filepath, self.uploads_dir).replace(os.sep, '/'),
+                          'version': item_version,
+                          'mtime': self.media_index.mtime_for(filepath),
+                          'transform': transform_json(self.media_index.transform_for(filepath)),
+                          'favourite': self.media_index.is_favourite(filepath),
+                          'video': is_video(filepath)})
+        body = json.dumps({'version': version, 'items': items})
+        with self._lock:
+            if self.version() == version:
+                self._listing = (version, body)
+        return version, body
+
+    def file_for(self, media_id, version, name):
+        # Path for /cluster/file: the original (videos) or a rendition, built now if the hub's own holes
+        # don't use that size. None if the item is gone or changed since the node's listing;
+        # ValueError for a name that is neither
+        filepath = self.media_index.path_for(media_id)
+        if filepath is None or self.media_index.version(filepath) != version:
+            return None
+        if name == ORIGINAL:
+            return filepath
+        parsed = parse_size_name(name)
+        if parsed is None or is_video(filepath) or not all(0 < side <= MAX_SIDE for side in parsed[0]):
+            raise ValueError(name)
+        return self.renditions.rendition_for(filepath, *parsed)
+
+
+class ClusterClient:
+    # Node side, next to the display: keeps the local media table and cache in step with the hub
+
+    def __init__(self, db, library_dir, renditions_dir, hub_url, targets, token='', cache_bytes=2 << 30,
+                 poll_seconds=300.0, retry_seconds=30.0, timeout=30.0):
+        self.db = db  # the node's own media.db (program/database.py)
+        self.library_dir = library_dir  # where item paths are rooted here; holds the downloaded videos
+        self.renditions_dir = renditions_dir
+        self.hub_url = hub_url
+        self.token = token
+        self.cache_bytes = cache_bytes
+        self.poll_seconds = poll_seconds  # full sync at least this often, events or not
+        self.retry_seconds = retry_seconds
+        self.timeout = timeout  # longer than the hub's [events] keepalive_seconds
+        self.targets = targets  # ((w, h), fit) per hole, see rendition_targets
+        self.on_message = None  # message -> None: program/display.py handle_message
+        self.online = None
+        self._items = []  # the hub's last listing, reused while it answers 304 Not Modified
+        self._version = None
+        self._rows = None  # media id -> [filepath, renditions entry, favourite], loaded on the first sync
+        self._usage = {}  # media id -> bytes in the cache
+        self._used = 0  # sum of _usage, kept up to date instead of summed per item
+        self._eviction = None  # cached media ids, most recently shown first; sorted once per sync when needed
+        self._shown = {}  # filepath -> when the display last put it in a hole (since this process started)
+        self._holes = {}  # hole id -> filepath on screen, never evicted
+        self._failed = set()  # (media id, version) the hub could not serve; tried again when the version changes
+        self._sync_lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name='cluster', daemon=True).start()
+
+    def set_targets(self, targets):
+        # The node's holes changed size or fit: fetch renditions for the new ones
+        self.targets = targets
+        if self.online:
+            threading.Thread(target=self._sync_now, name='cluster-sync', daemon=True).start()
+        else:
+            self._wake.set()  # retry now rather than after retry_seconds
+
+    def _sync_now(self):
+        try:
+            self.sync()
+        except (OSError, ValueError) as e:
+            print(f"Cluster sync error: {e}")
+
+    def handle_message(self, message):
+        # From the display: hole swaps decide what is evicted first
+        kind = message.get('type')
+        if kind == 'hole':
+            self._holes = dict(self._holes, **{str(message['hole']): message['path']})
+        elif kind == 'holes':
+            self._holes = {str(hole_id): filepath for hole_id, filepath in message['holes'].items()}
+        else:
+            return
+        now = time.time()
+        for filepath in self._holes.values():
+            if filepath:
+                self._shown[filepath] = now
+
+    def _run(self):
+        while True:
+            try:
+                self.sync()
+                self._listen()
+            except (OSError, ValueError) as e:
+                if self.online is not False:
+                    print(f"Cluster hub unreachable, playing from the cache: {e}")
+                self.online = False
+                self._wake.wait(self.retry_seconds)
+
+    def _open(self, path, headers=None):
+        request = urllib.request.Request(self.hub_url + path, headers=dict(headers or {}, **{'X-Cluster-Token': self.token}))
+        return urllib.request.urlopen(request, timeout=self.timeout)
+
+    def _listen(self):
+        # Follow the hub's event stream until it drops: sync when the library changed and every
+        # poll_seconds. The hub's keepalives keep the loop turning.
+        with self._open('/cluster/events') as stream:
+            last_sync = time.monotonic()
+            for line in stream:
+                line = line.decode('utf-8', 'replace').strip()
+                stale = False
+                if line.startswith('data:'):
+                    try:
+                        stale = json.loads(line[5:]).get('version') != self._version
+                    except ValueError:
+                        stale = True
+                if stale or time.monotonic() - last_sync > self.poll_seconds:
+                    self.sync()
+                    last_sync = time.monotonic()
+
+    def sync(self):
+        # One pass: fetch the listing, drop what the hub no longer has, download what the holes need
+        with self._sync_lock:
+            self._wake.clear()
+            items = self._fetch_listing()
+            if self.online is not True:
+                print(f"Cluster hub {self.hub_url}: {len(items)} items")
+            self.online = True
+            self._apply(items)
+
+    def _fetch_listing(self):
+        headers = {'If-None-Match': f'"{self._version}"'} if self._version else None
+        try:
+            with self._open('/cluster/library', headers) as response:
+                data = json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise
+            return self._items
+        self._items, self._version = data['items'], data['version']
+        return self._items
+
+    def _local_path(self, path):
+        # The hub's relative path under library_dir; None for anything that would leave it
+        parts = path.split('/')
+        if any(part in ('', '.', '..') for part in parts):
+            return None
+        return os.path.join(self.library_dir, *parts)
+
+    def _load_rows(self):
+        rows = self.db.query('SELECT id, filepath, renditions, favourite FROM media')
+        self._rows = {}
+        for media_id, filepath, data, favourite in rows:
+            try:
+                entry = json.loads(data) if data else {}
+            except ValueError:
+                entry = {}
+            self._rows[media_id] = [filepath, entry, bool(favourite)]
+            self._usage[media_id] = sum(os.path.getsize(path) for path in entry.get('sizes', {}).values()
+                                        if os.path.exists(path))
+        self._used = sum(self._usage.values())
+
+    def _names(self, item):
+        # Files this node needs for an item: one rendition per hole size and fit, or the video itself
+        if item['video']:
+            return [ORIGINAL]
+        return sorted({size_name(size, effective_fit(item['transform'], fit)) for size, fit in self.targets})
+
+    def _apply(self, items):
+        if self._rows is None:
+            self._load_rows()
+        wanted = {}
+        for item in items:
+            filepath = self._local_path(item['path'])
+            if filepath is not None:
+                wanted[item['id']] = (item, filepath)
+        rank = {media_id: i for i, media_id in enumerate(wanted)}  # 0 = newest
+        gone = [media_id for media_id, row in self._rows.items()
+                if media_id not in wanted or wanted[media_id][1] != row[0]]
+        if gone:
+            self._notify([], [self._drop(media_id) for media_id in gone])
+
+        full = False
+        self._eviction = None
+        for media_id, (item, filepath) in wanted.items():
+            row = self._rows.get(media_id)
+            names = self._names(item)
+            if row is not None and row[1].get('version') == item['version'] and set(row[1].get('sizes', {})) == set(names):
+                if row[2] != item['favourite']:
+                    row[2] = item['favourite']
+                    self.db.execute('UPDATE media SET favourite = ? WHERE id = ?', (int(row[2]), media_id))
+                    self._notify([filepath], [])
+                continue
+            if full or (media_id, item['version']) in self._failed:
+                continue
+            try:
+                full = not self._fetch(item, filepath, names, rank)  # the rest is older; it won't fit either
+            except urllib.error.HTTPError as e:
+                # Changed since the listing (the next sync has it), or not decodable on the hub
+                print(f"Cluster download error for {item['path']}: {e}")
+                self._failed.add((media_id, item['version']))
+
+    def _fetch(self, item, filepath, names, rank):
+        # Download the item's missing files and record its row; False if there is no room for it
+        media_id = item['id']
+        row = self._rows.get(media_id)
+        current = row is not None and row[1].get('version') == item['version']
+        sizes = {name: path for name, path in row[1].get('sizes', {}).items()
+                 if name in names and os.path.exists(path)} if current else {}
+        if self._used >= self.cache_bytes and self._next_victim(rank, rank[media_id]) is None:
+            return False
+        out_dir = os.path.join(self.renditions_dir, str(media_id))
+        os.makedirs(out_dir, exist_ok=True)
+        downloaded = []
+        try:
+            for name in names:
+                if name not in sizes:
+                    if name == ORIGINAL:
+                        sizes[name] = self._download(f"/cluster/file/{media_id}/{item['version']}/{name}", filepath)
+                    else:
+                        sizes[name] = self._download(f"/cluster/file/{media_id}/{item['version']}/{name}",
+                                                     os.path.join(out_dir, name), typed=True)
+                    downloaded.append(sizes[name])
+        except BaseException:
+            self._discard(media_id, downloaded)
+            raise
+        usage = sum(os.path.getsize(path) for path in sizes.values())
+        if not self._make_room(usage - self._usage.get(media_id, 0), rank, rank[media_id]):
+            self._discard(media_id, downloaded)
+            return False
+        if row is not None:
+            for path in set(row[1].get('sizes', {}).values()) - set(sizes.values()):
+                self._remove_file(path)  # an older version, or a hole size this node no longer has
+
+        rotation, crop, fit, focal = item['transform']
+        crop, focal = crop or (None,) * 4, focal or (None, None)
+        entry = {'mtime': item['mtime'], 'transform': item['transform'], 'sizes': sizes, 'boxes': {}, 'thumb': None,
+                 'version': item['version']}
+        parts = item['path'].split('/')
+        self.db.execute('INSERT OR REPLACE INTO media (id, filepath, user, rotation, crop_x, crop_y, crop_w, crop_h, fit, '
+                        'focal_x, focal_y, mtime, size, favourite, renditions) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (media_id, filepath, parts[0] if len(parts) > 1 else None, rotation, *crop, fit, *focal,
+                         item['mtime'], usage, int(item['favourite']), json.dumps(entry)))
+        self._rows[media_id] = [filepath, entry, item['favourite']]
+        self._used += usage - self._usage.get(media_id, 0)
+        self._usage[media_id] = usage
+        self._notify([filepath], [])
+        return True
+
+    def _download(self, url_path, dest, typed=False):
+        # To a temp name first, so the display never decodes half a file; typed adds the extension of
+        # what the hub sent (renditions are PNG for images with transparency, JPEG otherwise)
+        with self._open(url_path) as response:
+            if typed:
+                dest += '.png' if response.headers.get_content_type() == 'image/png' else '.jpg'
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            tmp = dest + '.part'
+            try:
+                with open(tmp, 'wb') as f:
+                    shutil.copyfileobj(response, f, READ_SIZE)
+            except BaseException:
+                self._remove_file(tmp)
+                raise
+        os.replace(tmp, dest)
+        return dest
+
+    def _discard(self, media_id, downloaded):
+        # Undo a download that failed or didn't fit; a new version may have replaced files the row
+        # still points at, so the row goes too
+        for path in downloaded:
+            self._remove_file(path)
+        row = self._rows.get(media_id)
+        if row is None:
+            shutil.rmtree(os.path.join(self.renditions_dir, str(media_id)), ignore_errors=True)
+        elif set(downloaded) & set(row[1].get('sizes', {}).values()):
+            self._notify([], [self._drop(media_id)])
+
+    def _next_victim(self, rank, below):
+        # The item that goes first to make room for the item at rank below: the least recently shown
+        # older one not on screen, or None. Items are fetched newest first, so below only grows during
+        # a sync and anything at or above it leaves the eviction list for good
+        if self._eviction is None:
+            self._eviction = sorted(self._rows, key=self._last_shown, reverse=True)
+        on_screen = set(self._holes.values())
+        victims = self._eviction
+        i = len(victims) - 1
+        while i >= 0:
+            media_id = victims[i]
+            row = self._rows.get(media_id)
+            if row is None or rank.get(media_id, len(rank)) <= below:
+                victims.pop(i)  # dropped already, or not older than the item being fetched
+            elif row[0] not in on_screen:
+                return media_id
+            i -= 1
+        return None
+
+    def _last_shown(self, media_id):
+        shown = self._shown.get(self._rows[media_id][0])
+        if shown is not None:
+            return shown
+        try:
+            return os.path.getmtime(os.path.join(self.renditions_dir, str(media_id)))  # when it was downloaded
+        except OSError:
+            return 0.0
+
+    def _make_room(self, nbytes, rank, below):
+        removed = []
+        while self._used + nbytes > self.cache_bytes:
+            media_id = self._next_victim(rank, below)
+            if media_id is None:
+                break
+            removed.append(self._drop(media_id))
+        if removed:
+            self._notify([], removed)
+        return self._used + nbytes <= self.cache_bytes
+
+    def _drop(self, media_id):
+        # Forget an item: its row and its files in the cache. Returns its path
+        filepath, entry, _ = self._rows.pop(media_id)
+        self._used -= self._usage.pop(media_id, 0)
+        for path in entry.get('sizes', {}).values():
+            self._remove_file(path)
+        shutil.rmtree(os.path.join(self.renditions_dir, str(media_id)), ignore_errors=True)
+        self.db.execute('DELETE FROM media WHERE id = ?', (media_id,))
+        return filepath
+
+    def _remove_file(self, path):
+        # Only ever files in the cache, whatever a row says
+        roots = tuple(os.path.abspath(d) + os.sep for d in (self.library_dir, self.renditions_dir))
+        if os.path.abspath(path).startswith(roots):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _notify(self, changed, removed):
+        if self.on_message is None:
+            return
+        for filepath in changed:
+            self.on_message({'type': 'renditions', 'path': filepath})
+        self.on_message({'type': 'media', 'changed': changed, 'removed': removed})
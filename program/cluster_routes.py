@@ -0,0 +1,46 @@
+# Routes the display nodes of program/cluster.py sync from: the library listing, its change events and
+# renditions in any hole size. Every request needs the [cluster] token of config.cfg
+# Used by program/web.py (registered as a blueprint)
+# Depends on program/library.py (cluster_hub) and program/serving.py for the file responses
+
+from flask import Blueprint, request, Response
+from serving import send_media
+from library import cluster_hub
+
+blueprint = Blueprint('cluster', __name__)
+
+@blueprint.route('/cluster/library')
+def cluster_library():
+    # Every item for the display nodes of program/cluster.py; unchanged since their last sync is a 304
+    if not cluster_hub.authorized(request.headers):
+        return '', 403
+    version, body = cluster_hub.listing()
+    if request.if_none_match.contains(version):
+        return '', 304
+    response = Response(body, mimetype='application/json')
+    response.set_etag(version)
+    return response
+
+@blueprint.route('/cluster/events')
+def cluster_events():
+    # Server-Sent Events: the library version on connect, then again whenever it changes
+    if not cluster_hub.authorized(request.headers):
+        return '', 403
+    return Response(cluster_hub.event_bus.stream(lambda: {'version': cluster_hub.version()}),
+                    mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@blueprint.route('/cluster/file/<int:media_id>/<version>/<name>')
+def cluster_file(media_id, version, name):
+    # A rendition in a node's hole size (WxH or WxH-cover), or the original video
+    if not cluster_hub.authorized(request.headers):
+        return '', 403
+    try:
+        path = cluster_hub.file_for(media_id, version, name)
+    except ValueError:
+        return '', 400
+    except Exception as e:
+        print(f"Rendition error for media {media_id}: {e}")
+        return '', 404
+    if path is None:
+        return '', 404
+    return send_media(path, version, immutable=True)
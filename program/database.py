@@ -0,0 +1,98 @@
+# SQLite access shared by everything that uses media.db: one connection per thread, opened once and reused
+# Used by program/settings.py (db, init_db), program/media_index.py and program/renditions.py
+# WAL lets the display and the web server read while the other process (or a rendition worker) writes;
+# busy_timeout makes a writer wait for the lock instead of failing with "database is locked"
+# Schema changes are numbered migrations, recorded in PRAGMA user_version
+# Settings come from the [database] section of config.cfg (cache_kb, mmap_mb, busy_timeout_ms)
+
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+STATEMENT_CACHE = 128  # compiled statements kept per connection; all queries are constant strings with ? parameters
+BATCH_SIZE = 500  # values per IN (...) list, below SQLite's host parameter limit
+
+
+class Database:
+    def __init__(self, path, cache_kb=4096, mmap_mb=64, busy_timeout_ms=5000):
+        self.path = path
+        self.cache_kb = cache_kb
+        self.mmap_mb = mmap_mb
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()  # the connection of the calling thread; closed when the thread ends
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, cached_statements=STATEMENT_CACHE)
+            conn.execute('PRAGMA journal_mode = WAL')  # stored in the file; a no-op once set
+            conn.execute('PRAGMA synchronous = NORMAL')  # safe with WAL: a power cut can only lose the last commits
+            conn.execute(f'PRAGMA cache_size = -{int(self.cache_kb)}')
+            conn.execute(f'PRAGMA mmap_size = {int(self.mmap_mb) * 1024 * 1024}')
+            conn.execute('PRAGMA temp_store = MEMORY')
+            self._local.conn = conn
+        return conn
+
+    def query(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchall()
+
+    def query_one(self, sql, params=()):
+        # The cursor is closed right away so the statement does not keep a WAL read snapshot open
+        cursor = self.connection().execute(sql, params)
+        try:
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+
+    def query_in(self, sql, values, params=()):
+        # sql has a single IN ({}) placeholder, filled with values BATCH_SIZE at a time; params come first
+        values = list(values)
+        rows = []
+        conn = self.connection()
+        for i in range(0, len(values), BATCH_SIZE):
+            chunk = values[i:i + BATCH_SIZE]
+            rows += conn.execute(sql.format(','.join('?' * len(chunk))), tuple(params) + tuple(chunk)).fetchall()
+        return rows
+
+    def execute(self, sql, params=()):
+        # One write in its own transaction; returns the number of rows changed
+        conn = self.connection()
+        with conn:
+            return conn.execute(sql, params).rowcount
+
+    def execute_many(self, statements):
+        # Batched writes: [(sql, rows), ...] in one transaction, so a whole watcher batch or reconcile
+        # costs a single commit
+        with self.transaction() as conn:
+            for sql, rows in statements:
+                if rows:
+                    conn.executemany(sql, rows)
+
+    @contextmanager
+    def transaction(self):
+        # Commits when the block ends, rolls back if it raises
+        conn = self.connection()
+        with conn:
+            yield conn
+
+    def migrate(self, migrations):
+        # migrations: [(version, step)] in order; a step is a list of SQL statements or a function taking
+        # the connection. Both processes may start at once: BEGIN IMMEDIATE makes the second one wait
+        # for the first and then find nothing left to do.
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            current = conn.execute('PRAGMA user_version').fetchone()[0]
+            for version, step in migrations:
+                if version <= current:
+                    continue
+                if callable(step):
+                    step(conn)
+                else:
+                    for sql in step:
+                        conn.execute(sql)
+                conn.execute(f'PRAGMA user_version = {int(version)}')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
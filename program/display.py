@@ -0,0 +1,414 @@
+# pygame display for 80s TV Frame: owns the screen, the surface cache, prefetching and video playback
+# Run by program/app.py, either next to program/web.py in one process or on its own (--role display)
+# Depends on config.cfg through program/settings.py; the layout snapshot comes from program/layout.py
+# and is swapped between frames when config.cfg changes
+# Depends on program/surface_cache.py for the display surface cache
+# Depends on program/scene.py for dirty-region rendering
+# Depends on program/prefetch.py for background decoding of the next image per hole
+# Depends on program/video.py for video playback in the holes
+# Depends on program/renditions.py to find renditions built by program/web.py
+# Depends on program/media_index.py (read only here; program/web.py writes the media table, or
+# program/cluster.py on a cluster node, where the QR code points at the hub)
+# Depends on program/scheduler.py for what each hole shows next and when
+# Depends on program/metrics.py and program/overlay.py for render-loop instrumentation
+# Depends on program/memory.py for the cache and prefetch budgets and backing off under memory pressure
+# Messages from the web server (program/library.py) arrive in handle_message; hole swaps go out through send
+# (a direct call in one process, program/ipc.py otherwise)
+# Startup is staged: the first frame (calibration grid or empty holes) is drawn from the layout alone;
+# the library, renditions and QR code are loaded in the background and appear when ready. The database
+# migrations, the media index and PIL (through program/renditions.py and the decoders in
+# program/surface_cache.py) all wait until then
+
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+
+from settings import config, layout_service, rendition_targets, uploads_dir, renditions_dir, renditions_options, \
+    schedule_options, memory_options, max_decode_pixels, db, init_db, cluster_hub_url
+from layout import reshaped_holes, hole_size
+from surface_cache import SurfaceCache
+from scene import Scene, hole_rect
+from prefetch import Prefetcher
+from video import VideoEngine
+from scheduler import Scheduler
+from metrics import Metrics
+from overlay import DebugOverlay
+from memory import MemoryGovernor
+
+surface_cache_mb = int(config['display'].get('surface_cache_mb', 64))
+prefetch_workers = int(config['display'].get('prefetch_workers', 2))
+
+# Layout snapshot in use; only the display loop replaces it (apply_layout)
+layout = layout_service.current
+holes = layout.holes
+
+# Media file currently shown in each hole (by path, so library re-sorts don't move it)
+current_media = {hole['id']: None for hole in holes}
+
+# Library index, kept in step with the web server's changes through handle_message, and the renditions
+# the web server built (the display only looks them up); both are set up by load_library
+media_index = None
+renditions = None
+
+# Weighted, non-repeating playlist with a swap interval per hole; load_library gives it the index
+scheduler = Scheduler(holes, None, **schedule_options)
+
+# Video settings
+video_max_decoders = int(config['video'].get('max_decoders', 0))  # decoder threads shared by the videos, 0 = core count
+
+# Pre-scaled display surfaces
+surface_cache = SurfaceCache(surface_cache_mb * 1024 * 1024)
+surface_cache.max_pixels = max_decode_pixels
+
+# Retained display scene; messages from the web server mark it dirty and wake the display loop
+video_engine = VideoEngine(layout.video['loop'], layout.video['mute'], layout.video['fps'], video_max_decoders)
+scene = Scene(holes, surface_cache, video_engine)
+video_engine.on_frame = scene.wake
+video_engine.slots = len(holes)
+
+# Decodes the next image for each hole ahead of its swap
+prefetcher = Prefetcher(surface_cache, prefetch_workers, on_ready=scene.wake)
+
+# Cache and prefetch budgets; shrinks them when the system runs low on memory
+memory_governor = MemoryGovernor(surface_cache, prefetcher, None, surface_cache.budget_bytes, **memory_options)
+surface_cache.on_memory_error = memory_governor.memory_error
+
+# Render-loop instrumentation; a snapshot goes to the web server's /metrics every push_seconds
+metrics = Metrics()
+metrics.histogram('display_frame_seconds', 'Time to draw and present one frame')
+metrics.counter('display_slow_frames_total', 'Frames that took longer than one video frame interval')
+metrics.histogram('display_decode_seconds', 'Image decode time per hole; hole="render" is a cache miss decoded while drawing')
+metrics.histogram('display_scale_seconds', 'Rotate, crop, fit and mask time per hole')
+metrics.counter('display_surface_cache_hits_total', 'Surface cache lookups that found a decoded image')
+metrics.counter('display_surface_cache_misses_total', 'Surface cache lookups that had to decode')
+metrics.counter('display_decode_failures_total', 'Images that could not be decoded')
+metrics.gauge('display_surface_cache_bytes', 'Memory used by decoded surfaces')
+metrics.gauge('display_surface_cache_budget_bytes', 'Surface cache budget after memory pressure and index growth')
+metrics.gauge('display_prefetch_bytes', 'Memory held by decodes waiting to be swapped in')
+metrics.counter('display_prefetch_deferred_total', 'Prefetches put off because the prefetch budget was full')
+metrics.gauge('display_index_bytes', 'Estimated memory used by the media path index')
+metrics.gauge('display_memory_available_bytes', 'MemAvailable at the last memory check')
+metrics.gauge('display_memory_scale', 'Fraction of the configured cache and prefetch budgets in use')
+metrics.counter('display_memory_pressure_total', 'Times the budgets were cut for low memory or a failed decode')
+metrics.counter('display_swaps_total', 'Prefetched images swapped into a hole')
+metrics.counter('display_missed_deadlines_total', 'Hole swaps that were due before their image was decoded')
+metrics.counter('display_dropped_frames_total', 'Video frames replaced before they were drawn')
+metrics.gauge('display_library_items', 'Items in the media library')
+metrics.gauge('display_first_frame_seconds', 'Time from process start to the first frame on screen')
+metrics.gauge('display_library_ready_seconds', 'Time from process start until the library was loaded')
+metrics_push_seconds = config.getfloat('metrics', 'push_seconds', fallback=5.0)
+overlay_on = config.getboolean('metrics', 'overlay', fallback=False)
+OVERLAY_SECONDS = 1.0
+
+def record_decode(hole_id, timings):
+    hole = 'render' if hole_id is None else str(hole_id)
+    metrics.observe('display_decode_seconds', timings['decode'], hole=hole)
+    metrics.observe('display_scale_seconds', timings['scale'], hole=hole)
+
+prefetcher.on_decoded = record_decode
+surface_cache.on_decoded = lambda timings: record_decode(None, timings)
+
+# Display mode
+display_mode = config['display'].get('mode', 'calibrate')  # 'calibrate' or 'media'
+
+# Set by program/app.py: delivers messages to the web server
+send = None
+
+def notify(message):
+    if send is not None:
+        send(message)
+
+def get_local_ip():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect(("8.8.8.8", 80))
+        ip = s.getsockname()[0]
+    except OSError:
+        ip = "127.0.0.1"
+    finally:
+        s.close()
+    return ip
+
+def load_media():
+    # Library order comes from the indexed media table, newest first
+    media_index.load()
+    scheduler.set_library(media_index.ids())
+    surface_cache.retain(media_index.id_for)
+    memory_governor.apply()  # the index may have outgrown its budget
+    scene.wake()
+
+def load_library(started=None):
+    # Background thread at startup (or called first, e.g. by program/benchmark.py): the media table as
+    # the last run left it; the web server's reconcile scan sends 'reload' if it finds changes.
+    # PIL comes in with program/renditions.py here, off the startup path
+    global library_loaded, media_index, renditions
+    from renditions import RenditionPipeline
+    from media_index import MediaIndex
+    init_db()
+    index = MediaIndex(db, uploads_dir)
+    pipeline = RenditionPipeline(db, renditions_dir, rendition_targets(holes), **renditions_options)
+    surface_cache.resolve_source = pipeline.source_for
+    surface_cache.resolve_transform = index.transform_for
+    if cluster_hub_url:
+        # A cluster node has the hub's renditions, not the originals (program/cluster.py)
+        surface_cache.resolve_mtime = index.mtime_for
+        pipeline.originals = False
+    scheduler.media_index = memory_governor.media_index = index
+    media_index, renditions = index, pipeline
+    renditions.set_targets(rendition_targets(holes))  # the layout may have changed meanwhile
+    renditions.load_index()
+    load_media()
+    library_loaded = True
+    if started is not None:
+        metrics.set('display_library_ready_seconds', time.monotonic() - started)
+
+library_loaded = False
+
+def make_qr_image():
+    # Background thread: the web address as a QR code; qrcode is imported here, off the startup path
+    import qrcode
+    url = cluster_hub_url or f"http://{get_local_ip()}:8000"
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(url)
+    qr.make(fit=True)
+    return qr.make_image(fill='black', back_color='white').convert('RGB').resize((100, 100))
+
+def sample_metrics():
+    # Copy the counters kept by the cache, prefetcher and video engine
+    metrics.set('display_surface_cache_hits_total', surface_cache.hits)
+    metrics.set('display_surface_cache_misses_total', surface_cache.misses)
+    metrics.set('display_decode_failures_total', surface_cache.failures)
+    metrics.set('display_surface_cache_bytes', surface_cache.used_bytes)
+    metrics.set('display_swaps_total', prefetcher.swaps)
+    metrics.set('display_missed_deadlines_total', prefetcher.missed_deadlines)
+    metrics.set('display_dropped_frames_total', video_engine.dropped_frames)
+    metrics.set('display_surface_cache_budget_bytes', surface_cache.budget_bytes)
+    metrics.set('display_prefetch_bytes', prefetcher.pending_bytes)
+    metrics.set('display_prefetch_deferred_total', prefetcher.deferred)
+    if memory_governor.available is not None:
+        metrics.set('display_memory_available_bytes', memory_governor.available)
+    metrics.set('display_memory_scale', memory_governor.scale)
+    metrics.set('display_memory_pressure_total', memory_governor.pressure_events)
+    if media_index is not None:
+        metrics.set('display_index_bytes', media_index.memory_bytes())
+        metrics.set('display_library_items', len(media_index))
+
+def push_metrics():
+    # Background thread: the web server keeps the latest snapshot for /metrics
+    while True:
+        time.sleep(metrics_push_seconds)
+        sample_metrics()
+        notify({'type': 'metrics', 'metrics': metrics.snapshot()})
+
+def snapshot():
+    # Everything the web server needs to know about the screen, sent when it connects
+    return {'type': 'holes', 'holes': dict(current_media)}
+
+def in_use():
+    # Media ids on screen or decoded ahead for a hole; the scheduler passes over them
+    return {media_index.id_for(filepath) for filepath in set(current_media.values()) | prefetcher.pending_paths()
+            if filepath is not None}
+
+def set_hole_media(hole_id, filepath):
+    # Display loop only: change what a hole shows and tell the web server
+    if current_media[hole_id] == filepath:
+        return
+    current_media[hole_id] = filepath
+    notify({'type': 'hole', 'hole': hole_id, 'path': filepath})
+
+# Newest snapshot from program/layout.py, waiting for the display loop
+pending_layout = None
+
+def layout_changed(old, new):
+    # Any thread: config.cfg changed or the offset was nudged
+    global pending_layout
+    pending_layout = new
+    scene.wake()
+
+layout_service.subscribe(layout_changed)
+
+def apply_layout(new):
+    # Display loop only: swap in a new layout. Holes that only moved keep their cached surfaces, video
+    # and pending prefetch; resized, reshaped, added and removed holes start over.
+    global layout, holes, current_media
+    old, layout, holes = layout, new, new.holes
+    reshaped = reshaped_holes(old, new)
+    if old.video != new.video:
+        video_engine.loop, video_engine.mute, video_engine.fps = new.video['loop'], new.video['mute'], new.video['fps']
+        reshaped |= {hole['id'] for hole in holes}  # restart the players with the new flags
+    for hole_id in reshaped:
+        prefetcher.discard(hole_id)
+    surface_cache.discard_sizes({hole_size(hole) for hole in old.holes if hole['id'] in reshaped}
+                                - {hole_size(hole) for hole in holes})
+    if renditions is not None:
+        renditions.set_targets(rendition_targets(holes))
+    video_engine.slots = len(holes)
+    current_media = {hole['id']: current_media.get(hole['id']) for hole in holes}
+    scene.set_holes(holes, reshaped)
+    if [(hole['id'], hole['interval']) for hole in old.holes] != [(hole['id'], hole['interval']) for hole in holes]:
+        scheduler.start(holes)
+    notify(snapshot())
+
+def handle_message(message):
+    # From program/library.py (Flask thread in one process, IPC reader thread otherwise)
+    global display_mode, overlay_on
+    kind = message.get('type')
+    if kind in ('media', 'reload', 'renditions') and media_index is None:
+        return  # load_library hasn't started on the media table yet; it reads everything afresh
+    if kind == 'media':
+        # Files added, replaced, removed or given new rotation/crop/fit metadata
+        changed, removed = message.get('changed', []), message.get('removed', [])
+        new = [filepath for filepath in changed if media_index.id_for(filepath) is None]
+        media_index.refresh(changed + removed)
+        scheduler.add([media_id for media_id in map(media_index.id_for, new) if media_id is not None])
+        for filepath in changed + removed:
+            surface_cache.invalidate(filepath)
+        for filepath in changed:
+            scene.invalidate_path(filepath)
+        scene.wake()
+    elif kind == 'reload':
+        # Full reconcile on the web side
+        renditions.load_index()
+        load_media()
+    elif kind == 'renditions':
+        renditions.reload(message['path'])
+    elif kind == 'layout':
+        # Calibration nudge; sent straight away rather than waiting for this process to see config.cfg change
+        layout_service.set_offset(*message['offset'], save=False)
+    elif kind == 'mode':
+        display_mode = message['mode']
+        scheduler.start(holes)
+        scene.request_redraw()
+    elif kind == 'overlay':
+        overlay_on = message['on']
+        if overlay_on:
+            scene.wake()
+        else:
+            scene.set_debug(None)
+
+def run_display(fullscreen=True, max_frames=None, on_frame=None, started=None):
+    # fullscreen=False with SDL_VIDEODRIVER=dummy renders offscreen at the configured size;
+    # max_frames returns after that many presented frames, on_frame receives each frame time (program/benchmark.py);
+    # started is the monotonic time the process started, for the time to first frame (program/app.py)
+    global pending_layout
+    started = time.monotonic() if started is None else started
+    # Only what the display needs; audio is played by ffplay, so the mixer is never opened
+    pygame.display.init()
+    pygame.font.init()
+    flags = pygame.FULLSCREEN if fullscreen else 0
+    screen = pygame.display.set_mode(layout.screen_size, flags)
+    pygame.display.set_caption("80s TV Frame Display")
+    font = pygame.font.SysFont(None, 36)
+
+    # QR code with the web address, drawn at bottom left on top of the holes once it has been made
+    qr_future = ThreadPoolExecutor(max_workers=1, thread_name_prefix='qrcode').submit(make_qr_image)
+    qr_future.add_done_callback(lambda f: scene.wake())
+    qr_surface = None
+    scene.attach(screen, font)
+    scene.wake()  # draw the first frame without waiting for an event
+    if not library_loaded:
+        threading.Thread(target=load_library, args=(started,), name='library', daemon=True).start()
+    first_frame = True
+    scheduler.start(holes)
+    waiting_swaps = set()  # holes that are due but whose prefetch hasn't finished
+
+    # Debug overlay to the right of the QR code, refreshed every OVERLAY_SECONDS while it is on
+    debug_overlay = DebugOverlay(metrics, pygame.font.SysFont(None, 24))
+    overlay_pos = (120, layout.screen_size[1] - 110)
+    next_overlay_time = time.monotonic()
+    frames = 0
+    threading.Thread(target=push_metrics, name='metrics', daemon=True).start()
+    memory_governor.start()
+
+    while True:
+        if pending_layout is not None:
+            new, pending_layout = pending_layout, None
+            if new.screen_size != screen.get_size():
+                screen = pygame.display.set_mode(new.screen_size, flags)
+                scene.attach(screen, font, (qr_surface, (10, new.screen_size[1] - 110)) if qr_surface else None)
+                overlay_pos = (120, new.screen_size[1] - 110)
+                scene.set_debug(None)
+            apply_layout(new)
+            waiting_swaps &= set(current_media)  # forget removed holes
+
+        # Sleep until the next hole is due, the overlay needs a refresh or an event (input, WAKE_EVENT
+        # from a route) arrives
+        deadlines = []
+        if display_mode == 'media' and media_index is not None and len(media_index):
+            deadlines.append(scheduler.next_due())
+        if overlay_on:
+            deadlines.append(next_overlay_time)
+        if deadlines:
+            timeout_ms = int((min(deadlines) - time.monotonic()) * 1000)
+            events = [pygame.event.wait(max(1, timeout_ms))] if timeout_ms > 0 else []
+        else:
+            events = [pygame.event.wait()]
+        events += pygame.event.get()
+
+        if qr_surface is None and qr_future.done():
+            try:
+                qr_img = qr_future.result()
+                qr_surface = pygame.image.fromstring(qr_img.tobytes(), qr_img.size, 'RGB').convert()
+                scene.set_overlay((qr_surface, (10, layout.screen_size[1] - 110)))
+            except Exception as e:
+                print(f"QR code error: {e}")
+                qr_surface = False  # carry on without it
+
+        for event in events:
+            if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+                video_engine.stop_all()
+                pygame.quit()
+                sys.exit()
+            elif event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                scene.invalidate_all()
+
+        if display_mode == 'media' and media_index is not None and len(media_index):
+            # Pick each hole's next item ahead of time and decode it in the background
+            for hole in holes:
+                if not prefetcher.pending(hole['id']) and prefetcher.has_room(hole['id'], hole_rect(hole).size):
+                    filepath = media_index.path_for(scheduler.pick(exclude=in_use()))
+                    if filepath is not None:
+                        prefetcher.schedule(hole['id'], filepath, hole_rect(hole).size, hole['type'], hole['fit'])
+            # Each hole changes on its own interval
+            for hole_id in scheduler.due(time.monotonic()):
+                prefetcher.check_deadline(hole_id)
+                waiting_swaps.add(hole_id)
+            for hole_id, filepath in current_media.items():
+                if filepath is None or media_index.id_for(filepath) is None:
+                    # Empty hole or deleted file: swap as soon as the hole's prefetch is ready, don't wait for its interval
+                    waiting_swaps.add(hole_id)
+            # Only swap in images that are already decoded
+            for hole_id in list(waiting_swaps):
+                if prefetcher.ready(hole_id):
+                    filepath = prefetcher.take(hole_id)
+                    waiting_swaps.discard(hole_id)
+                    if media_index.id_for(filepath) is not None:
+                        set_hole_media(hole_id, filepath)
+
+        if overlay_on and time.monotonic() >= next_overlay_time:
+            sample_metrics()
+            scene.set_debug(debug_overlay.render(surface_cache.used_bytes, surface_cache.budget_bytes), overlay_pos)
+            next_overlay_time = time.monotonic() + OVERLAY_SECONDS
+
+        frame_start = time.perf_counter()
+        rects = scene.render(display_mode, current_media)
+        if rects:
+            pygame.display.update(rects)
+            frame_time = time.perf_counter() - frame_start
+            metrics.observe('display_frame_seconds', frame_time)
+            if frame_time > 1.0 / video_engine.fps:  # longer than one video frame
+                metrics.inc('display_slow_frames_total')
+            if first_frame:
+                first_frame = False
+                metrics.set('display_first_frame_seconds', time.monotonic() - started)
+                print(f"First frame after {time.monotonic() - started:.2f}s")
+            if on_frame:
+                on_frame(frame_time)
+            frames += 1
+            if max_frames is not None and frames >= max_frames:
+                video_engine.stop_all()
+                return
@@ -0,0 +1,37 @@
+# Routes the media page and monitoring poll or stream from: /current_media, /events (Server-Sent Events)
+# and /metrics (Prometheus text)
+# Used by program/web.py (registered as a blueprint)
+# Depends on program/library.py (hole state, event bus, metrics) and program/metrics.py (render)
+# /metrics is switched off with [metrics] enabled = false in config.cfg
+
+import json
+from flask import Blueprint, redirect, url_for, session, Response
+from settings import config
+from metrics import render as render_metrics
+import library
+from library import media_index, event_bus, metrics, current_media_info
+
+blueprint = Blueprint('events', __name__)
+
+@blueprint.route('/metrics')
+def metrics_page():
+    # Prometheus text format; open like /media_file so a scraper needs no session
+    if not config.getboolean('metrics', 'enabled', fallback=True):
+        return '', 404
+    metrics.set('events_clients', event_bus.client_count)
+    metrics.set('library_items', len(media_index))
+    return Response(render_metrics(metrics.snapshot(), library.display_metrics), mimetype='text/plain; version=0.0.4')
+
+@blueprint.route('/current_media')
+def current_media_route():
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    return json.dumps(current_media_info())
+
+@blueprint.route('/events')
+def events_stream():
+    # Server-Sent Events: a snapshot on connect (and reconnect), then one event per hole swap
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    return Response(event_bus.stream(current_media_info), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -0,0 +1,69 @@
+# Server-Sent Events bus: pushes hole swaps and library changes to connected media pages
+# Used by program/library.py and program/event_routes.py (/events route; hole swaps reported by program/display.py, library and rotation changes)
+
+import json
+import queue
+import threading
+
+RESYNC = object()  # queued for a client that fell behind; it gets a fresh snapshot instead
+
+
+def format_sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+class Subscription:
+    def __init__(self, max_queue):
+        self.queue = queue.Queue(maxsize=max_queue)
+
+    def offer(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            # Too slow to keep up: drop what is queued and resend the whole state
+            with self.queue.mutex:
+                self.queue.queue.clear()
+            self.queue.put_nowait(RESYNC)
+
+
+class EventBus:
+    def __init__(self, max_queue=100, keepalive_seconds=15):
+        self.max_queue = max_queue
+        self.keepalive_seconds = keepalive_seconds
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    @property
+    def client_count(self):
+        return len(self._subscribers)
+
+    def publish(self, event, data):
+        if not self._subscribers:
+            return  # nobody listening, nothing to format
+        message = format_sse(event, data)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            sub.offer(message)
+
+    def stream(self, snapshot):
+        # Generator for one client: a snapshot first, then events as they happen.
+        # The keepalive comment also lets the server notice disconnected clients.
+        sub = Subscription(self.max_queue)
+        with self._lock:
+            self._subscribers.add(sub)
+        try:
+            yield format_sse('snapshot', snapshot())
+            while True:
+                try:
+                    message = sub.queue.get(timeout=self.keepalive_seconds)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if message is RESYNC:
+                    yield format_sse('snapshot', snapshot())
+                else:
+                    yield message
+        finally:
+            with self._lock:
+                self._subscribers.discard(sub)
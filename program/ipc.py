@@ -0,0 +1,141 @@
+# Newline-delimited JSON messages over a Unix domain socket, used when the display and the web server
+# run as separate processes (program/app.py --role display / --role web, see run.sh)
+# The display process listens (IpcServer); the web process connects and reconnects (IpcClient)
+# Messages are small dicts: hole swaps from the display, library/layout/mode changes from the web server
+# Socket path comes from [ipc] socket_path in config.cfg
+
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+SEND_TIMEOUT = struct.pack('ll', 1, 0)  # a stuck peer must not block the render loop for more than a second
+
+
+class Channel:
+    # One connected socket; send() may be called from any thread, messages are handed to on_message
+    # on the reader thread
+
+    def __init__(self, sock, on_message, on_close=None):
+        self.sock = sock
+        self.on_message = on_message
+        self.on_close = on_close
+        self.closed = False
+        self._lock = threading.Lock()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, SEND_TIMEOUT)
+
+    def start(self):
+        threading.Thread(target=self.read, name='ipc', daemon=True).start()
+
+    def send(self, message):
+        data = (json.dumps(message) + '\n').encode()
+        try:
+            with self._lock:
+                self.sock.sendall(data)
+        except OSError as e:
+            print(f"IPC error: {e}")
+            self.close()
+            return False
+        return True
+
+    def read(self):
+        try:
+            with self.sock.makefile('rb') as f:
+                for line in f:
+                    try:
+                        message = json.loads(line)
+                    except ValueError:
+                        continue
+                    try:
+                        self.on_message(message)
+                    except Exception as e:
+                        print(f"IPC error: {e}")
+        except OSError:
+            pass
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        if self.on_close:
+            self.on_close(self)
+
+
+class IpcServer:
+    # Display side: accepts web server connections and broadcasts to all of them
+
+    def __init__(self, path, on_message, on_connect=None):
+        self.path = path
+        self.on_message = on_message
+        self.on_connect = on_connect  # e.g. send the current hole assignments
+        self._channels = set()
+        self._sock = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left over from a previous run
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self._sock.listen(4)
+        threading.Thread(target=self._accept, name='ipc-accept', daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            channel = Channel(conn, self.on_message, on_close=self._channels.discard)
+            self._channels.add(channel)
+            channel.start()
+            if self.on_connect:
+                self.on_connect(channel)
+
+    def send(self, message):
+        for channel in list(self._channels):
+            channel.send(message)
+
+
+class IpcClient:
+    # Web side: keeps (re)connecting to the display process
+
+    def __init__(self, path, on_message, on_connect=None, retry_seconds=1.0):
+        self.path = path
+        self.on_message = on_message
+        self.on_connect = on_connect  # e.g. ask a (re)started display to reload the library
+        self.retry_seconds = retry_seconds
+        self._channel = None
+
+    def start(self):
+        threading.Thread(target=self._run, name='ipc-client', daemon=True).start()
+
+    def _run(self):
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                time.sleep(self.retry_seconds)
+                continue
+            self._channel = Channel(sock, self.on_message)
+            if self.on_connect:
+                self.on_connect(self._channel)
+            self._channel.read()
+            self._channel = None
+            time.sleep(self.retry_seconds)
+
+    def send(self, message):
+        # Dropped while the display is not running; it reads the database and config.cfg when it starts
+        channel = self._channel
+        if channel is None:
+            return False
+        return channel.send(message)
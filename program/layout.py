@@ -0,0 +1,217 @@
+# Screen layout read from config.cfg as an immutable snapshot: screen and frame size, scale, calibration
+# offset, video flags and the holes (read-only mappings)
+# LayoutService watches config.cfg and swaps in a new snapshot when the file changes, so the display and
+# the web server pick up a layout from program/config_creator.py (or a hand edit) without a restart
+# Used by program/settings.py (layout_service, save_config), program/display.py and program/web.py;
+# both read layout_service.current and subscribe to changes
+# Calibration nudges change the offset in memory at once; writing them to config.cfg waits until the
+# nudges stop for save_delay seconds, so a run of 1px clicks costs one write to the SD card
+# Settings come from the [reload] section of config.cfg
+
+import atexit
+import configparser
+import os
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+Layout = namedtuple('Layout', 'screen_size frame_size scale offset holes video')
+
+# Sections a complete config.cfg has; a file missing one is being written and is read again on the next poll
+REQUIRED_SECTIONS = ('frame', 'display', 'holes')
+
+
+def read_holes(config, scale, offset):
+    # Fit mode per hole from [fit], defaulting to [display] fit, and seconds between changes
+    # from [interval], defaulting to [schedule] interval_seconds
+    scale_x, scale_y = scale
+    offset_x, offset_y = offset
+    default_fit = config['display'].get('fit', 'contain')
+    default_interval = config.getfloat('schedule', 'interval_seconds', fallback=50.0)
+    holes = []
+    for key, value in config['holes'].items():
+        typ, x, y, w, h = value.split(',')
+        holes.append(MappingProxyType({
+            'id': int(key),
+            'type': typ.strip(),
+            'fit': config.get('fit', key, fallback=default_fit),
+            'interval': config.getfloat('interval', key, fallback=default_interval),
+            'x_mm': float(x),
+            'y_mm': float(y),
+            'w_mm': float(w),
+            'h_mm': float(h),
+            'x_px': float(x) * scale_x + offset_x,
+            'y_px': float(y) * scale_y + offset_y,
+            'w_px': float(w) * scale_x,
+            'h_px': float(h) * scale_y
+        }))
+    return tuple(holes)
+
+
+def read_layout(config):
+    frame_size = (int(config['frame']['width_mm']), int(config['frame']['height_mm']))
+    screen_size = (int(config['display']['screen_width_px']), int(config['display']['screen_height_px']))
+    scale = (screen_size[0] / frame_size[0], screen_size[1] / frame_size[1])
+    offset = (int(config['display'].get('offset_x', 0)), int(config['display'].get('offset_y', 0)))
+    video = MappingProxyType({
+        'loop': config.getboolean('video', 'loop', fallback=True),
+        'mute': config.getboolean('video', 'mute', fallback=False),
+        'fps': config.getint('video', 'fps', fallback=25),
+    })
+    return Layout(screen_size, frame_size, scale, offset, read_holes(config, scale, offset), video)
+
+
+def with_offset(layout, offset_x, offset_y):
+    # Calibration nudge: same holes, moved
+    if (offset_x, offset_y) == layout.offset:
+        return layout
+    dx, dy = offset_x - layout.offset[0], offset_y - layout.offset[1]
+    holes = tuple(MappingProxyType(dict(hole, x_px=hole['x_px'] + dx, y_px=hole['y_px'] + dy)) for hole in layout.holes)
+    return layout._replace(offset=(offset_x, offset_y), holes=holes)
+
+
+def hole_size(hole):
+    return int(hole['w_px']), int(hole['h_px'])
+
+
+def reshaped_holes(old, new):
+    # Ids of holes whose decoded surfaces no longer fit: added, removed, resized, or a new shape or fit mode.
+    # A hole that only moved (calibration offset, position in config.cfg) keeps its cached surfaces.
+    before = {hole['id']: (hole_size(hole), hole['type'], hole['fit']) for hole in old.holes}
+    after = {hole['id']: (hole_size(hole), hole['type'], hole['fit']) for hole in new.holes}
+    return {hole_id for hole_id in before.keys() | after.keys() if before.get(hole_id) != after.get(hole_id)}
+
+
+def _signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class LayoutService:
+    def __init__(self, config, path, poll_seconds=2.0, save_delay=2.0):
+        self.config = config  # the shared ConfigParser of program/settings.py, kept in step with the file
+        self.path = path
+        self.poll_seconds = poll_seconds
+        self.save_delay = save_delay
+        self.current = read_layout(config)  # replaced, never modified; read it once per frame or request
+        self._listeners = []
+        self._signature = _signature(path)
+        self._rejected = None  # signature of a file that could not be read, reported once
+        self._lock = threading.RLock()
+        self._thread = None
+        self._save_timer = None  # pending coalesced write, see save_soon
+        atexit.register(self.flush)
+
+    def subscribe(self, listener):
+        # listener(old, new) runs on the thread that made the change (poll thread, Flask or IPC thread)
+        self._listeners.append(listener)
+
+    def start(self):
+        if self._thread is None and self.poll_seconds > 0:
+            self._thread = threading.Thread(target=self._run, name='config', daemon=True)
+            self._thread.start()
+
+    def save(self):
+        # Written to a temp name and renamed, so the other process never reads half a file
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()  # this write includes whatever it was waiting to save
+                self._save_timer = None
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                self.config.write(f)
+            os.replace(tmp, self.path)
+            self._signature = _signature(self.path)  # our own write is not a change to reload
+
+    def save_soon(self):
+        # Coalesced save: every call pushes the write back, so it happens save_delay after the last change
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+            timer = threading.Timer(self.save_delay, lambda: self._save_due(timer))
+            timer.daemon = True
+            self._save_timer = timer
+            timer.start()
+
+    def _save_due(self, timer):
+        with self._lock:
+            if self._save_timer is timer:  # not superseded by a newer save_soon or an immediate save
+                self.save()
+
+    def flush(self):
+        # Write a pending coalesced save now (e.g. at exit or before committing the calibration)
+        with self._lock:
+            if self._save_timer is not None:
+                self.save()
+
+    def set_offset(self, offset_x, offset_y, save=True):
+        # Moves the holes in a new snapshot straight away; save=True writes config.cfg a little later
+        with self._lock:
+            self.config.set('display', 'offset_x', str(offset_x))
+            self.config.set('display', 'offset_y', str(offset_y))
+            if save:
+                self.save_soon()
+            self._swap(with_offset(self.current, offset_x, offset_y))
+            return self.current.offset
+
+    def nudge_offset(self, dx, dy):
+        # Relative move for the calibration page; two clicks handled at once both count
+        with self._lock:
+            offset_x, offset_y = self.current.offset
+            return self.set_offset(offset_x + dx, offset_y + dy)
+
+    def reload(self):
+        # Re-read config.cfg if it changed on disk; returns True when a new layout was swapped in
+        signature = _signature(self.path)
+        if signature is None or signature in (self._signature, self._rejected):
+            return False
+        fresh = configparser.ConfigParser()
+        try:
+            fresh.read(self.path)
+            missing = [section for section in REQUIRED_SECTIONS if not fresh.has_section(section)]
+            if missing:
+                raise ValueError(f"missing [{'], ['.join(missing)}]")
+            layout = read_layout(fresh)
+        except (configparser.Error, ValueError, KeyError) as e:
+            # Probably caught mid-write; read again once the file changes
+            self._rejected = signature
+            print(f"Config reload error: {e}")
+            return False
+        if _signature(self.path) != signature:
+            return False  # changed again while being read
+        with self._lock:
+            self._signature = signature
+            self._replace_config(fresh)
+            return self._swap(layout)
+
+    def _replace_config(self, fresh):
+        # Update the shared parser in place so modules holding a reference to it see the new values
+        for section in self.config.sections():
+            if not fresh.has_section(section):
+                self.config.remove_section(section)
+            else:
+                for option in list(self.config[section]):
+                    if not fresh.has_option(section, option):
+                        self.config.remove_option(section, option)
+        self.config.read_dict({section: dict(fresh.items(section, raw=True)) for section in fresh.sections()})
+
+    def _swap(self, layout):
+        old = self.current
+        if layout == old:
+            return False
+        self.current = layout
+        for listener in self._listeners:
+            try:
+                listener(old, layout)
+            except Exception as e:
+                print(f"Layout change error: {e}")
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            self.reload()
@@ -0,0 +1,218 @@
+# The web server's side of the media library: the media index it writes, renditions, the uploads_dir
+# watcher and how changes reach the display, the media pages and other frames
+# Used by program/web.py (pages), program/media_routes.py, program/upload_routes.py, program/event_routes.py,
+# program/cluster_routes.py and program/app.py (send, handle_message, watcher, startup_scan)
+# Depends on config.cfg through program/settings.py and the layout snapshot of program/layout.py
+# Depends on program/renditions.py for per-hole renditions and web thumbnails
+# Depends on program/media_index.py for the incremental media library index (this process writes it)
+# Depends on program/watcher.py for files added to uploads_dir outside the web form
+# Depends on program/events.py for pushing hole and library changes to the media page (SSE)
+# Depends on program/metrics.py for request timings (the display sends its own figures)
+# Depends on program/cluster.py for the library listing other frames sync from ([cluster] token)
+# Library, layout and mode changes go to program/display.py through send; hole swaps come back
+# in handle_message (a direct call in one process, program/ipc.py otherwise)
+
+import os
+import threading
+from datetime import datetime
+from werkzeug.utils import secure_filename
+from settings import config, layout_service, rendition_targets, uploads_dir, renditions_dir, renditions_options, db, \
+    init_db, cluster_token
+from layout import reshaped_holes
+from video import is_video
+from renditions import RenditionPipeline
+from media_index import MediaIndex
+from watcher import create_watcher
+from events import EventBus
+from metrics import Metrics
+from cluster import ClusterHub
+
+# Media file shown in each hole, as last reported by the display
+current_media = {hole['id']: None for hole in layout_service.current.holes}
+
+init_db()
+
+# Library index kept in the media table; updated per upload/delete instead of rescanning
+media_index = MediaIndex(db, uploads_dir)
+
+# Derivatives built after upload: one rendition per hole size and fit mode plus a web thumbnail
+renditions = RenditionPipeline(db, renditions_dir, rendition_targets(layout_service.current.holes), **renditions_options)
+renditions.load_index()
+
+# Pushes hole swaps and library changes to open media pages instead of having them poll
+event_bus = EventBus(max_queue=config.getint('events', 'max_queue', fallback=100),
+                     keepalive_seconds=config.getint('events', 'keepalive_seconds', fallback=15))
+
+# Other frames in the house showing this library; their own bus, they only need to hear that it changed
+cluster_hub = ClusterHub(media_index, renditions, uploads_dir, cluster_token,
+                         EventBus(max_queue=config.getint('events', 'max_queue', fallback=100),
+                                  keepalive_seconds=config.getint('events', 'keepalive_seconds', fallback=15)))
+
+# Request timings per route (recorded by program/web.py), served on /metrics by program/event_routes.py
+# with the latest figures pushed by the display
+metrics = Metrics()
+metrics.histogram('http_request_seconds', 'Time to produce a response (streams are timed until their first byte)')
+metrics.counter('http_requests_total', 'Responses by route and status')
+metrics.gauge('events_clients', 'Media pages connected for Server-Sent Events')
+metrics.gauge('library_items', 'Items in the media table')
+display_metrics = None
+
+# Set by program/app.py: delivers messages to the display
+send = None
+
+def notify(message):
+    if send is not None:
+        send(message)
+
+renditions.on_built = lambda filepath: notify({'type': 'renditions', 'path': filepath})
+
+def media_changed(changed=(), removed=()):
+    # Tell the display and the media pages about an incremental add/remove/edit
+    notify({'type': 'media', 'changed': list(changed), 'removed': list(removed)})
+    event_bus.publish('library', {'count': len(media_index)})
+    cluster_hub.changed()
+
+def fill_hashes():
+    # Content hashes for files that reached the table without one, in the background; files that turn out
+    # to be copies of another item leave the library. A new hash is a new version (URLs, cluster listing)
+    def run():
+        hashed, moved = media_index.fill_hashes()
+        for filepath, media_id in moved.items():
+            renditions.discard(filepath, media_id)
+        if moved:
+            media_changed(removed=moved)
+        elif hashed:
+            cluster_hub.changed()
+    threading.Thread(target=run, name='hashes', daemon=True).start()
+
+def ingest_batch(changed, removed):
+    # Debounced batch from the uploads_dir watcher (runs on the watcher thread)
+    updated, removed_ids = media_index.ingest(changed, removed)
+    for filepath, media_id in removed_ids.items():
+        renditions.discard(filepath, media_id)
+    for filepath in updated:
+        renditions.submit(filepath)
+    if updated or removed_ids:
+        media_changed(updated, removed_ids)
+    if updated:
+        fill_hashes()
+
+def reconcile_media():
+    # Full catch-up, used when the watcher lost events
+    media_index.reconcile()
+    media_index.load()
+    renditions.backfill(media_index.iter_paths(), media_index.transform_for)
+    notify({'type': 'reload'})
+    event_bus.publish('library', {'count': len(media_index)})
+    cluster_hub.changed()
+
+watcher = create_watcher(
+    uploads_dir, ingest_batch,
+    backend=config.get('watcher', 'backend', fallback='auto'),
+    debounce_seconds=config.getfloat('watcher', 'debounce_seconds', fallback=2.0),
+    max_delay_seconds=config.getfloat('watcher', 'max_delay_seconds', fallback=30.0),
+    poll_seconds=config.getfloat('watcher', 'poll_seconds', fallback=10.0),
+    on_overflow=reconcile_media) if config.getboolean('watcher', 'enabled', fallback=True) else None
+
+# Pages are served from the media table as the last run left it; startup_scan catches up in the background
+media_index.load()
+
+def startup_scan():
+    # Run in the background by program/app.py: the reconcile only inserts files the table hasn't seen
+    # and drops rows for files that are gone, then the display reloads
+    reconcile_media()
+    fill_hashes()
+
+def layout_changed(old, new):
+    # config.cfg changed or the offset was nudged: renditions for new hole sizes, and open pages follow
+    if renditions.set_targets(rendition_targets(new.holes)):
+        renditions.backfill(media_index.iter_paths(), media_index.transform_for)
+    if reshaped_holes(old, new) or old.screen_size != new.screen_size:
+        event_bus.publish('layout', {'holes': len(new.holes)})  # pages reload
+    elif old.offset != new.offset:
+        event_bus.publish('offset', {'offset': list(new.offset)})  # pages move the holes themselves
+    if old.offset != new.offset:
+        # Sent while the layout service still holds its lock, so the display gets nudges in order
+        notify({'type': 'layout', 'offset': list(new.offset)})
+
+layout_service.subscribe(layout_changed)
+
+def handle_message(message):
+    # From program/display.py (display thread in one process, IPC reader thread otherwise)
+    global current_media
+    kind = message.get('type')
+    if kind == 'hole':
+        current_media[message['hole']] = message['path']
+        event_bus.publish('hole', {'hole': message['hole'], 'media': media_info(message['path'])})
+    elif kind == 'holes':
+        # Every hole, also after a layout change; JSON turns the hole ids into strings
+        current_media = {int(hole_id): path for hole_id, path in message['holes'].items()}
+        event_bus.publish('snapshot', current_media_info())
+    elif kind == 'metrics':
+        global display_metrics
+        display_metrics = message['metrics']
+
+def media_info(filepath):
+    # How the web page addresses one library item: stable id plus versioned, cacheable URLs
+    media_id = media_index.id_for(filepath) if filepath else None
+    if media_id is None:
+        return None
+    version = media_index.version(filepath)
+    src = f'/media_file/{media_id}/{version}'
+    video = is_video(filepath)
+    rotation, crop, fit, focal = media_index.transform_for(filepath)
+    return {'id': media_id, 'video': video, 'src': src,
+            'thumb': src if video else f'/media_thumb/{media_id}/{version}',
+            'fit': fit, 'focal': focal, 'favourite': media_index.is_favourite(filepath)}
+
+def current_media_info():
+    return {hole_id: media_info(path) for hole_id, path in current_media.items()}
+
+def item_changed(filepath):
+    # Metadata of one item changed: the display re-reads its row, open pages showing it are updated
+    notify({'type': 'media', 'changed': [filepath]})
+    cluster_hub.changed()
+    for hole_id, path in list(current_media.items()):
+        if path == filepath:
+            event_bus.publish('hole', {'hole': hole_id, 'media': media_info(filepath)})
+
+def transform_changed(filepath):
+    # Rotation/crop metadata changed: rebuild renditions and redraw, the original is untouched.
+    # The content version changed, so holes showing the file get new URLs
+    renditions.submit(filepath)
+    item_changed(filepath)
+
+def upload_path(user, filename):
+    # Create directory structure: uploads_dir/user/year/month/day/timestamp_filename
+    filename = secure_filename(filename)
+    now = datetime.now()
+    path = os.path.join(uploads_dir, user, str(now.year), f"{now.month:02d}", f"{now.day:02d}")
+    os.makedirs(path, exist_ok=True)
+    timestamp = int(now.timestamp() * 1000)  # milliseconds
+    fileid = f"{timestamp}_{filename}"
+    return os.path.join(path, fileid)
+
+def add_upload(user, filename, sha256, store):
+    # One finished upload. Content already in the library (uploaded by anyone) is not stored again:
+    # the existing item, its renditions and thumbnail are used. Otherwise store(filepath) puts the file
+    # into the uploads layout and it is indexed. Returns (media id, duplicate); the media id is None if the
+    # database failed. Raises ValueError if store returned False (nothing was stored)
+    existing = media_index.find_hash(sha256)
+    if existing is None:
+        filepath = upload_path(user, filename)
+        if store(filepath) is False:
+            raise ValueError('store')
+        media_id = media_index.add(filepath, user=user, sha256=sha256)
+        if media_id is not None:
+            renditions.submit(filepath)
+            media_changed([filepath])
+            return media_id, False
+        existing = media_index.find_hash(sha256)
+        if existing is None:
+            return None, False  # database error; the file stays for the watcher or the next startup scan
+        # The same content was added in the meantime, e.g. by a concurrent upload
+        try:
+            os.remove(filepath)
+        except FileNotFoundError:
+            pass
+    return existing[0], True
@@ -0,0 +1,492 @@
+# Incremental media index: the media table is the source of truth for the library
+# Used by program/library.py (uploads, startup reconcile, watcher batches) and program/media_routes.py (the id-based
+# HTTP API: files, delete, rotate)
+# Used by program/display.py read-only: it refreshes changed rows when the web server reports them; program/scheduler.py
+# deals its decks from the id order
+# Depends on the media table created by init_db in program/settings.py (mtime, size and user are indexed,
+# sha256 is unique so each piece of content is in the library once), reached through program/database.py
+# Files whose content is already in the library, whichever way they arrived, are kept in the duplicates table
+# instead; when the indexed copy goes away one of them takes its place, and deleting the item deletes them all
+# Kept compact for very large libraries: the order is an array of media ids, mtime, size and uploader live in
+# arrays indexed by id, and each path string is held once (program/path_store.py); see memory_bytes
+
+import bisect
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+
+from path_store import PathStore
+
+READ_SIZE = 1024 * 1024
+
+
+def hash_key(sha256):
+    # The first 64 bits of a hex SHA-256 as an integer for the compact index; 0 for no hash
+    return int(sha256[:16], 16) if sha256 else 0
+
+
+def file_sha256(filepath):
+    # Content hash of a file, read in blocks
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class MediaIndex:
+    # Keeps the newest-first list of file paths in step with the media table without rescanning
+
+    def __init__(self, db, uploads_dir):
+        self.db = db
+        self.uploads_dir = uploads_dir
+        self._order = array('q')  # media ids, newest first; changed in place, readers take a copy (ids)
+        self._keys = array('d')  # -mtime for each entry in _order, ascending, for bisect
+        self._mtimes = array('d')  # indexed by media id
+        self._sizes = array('q')  # indexed by media id
+        self._hashes = array('Q')  # first 64 bits of each row's sha256 (0 while unhashed), indexed by media id
+        self._users = array('H')  # uploader of each row as a position in _user_names (0 = none), indexed by media id
+        self._user_names = [None]
+        self._user_numbers = {None: 0}  # uploader -> position in _user_names
+        self._paths = PathStore()
+        self._transforms = {}  # filepath -> (rotation, crop, fit, focal) when not the default (0, None, None, None)
+        self._favourites = set()  # media ids marked as favourites
+        self._lock = threading.Lock()
+        self._hash_lock = threading.Lock()
+        self._unhashed = set()  # media ids fill_hashes could not hash
+
+    def path_user(self, filepath):
+        # uploads/<user>/<year>/... -> <user>; None for files outside that layout
+        parts = os.path.relpath(filepath, self.uploads_dir).split(os.sep)
+        return parts[0] if len(parts) > 1 and parts[0] != '..' else None
+
+    def user_for(self, filepath):
+        # Uploader from the row's user column
+        return self.user_of(self.id_for(filepath))
+
+    def user_of(self, media_id):
+        return self._user_names[self._users[media_id]] if self.path_for(media_id) is not None else None
+
+    def __len__(self):
+        return len(self._order)
+
+    def ids(self):
+        # Newest first, as a copy of the compact order array
+        with self._lock:
+            return self._order[:]
+
+    def iter_paths(self):
+        # Newest first, looked up one at a time; items removed while iterating are skipped
+        for media_id in self.ids():
+            filepath = self.path_for(media_id)
+            if filepath is not None:
+                yield filepath
+
+    def memory_bytes(self):
+        # Approximate memory held by the index, for the memory governor (program/memory.py)
+        return (sum(a.itemsize * len(a) for a in (self._order, self._keys, self._mtimes, self._sizes, self._hashes,
+                                                  self._users))
+                + self._paths.memory_bytes())
+
+    def id_for(self, filepath):
+        with self._lock:
+            return self._paths.id_for(filepath)
+
+    def path_for(self, media_id):
+        return self._paths.path_for(media_id)
+
+    def mtime_for(self, filepath):
+        return self.mtime_of(self.id_for(filepath))
+
+    def mtime_of(self, media_id):
+        return self._mtimes[media_id] if self.path_for(media_id) is not None else None
+
+    def is_favourite(self, filepath):
+        return self.id_for(filepath) in self._favourites
+
+    def favourite_of(self, media_id):
+        return media_id in self._favourites
+
+    def set_favourite(self, filepath, favourite=True):
+        try:
+            self.db.execute('UPDATE media SET favourite = ? WHERE filepath = ?', (1 if favourite else 0, filepath))
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        with self._lock:
+            media_id = self._paths.id_for(filepath)
+            if media_id is None:
+                return
+            if favourite:
+                self._favourites.add(media_id)
+            else:
+                self._favourites.discard(media_id)
+
+    def transform_for(self, filepath):
+        # Rotation (degrees clockwise), crop (x, y, w, h fractions), fit mode override (None = the hole's)
+        # and focal point (x, y fractions) applied at render time
+        return self._transforms.get(filepath, (0, None, None, None))
+
+    def set_transform(self, filepath, rotation=None, crop=False, fit=False, focal=False):
+        # Metadata-only edit; crop/fit/focal=None clear the value, False leaves it alone
+        old_rotation, old_crop, old_fit, old_focal = self.transform_for(filepath)
+        rotation = old_rotation if rotation is None else rotation % 360
+        crop = old_crop if crop is False else (tuple(crop) if crop else None)
+        fit = old_fit if fit is False else fit
+        focal = old_focal if focal is False else (tuple(focal) if focal else None)
+        try:
+            self.db.execute('UPDATE media SET rotation = ?, crop_x = ?, crop_y = ?, crop_w = ?, crop_h = ?, '
+                            'fit = ?, focal_x = ?, focal_y = ? WHERE filepath = ?',
+                            (rotation,) + (crop or (None, None, None, None)) + (fit,) + (focal or (None, None)) + (filepath,))
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        with self._lock:
+            if rotation or crop or fit or focal:
+                self._transforms[filepath] = (rotation, crop, fit, focal)
+            else:
+                self._transforms.pop(filepath, None)
+
+    def version(self, filepath):
+        # Changes whenever the file's contents or its rotation/crop change; used in immutable URLs and as the ETag.
+        # The content hash where the row has one, so a touched but unchanged file keeps its URLs; rows not
+        # hashed yet fall back to id, mtime and size
+        media_id = self.id_for(filepath)
+        if media_id is None:
+            return None
+        transform = self.transform_for(filepath)
+        content = f'{self._hashes[media_id]:016x}' if self._hashes[media_id] else \
+            f'{media_id}:{self._mtimes[media_id]}:{self._sizes[media_id]}'
+        return hashlib.sha1(f'{content}:{transform}'.encode()).hexdigest()[:16]
+
+    def load(self):
+        # Library order straight from the mtime index
+        rows = self.db.query('SELECT filepath, id, mtime, size, rotation, crop_x, crop_y, crop_w, crop_h, fit, focal_x, focal_y, '
+                             'favourite, sha256, user FROM media ORDER BY mtime DESC')
+        with self._lock:
+            self._order = array('q', (row[1] for row in rows))
+            self._keys = array('d', (-(row[2] or 0) for row in rows))
+            top = max(self._order, default=0) + 1
+            self._mtimes, self._sizes = array('d', bytes(8 * top)), array('q', bytes(8 * top))
+            self._hashes = array('Q', bytes(8 * top))
+            self._users = array('H', bytes(2 * top))
+            for row in rows:
+                self._mtimes[row[1]], self._sizes[row[1]] = row[2] or 0, row[3] or 0
+                self._hashes[row[1]] = hash_key(row[13])
+                self._users[row[1]] = self._user_number(row[14])
+            self._paths = PathStore(row[:2] for row in rows)
+            self._transforms = {}
+            self._favourites = {row[1] for row in rows if row[12]}
+            for row in rows:
+                crop = tuple(row[5:9]) if None not in row[5:9] else None
+                focal = tuple(row[10:12]) if None not in row[10:12] else None
+                if row[4] or crop or row[9] or focal:
+                    self._transforms[row[0]] = (row[4] or 0, crop, row[9], focal)
+
+    def reconcile(self):
+        # Startup check against the uploads tree: only unseen files are stat'ed and inserted,
+        # rows for vanished files are removed, all in a single transaction
+        known = {row[0]: row[1:] for row in self.db.query('SELECT filepath, mtime, sha256 FROM media')}
+        duplicates = dict(self.db.query('SELECT filepath, mtime FROM duplicates'))
+        on_disk = set()
+        new_rows = []
+        stale_rows = []
+        for root, dirs, files in os.walk(self.uploads_dir):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]  # e.g. .incoming upload parts
+            for file in files:
+                if file.startswith('.'):
+                    continue
+                filepath = os.path.join(root, file)
+                on_disk.add(filepath)
+                if filepath in known and known[filepath][0] is not None:
+                    continue
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue
+                if duplicates.get(filepath) == st.st_mtime:
+                    continue  # unchanged copy of an indexed file
+                if filepath in known:
+                    stale_rows.append((st.st_mtime, st.st_size, filepath))  # row from before mtime was indexed
+                else:
+                    new_rows.append((filepath, self.path_user(filepath), None, None, None, None, None, 'all', st.st_mtime, st.st_size))
+        removed = [(filepath,) for filepath in known if filepath not in on_disk]
+        try:
+            self.db.execute_many([
+                ('INSERT OR IGNORE INTO media (filepath, user, rotation, crop_x, crop_y, crop_w, crop_h, frames, mtime, size) '
+                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', new_rows),
+                ('UPDATE media SET mtime = ?, size = ? WHERE filepath = ?', stale_rows),
+                ('DELETE FROM media WHERE filepath = ?', removed),
+                # Copies that vanished or changed; changed ones were just inserted and fill_hashes checks them again
+                ('DELETE FROM duplicates WHERE filepath = ?',
+                 [(filepath,) for filepath in duplicates if filepath not in on_disk] + [row[:1] for row in new_rows]),
+            ])
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return len(new_rows), len(removed)
+        self._promote([known[filepath][1] for (filepath,) in removed])
+        return len(new_rows), len(removed)
+
+    def find_hash(self, sha256):
+        # (media id, filepath) of the library item with this content, or None
+        try:
+            return self.db.query_one('SELECT id, filepath FROM media WHERE sha256 = ?', (sha256,))
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return None
+
+    def add(self, filepath, user=None, sha256=None):
+        # Register one new or replaced file and slot it into the newest-first list; returns its media id,
+        # or None if the table already has the same content under another path
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+        try:
+            with self.db.transaction() as conn:
+                conn.execute('INSERT OR IGNORE INTO media (filepath, user, frames, mtime, size, sha256) VALUES (?, ?, ?, ?, ?, ?)',
+                             (filepath, user, 'all', st.st_mtime, st.st_size, sha256))
+                conn.execute('UPDATE media SET mtime = ?, size = ?, sha256 = COALESCE(?, sha256) WHERE filepath = ?',
+                             (st.st_mtime, st.st_size, sha256, filepath))
+            row = self.db.query_one('SELECT id, sha256, user FROM media WHERE filepath = ?', (filepath,))
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return None
+        if not row:
+            return None
+        with self._lock:
+            self._apply([filepath], {filepath: (row[0], st.st_mtime, st.st_size, row[1], row[2])})
+        return row[0]
+
+    def fill_hashes(self):
+        # Hash rows indexed without one (from before hashes were kept, found by the startup reconcile or
+        # changed in place) so later copies of the same content are recognised. Runs in the background;
+        # a row whose content is already in the table under another path becomes a duplicate.
+        # Returns (paths that got a hash, and so a new version; {filepath: media id} of the rows taken out
+        # of the library as duplicates)
+        if not self._hash_lock.acquire(blocking=False):
+            return [], {}
+        hashed, moved = [], {}
+        try:
+            while True:
+                rows = [row for row in self.db.query('SELECT id, filepath FROM media WHERE sha256 IS NULL')
+                        if row[0] not in self._unhashed]
+                if not rows:
+                    break
+                for media_id, filepath in rows:
+                    try:
+                        sha256 = file_sha256(filepath)
+                        mtime = os.path.getmtime(filepath)
+                    except OSError:
+                        self._unhashed.add(media_id)
+                        continue
+                    try:
+                        self.db.execute('UPDATE media SET sha256 = ? WHERE id = ?', (sha256, media_id))
+                        with self._lock:
+                            if self.path_for(media_id) == filepath:
+                                self._hashes[media_id] = hash_key(sha256)
+                        hashed.append(filepath)
+                    except sqlite3.IntegrityError:
+                        with self.db.transaction() as conn:
+                            conn.execute('DELETE FROM media WHERE id = ?', (media_id,))
+                            conn.execute('INSERT OR REPLACE INTO duplicates (filepath, sha256, mtime) VALUES (?, ?, ?)',
+                                         (filepath, sha256, mtime))
+                        with self._lock:
+                            self._apply([filepath], {})
+                        moved[filepath] = media_id
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+        finally:
+            self._hash_lock.release()
+        return hashed, moved
+
+    def drop_duplicates(self, filepath):
+        # Forget the other copies of this file's content, for a delete; returns their paths so the caller
+        # can remove the files
+        try:
+            with self.db.transaction() as conn:
+                rows = conn.execute('SELECT filepath FROM duplicates WHERE sha256 = '
+                                    '(SELECT sha256 FROM media WHERE filepath = ?)', (filepath,)).fetchall()
+                conn.execute('DELETE FROM duplicates WHERE sha256 = (SELECT sha256 FROM media WHERE filepath = ?)',
+                             (filepath,))
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return []
+        return [row[0] for row in rows]
+
+    def remove(self, filepath):
+        # Drop one file from the table and the list; returns its media id (or None)
+        try:
+            with self.db.transaction() as conn:
+                row = conn.execute('SELECT id FROM media WHERE filepath = ?', (filepath,)).fetchone()
+                conn.execute('DELETE FROM media WHERE filepath = ?', (filepath,))
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            row = None
+        with self._lock:
+            self._apply([filepath], {})
+        return row[0] if row else None
+
+    def refresh(self, filepaths):
+        # Re-read these rows after another process changed them; rows that are gone are dropped
+        try:
+            rows = self.db.query_in('SELECT filepath, id, mtime, size, rotation, crop_x, crop_y, crop_w, crop_h, fit, focal_x, focal_y, '
+                                    'favourite, sha256, user FROM media WHERE filepath IN ({})', filepaths)
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        with self._lock:
+            self._apply(filepaths, {row[0]: (row[1], row[2] or 0, row[3], row[13], row[14]) for row in rows})
+            for row in rows:
+                crop = tuple(row[5:9]) if None not in row[5:9] else None
+                focal = tuple(row[10:12]) if None not in row[10:12] else None
+                if row[4] or crop or row[9] or focal:
+                    self._transforms[row[0]] = (row[4] or 0, crop, row[9], focal)
+                else:
+                    self._transforms.pop(row[0], None)
+                if row[12]:
+                    self._favourites.add(row[1])
+                else:
+                    self._favourites.discard(row[1])
+
+    def ingest(self, changed, removed):
+        # Apply one batch of filesystem events in a single transaction.
+        # removed entries may be directories and drop everything below them.
+        # Returns (paths that are new or changed, {removed path: media id})
+        removed_paths = set()
+        with self._lock:
+            for path in removed:
+                prefix = path + os.sep
+                removed_paths.update(p for p in self._paths if p == path or p.startswith(prefix))
+        stats = {}
+        for filepath in changed:
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                continue  # gone again before the batch was flushed
+            stats[filepath] = st
+            removed_paths.discard(filepath)
+
+        try:
+            known = self._select_ids(list(stats) + list(removed_paths))
+            # Skip files the table already has at the same mtime and size (e.g. web uploads)
+            updated = [p for p, st in stats.items()
+                       if p not in known or known[p][1:3] != (st.st_mtime, st.st_size)]
+            # New files whose content is already in the library are kept aside, like a repeated web upload
+            hashes, duplicates = self._hash_new([p for p in updated if p not in known], removed_paths)
+            updated = [p for p in updated if p not in duplicates]
+            self.db.execute_many([
+                ('DELETE FROM media WHERE filepath = ?', [(p,) for p in removed_paths]),  # first: a moved file keeps its hash
+                ('INSERT OR IGNORE INTO media (filepath, user, frames, mtime, size, sha256) VALUES (?, ?, ?, ?, ?, ?)',
+                 [(p, self.path_user(p), 'all', stats[p].st_mtime, stats[p].st_size, hashes.get(p))
+                  for p in updated if p not in known]),
+                # Changed in place: the old hash no longer applies, fill_hashes works out the new one
+                ('UPDATE media SET mtime = ?, size = ?, sha256 = NULL WHERE filepath = ?',
+                 [(stats[p].st_mtime, stats[p].st_size, p) for p in updated if p in known]),
+                ('DELETE FROM duplicates WHERE filepath = ?', [(p,) for p in updated]),
+                ('DELETE FROM duplicates WHERE filepath = ? OR substr(filepath, 1, ?) = ?',
+                 [(p, len(p + os.sep), p + os.sep) for p in removed]),
+                ('INSERT OR REPLACE INTO duplicates (filepath, sha256, mtime) VALUES (?, ?, ?)',
+                 [(p, sha256, stats[p].st_mtime) for p, sha256 in duplicates.items()]),
+            ])
+            ids = self._select_ids(updated)
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return [], {}
+
+        with self._lock:
+            self._apply(list(removed_paths) + updated, {p: (ids[p][0], stats[p].st_mtime, stats[p].st_size, ids[p][3], ids[p][4])
+                                                        for p in updated if p in ids})
+        updated += self._promote([known[p][3] for p in removed_paths if p in known])
+        return updated, {p: known[p][0] if p in known else None for p in removed_paths}
+
+    def _hash_new(self, filepaths, removed_paths):
+        # ({path: sha256} for files to index, {path: sha256} for copies of content the library already has);
+        # a file that can't be read is indexed without a hash and fill_hashes tries again
+        hashes, duplicates, seen = {}, {}, set()
+        for filepath in filepaths:
+            try:
+                sha256 = file_sha256(filepath)
+            except OSError:
+                continue
+            row = self.find_hash(sha256)
+            if sha256 in seen or (row and row[1] not in removed_paths):
+                duplicates[filepath] = sha256
+            else:
+                hashes[filepath] = sha256
+                seen.add(sha256)
+        return hashes, duplicates
+
+    def _promote(self, hashes):
+        # Content whose indexed file went away stays in the library through a copy that is still on disk;
+        # returns the paths that took over
+        promoted = []
+        for sha256 in filter(None, hashes):
+            try:
+                rows = self.db.query('SELECT filepath FROM duplicates WHERE sha256 = ?', (sha256,))
+                for (filepath,) in rows:
+                    # Copies that are gone from disk are dropped on the way; the rest stay duplicates
+                    self.db.execute('DELETE FROM duplicates WHERE filepath = ?', (filepath,))
+                    if self.add(filepath, self.path_user(filepath), sha256) is not None:
+                        promoted.append(filepath)
+                        break
+            except sqlite3.Error as e:
+                print(f"Database error: {e}")
+        return promoted
+
+    def _select_ids(self, paths):
+        rows = self.db.query_in('SELECT filepath, id, mtime, size, sha256, user FROM media WHERE filepath IN ({})', paths)
+        return {row[0]: row[1:] for row in rows}
+
+    def _user_number(self, user):
+        # Caller holds the lock. Position of an uploader in _user_names, added on first sight
+        number = self._user_numbers.get(user)
+        if number is None:
+            number = self._user_numbers[user] = len(self._user_names)
+            self._user_names.append(user)
+        return number
+
+    def _apply(self, dropped, added):
+        # Caller holds the lock. Removes dropped paths, then inserts added {path: (id, mtime, size, sha256, user)}
+        # by mtime; the arrays are changed in place
+        for filepath in dropped:
+            media_id = self._drop(filepath)
+            if filepath not in added:
+                self._transforms.pop(filepath, None)
+                self._favourites.discard(media_id)
+        for filepath, (media_id, mtime, size, sha256, user) in added.items():
+            self._drop(filepath)
+            mtime = mtime or 0
+            pos = bisect.bisect_left(self._keys, -mtime)
+            self._order.insert(pos, media_id)
+            self._keys.insert(pos, -mtime)
+            if media_id >= len(self._mtimes):
+                grow = media_id + 1 - len(self._mtimes) + len(self._mtimes) // 4  # room for the next uploads
+                self._mtimes.frombytes(bytes(8 * grow))
+                self._sizes.frombytes(bytes(8 * grow))
+                self._hashes.frombytes(bytes(8 * grow))
+                self._users.frombytes(bytes(2 * grow))
+            self._mtimes[media_id], self._sizes[media_id] = mtime, size or 0
+            self._hashes[media_id] = hash_key(sha256)
+            self._users[media_id] = self._user_number(user)
+            self._paths.add(filepath, media_id)
+
+    def _drop(self, filepath):
+        # Caller holds the lock. Forgets filepath; returns its media id (or None)
+        media_id = self._paths.remove(filepath)
+        if media_id is None:
+            return None
+        # Entries with the same mtime sit together, so the id is found without a full scan
+        key = -self._mtimes[media_id]
+        lo, hi = bisect.bisect_left(self._keys, key), bisect.bisect_right(self._keys, key)
+        i = next((j for j in range(lo, hi) if self._order[j] == media_id), None)
+        if i is None:
+            try:
+                i = self._order.index(media_id)
+            except ValueError:
+                return media_id
+        del self._order[i]
+        del self._keys[i]
+        return media_id
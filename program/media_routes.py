@@ -0,0 +1,139 @@
+# Media item routes: versioned file and thumbnail URLs, and the delete, rotate, crop, fit and favourite
+# actions of the media page
+# Used by program/web.py (registered as a blueprint) and the media page through fetch
+# Depends on program/library.py (media index, renditions, change notifications) and program/serving.py
+# for the responses (ETags, byte ranges)
+
+import os
+from flask import Blueprint, request, redirect, url_for, session
+from surface_cache import FIT_MODES
+from serving import send_media
+from library import media_index, renditions, media_changed, item_changed, transform_changed
+
+blueprint = Blueprint('media', __name__)
+
+@blueprint.route('/media_file/<int:media_id>')
+@blueprint.route('/media_file/<int:media_id>/<version>')
+def media_file(media_id, version=None):
+    filepath = media_index.path_for(media_id)
+    if filepath is None:
+        return '', 404
+    current = media_index.version(filepath)
+    if version is not None and version != current:
+        return redirect(url_for('.media_file', media_id=media_id, version=current))
+    return send_media(filepath, current, immutable=version is not None)
+
+@blueprint.route('/media_thumb/<int:media_id>/<version>')
+def media_thumb(media_id, version):
+    filepath = media_index.path_for(media_id)
+    if filepath is None:
+        return '', 404
+    current = media_index.version(filepath)
+    if version != current:
+        return redirect(url_for('.media_thumb', media_id=media_id, version=current))
+    thumb = renditions.thumb_for(filepath, media_index.transform_for(filepath))
+    # Until the thumbnail is built the original is served, which must not be cached under this URL
+    return send_media(thumb, current, immutable=thumb != filepath)
+
+@blueprint.route('/delete_media/<int:media_id>')
+def delete_media(media_id):
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    filepath = media_index.path_for(media_id)
+    if filepath is not None:
+        # remove from db, with any other copies of the same content so none of them takes its place
+        duplicates = media_index.drop_duplicates(filepath)
+        media_id = media_index.remove(filepath)
+        renditions.discard(filepath, media_id)
+        # remove files
+        for path in [filepath] + duplicates:
+            if os.path.exists(path):
+                os.remove(path)
+        media_changed(removed=[filepath])
+    return '', 204
+
+@blueprint.route('/rotate_media/<int:media_id>')
+def rotate_media(media_id):
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    filepath = media_index.path_for(media_id)
+    if filepath is not None:
+        # Rotate 90 deg left as metadata only; renditions are rebuilt in the background
+        rotation = media_index.transform_for(filepath)[0]
+        media_index.set_transform(filepath, rotation=rotation - 90)
+        transform_changed(filepath)
+    return '', 204
+
+@blueprint.route('/rotate_right/<int:media_id>')
+def rotate_right(media_id):
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    filepath = media_index.path_for(media_id)
+    if filepath is not None:
+        # Rotate 90 deg right as metadata only; renditions are rebuilt in the background
+        rotation = media_index.transform_for(filepath)[0]
+        media_index.set_transform(filepath, rotation=rotation + 90)
+        transform_changed(filepath)
+    return '', 204
+
+@blueprint.route('/crop_media/<int:media_id>')
+def crop_media(media_id):
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    filepath = media_index.path_for(media_id)
+    if filepath is None:
+        return '', 404
+    if 'reset' in request.args:
+        crop = None
+    else:
+        # x, y, w, h as fractions of the (rotated) image
+        try:
+            crop = tuple(float(request.args[k]) for k in ('x', 'y', 'w', 'h'))
+        except (KeyError, ValueError):
+            return '', 400
+        x, y, w, h = crop
+        if not (0 <= x < 1 and 0 <= y < 1 and 0 < w <= 1 - x and 0 < h <= 1 - y):
+            return '', 400
+    media_index.set_transform(filepath, crop=crop)
+    transform_changed(filepath)
+    return '', 204
+
+@blueprint.route('/fit_media/<int:media_id>')
+def fit_media(media_id):
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    filepath = media_index.path_for(media_id)
+    if filepath is None:
+        return '', 404
+    if 'reset' in request.args:
+        # Back to each hole's own fit mode, centered
+        fit, focal = None, None
+    else:
+        # mode=contain|cover, optional focal point x, y as fractions of the (rotated, cropped) image
+        fit = request.args.get('mode')
+        if fit not in FIT_MODES:
+            return '', 400
+        focal = None
+        if 'x' in request.args or 'y' in request.args:
+            try:
+                focal = (float(request.args['x']), float(request.args['y']))
+            except (KeyError, ValueError):
+                return '', 400
+            if not all(0 <= v <= 1 for v in focal):
+                return '', 400
+    media_index.set_transform(filepath, fit=fit, focal=focal)
+    transform_changed(filepath)
+    return '', 204
+
+@blueprint.route('/favourite_media/<int:media_id>')
+def favourite_media(media_id):
+    # Favourites come up more often in the playlist ([schedule] favourite_weight); ?off=1 clears it
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    filepath = media_index.path_for(media_id)
+    if filepath is None:
+        return '', 404
+    media_index.set_favourite(filepath, 'off' not in request.args)
+    item_changed(filepath)
+    return '', 204
+
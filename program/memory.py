@@ -0,0 +1,97 @@
+# Memory governor for the display process: one place that sets the surface cache and prefetch budgets,
+# watches the system's available memory and backs off before the Pi starts swapping or the OOM killer runs
+# Used by program/display.py (check thread, MemoryError from a decode, gauges in sample_metrics)
+# Depends on program/surface_cache.py (set_budget, hole_mask), program/prefetch.py (budget_bytes) and
+# program/media_index.py (memory_bytes)
+# The path index is not evicted (the library needs every path); when it grows past its budget the surplus
+# comes out of the surface cache budget instead, so the total stays the same
+# Settings come from the [memory] section of config.cfg; [display] surface_cache_mb is the cache budget
+
+import gc
+import threading
+import time
+
+from surface_cache import hole_mask
+
+MIN_SCALE = 0.125  # budgets never shrink below 1/8 of their configured size
+MIN_CACHE_BYTES = 4 * 1024 * 1024  # enough for a couple of decoded holes
+
+
+def available_bytes():
+    # MemAvailable from /proc/meminfo; None where there is no such file (not Linux)
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class MemoryGovernor:
+    def __init__(self, surface_cache, prefetcher, media_index, cache_bytes, prefetch_bytes=32 * 1024 * 1024,
+                 index_bytes=16 * 1024 * 1024, min_available_bytes=64 * 1024 * 1024, check_seconds=5.0):
+        self.surface_cache = surface_cache
+        self.prefetcher = prefetcher
+        self.media_index = media_index
+        self.cache_bytes = cache_bytes
+        self.prefetch_bytes = prefetch_bytes
+        self.index_bytes = index_bytes
+        self.min_available_bytes = min_available_bytes
+        self.check_seconds = check_seconds
+        self.scale = 1.0  # halved under memory pressure, doubled back once it has passed
+        self.pressure_events = 0
+        self.available = None  # last reading of available_bytes
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self.apply()
+        if self._thread is None and self.check_seconds > 0:
+            self._thread = threading.Thread(target=self._run, name='memory', daemon=True)
+            self._thread.start()
+
+    def apply(self):
+        # Push the current budgets to the cache and the prefetcher
+        with self._lock:
+            index_bytes = self.media_index.memory_bytes() if self.media_index is not None else 0  # None until loaded
+            index_over = max(0, index_bytes - self.index_bytes)
+            cache_budget = max(MIN_CACHE_BYTES, int((self.cache_bytes - index_over) * self.scale))
+            prefetch_budget = int(self.prefetch_bytes * self.scale)
+        self.prefetcher.budget_bytes = prefetch_budget
+        self.surface_cache.set_budget(cache_budget)
+
+    def check(self):
+        # One reading of available memory: back off below the threshold, recover one step at a time above twice it
+        self.available = available_bytes()
+        if self.available is not None and self.min_available_bytes:
+            if self.available < self.min_available_bytes:
+                self.pressure(f"{self.available / 1048576:.0f} MB available")
+                return
+            if self.available > 2 * self.min_available_bytes and self.scale < 1.0:
+                with self._lock:
+                    self.scale = min(1.0, self.scale * 2)
+        self.apply()
+
+    def pressure(self, reason):
+        with self._lock:
+            self.scale = max(MIN_SCALE, self.scale / 2)
+            self.pressure_events += 1
+            scale = self.scale
+        print(f"Memory pressure ({reason}): budgets at {scale:.0%}")
+        self.apply()
+        hole_mask.cache_clear()
+        gc.collect()
+
+    def memory_error(self):
+        # SurfaceCache.on_memory_error: a decode ran out of memory
+        self.pressure('decode ran out of memory')
+
+    def _run(self):
+        while True:
+            time.sleep(self.check_seconds)
+            try:
+                self.check()
+            except Exception as e:
+                print(f"Memory check error: {e}")
@@ -0,0 +1,102 @@
+# In-process counters, gauges and histograms, rendered in the Prometheus text format
+# Used by program/display.py (frame, decode and cache figures; pushed to the web server every few seconds)
+# Used by program/web.py (request latency per route) and program/event_routes.py (the /metrics endpoint)
+# Settings come from the [metrics] section of config.cfg
+
+import bisect
+import threading
+
+PREFIX = 'tvframe_'
+# Seconds; from a fast frame to a slow full-size decode
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.64, 1.28, 2.56)
+
+
+class Metrics:
+    def __init__(self):
+        self._meta = {}  # name -> (type, help, buckets)
+        self._values = {}  # (name, labels) -> number, or [per-bucket counts, sum, count] for histograms
+        self._lock = threading.Lock()
+
+    def counter(self, name, help):
+        self._meta[name] = ('counter', help, None)
+
+    def gauge(self, name, help):
+        self._meta[name] = ('gauge', help, None)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        self._meta[name] = ('histogram', help, tuple(buckets))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        # Gauges, and counters kept elsewhere (e.g. SurfaceCache.hits) copied in before a snapshot
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self._meta[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(buckets), 0.0, 0]
+            i = bisect.bisect_left(buckets, value)
+            if i < len(buckets):
+                entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def total(self, name):
+        # Sum over all label sets: (sum, count) for a histogram, the value otherwise
+        with self._lock:
+            values = [value for (n, _), value in self._values.items() if n == name]
+        if self._meta[name][0] == 'histogram':
+            return sum(v[1] for v in values), sum(v[2] for v in values)
+        return sum(values)
+
+    def snapshot(self):
+        # JSON-friendly copy, e.g. to send from the display process to the web server
+        with self._lock:
+            return {'meta': {name: [typ, help, list(buckets) if buckets else None]
+                             for name, (typ, help, buckets) in self._meta.items()},
+                    'values': [[name, dict(labels), [list(v[0]), v[1], v[2]] if isinstance(v, list) else v]
+                               for (name, labels), v in self._values.items()]}
+
+
+def _labels(labels, **extra):
+    items = list(labels.items()) + list(extra.items())
+    if not items:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+
+
+def render(*snapshots):
+    # Prometheus text exposition of one or more snapshots (None entries are skipped)
+    lines = []
+    for snapshot in snapshots:
+        if not snapshot:
+            continue
+        values = {}
+        for name, labels, value in snapshot['values']:
+            values.setdefault(name, []).append((labels, value))
+        for name, (typ, help, buckets) in sorted(snapshot['meta'].items()):
+            full = PREFIX + name
+            lines.append(f'# HELP {full} {help}')
+            lines.append(f'# TYPE {full} {typ}')
+            for labels, value in values.get(name, []):
+                if typ == 'histogram':
+                    counts, total, count = value
+                    cumulative = 0
+                    for le, n in zip(buckets, counts):
+                        cumulative += n
+                        lines.append(f'{full}_bucket{_labels(labels, le=le)} {cumulative}')
+                    lines.append(f'{full}_bucket{_labels(labels, le="+Inf")} {count}')
+                    lines.append(f'{full}_sum{_labels(labels)} {total}')
+                    lines.append(f'{full}_count{_labels(labels)} {count}')
+                else:
+                    lines.append(f'{full}{_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
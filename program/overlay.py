@@ -0,0 +1,58 @@
+# On-screen debug overlay drawn next to the QR code: frame time, decode and scale time, cache hit rate,
+# swaps, missed prefetch deadlines and dropped video frames
+# Used by program/display.py while [metrics] overlay is on (toggled from the calibration and media pages)
+# Depends on program/metrics.py; figures cover the time since the previous refresh, not since start
+
+import time
+
+import pygame
+
+SIZE = (360, 100)
+BACKGROUND = (0, 0, 0)
+TEXT_COLOR = (0, 255, 0)
+
+# Totals compared between refreshes
+TOTALS = ('display_frame_seconds', 'display_decode_seconds', 'display_scale_seconds',
+          'display_surface_cache_hits_total', 'display_surface_cache_misses_total', 'display_swaps_total',
+          'display_missed_deadlines_total', 'display_dropped_frames_total', 'display_slow_frames_total')
+
+
+class DebugOverlay:
+    def __init__(self, metrics, font):
+        self.metrics = metrics
+        self.font = font
+        self._previous = None
+        self._previous_time = None
+
+    def render(self, cache_bytes=0, cache_budget=1):
+        now = time.monotonic()
+        current = {name: self.metrics.total(name) for name in TOTALS}
+        previous = self._previous or {name: (0.0, 0) if isinstance(value, tuple) else 0
+                                      for name, value in current.items()}
+        elapsed = max(1e-3, now - self._previous_time) if self._previous_time else 1.0
+        self._previous, self._previous_time = current, now
+
+        def delta(name):
+            return current[name] - previous[name]
+
+        def mean_ms(name):
+            total, count = current[name][0] - previous[name][0], current[name][1] - previous[name][1]
+            return (f'{total / count * 1000:.1f} ms', count) if count else ('-', 0)
+
+        frame, frames = mean_ms('display_frame_seconds')
+        decode, decodes = mean_ms('display_decode_seconds')
+        scale, _ = mean_ms('display_scale_seconds')
+        lookups = delta('display_surface_cache_hits_total') + delta('display_surface_cache_misses_total')
+        hit_rate = f"{delta('display_surface_cache_hits_total') / lookups:.0%}" if lookups else '-'
+        lines = [
+            f'{frames / elapsed:.1f} fps  frame {frame}',
+            f'decode {decode}  scale {scale}  ({decodes})',
+            f'cache hits {hit_rate}  {cache_bytes / 1048576:.0f}/{cache_budget / 1048576:.0f} MB',
+            f"swaps {delta('display_swaps_total')}  late {delta('display_missed_deadlines_total')}  "
+            f"dropped {delta('display_dropped_frames_total')}  slow {delta('display_slow_frames_total')}",
+        ]
+        surface = pygame.Surface(SIZE)
+        surface.fill(BACKGROUND)
+        for i, line in enumerate(lines):
+            surface.blit(self.font.render(line, True, TEXT_COLOR), (6, 4 + i * 24))
+        return surface.convert()
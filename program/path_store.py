@@ -0,0 +1,69 @@
+# Compact two-way map between media ids and file paths, for very large libraries
+# Used by program/media_index.py, which calls it under its own lock (path_for is a single list read and
+# needs none)
+# Each path string is held once, in a list indexed by media id; a path's id is found through sorted arrays
+# of path hashes (hash() is per process, nothing here is stored) instead of a second dict
+
+import bisect
+import sys
+from array import array
+
+
+class PathStore:
+    def __init__(self, rows=()):
+        # rows: (filepath, media id)
+        rows = list(rows)
+        top = max((row[1] for row in rows), default=-1) + 1
+        self._paths = [None] * top  # filepath by media id, None for ids not in the library
+        for filepath, media_id in rows:
+            self._paths[media_id] = filepath
+        by_hash = sorted((hash(filepath), media_id) for filepath, media_id in rows)
+        self._hashes = array('q', (pair[0] for pair in by_hash))  # ascending, for bisect
+        self._ids = array('q', (pair[1] for pair in by_hash))  # media id for each entry in _hashes
+        self._bytes = sum(sys.getsizeof(filepath) for filepath, _ in rows)  # held by the path strings
+
+    def __iter__(self):
+        return (filepath for filepath in self._paths if filepath is not None)
+
+    def memory_bytes(self):
+        return sys.getsizeof(self._paths) + self._hashes.itemsize * (len(self._hashes) + len(self._ids)) + self._bytes
+
+    def path_for(self, media_id):
+        paths = self._paths
+        return paths[media_id] if media_id is not None and 0 <= media_id < len(paths) else None
+
+    def id_for(self, filepath):
+        # Entries with the same hash sit together
+        key, hashes = hash(filepath), self._hashes
+        i = bisect.bisect_left(hashes, key)
+        while i < len(hashes) and hashes[i] == key:
+            media_id = self._ids[i]
+            if self._paths[media_id] == filepath:
+                return media_id
+            i += 1
+        return None
+
+    def add(self, filepath, media_id):
+        # filepath must not be in the store
+        if media_id >= len(self._paths):
+            self._paths.extend([None] * (media_id + 1 - len(self._paths) + len(self._paths) // 4))
+        self._paths[media_id] = filepath
+        key = hash(filepath)
+        i = bisect.bisect_left(self._hashes, key)
+        self._hashes.insert(i, key)
+        self._ids.insert(i, media_id)
+        self._bytes += sys.getsizeof(filepath)
+
+    def remove(self, filepath):
+        # Returns the path's media id, or None if it was not in the store
+        media_id = self.id_for(filepath)
+        if media_id is None:
+            return None
+        self._paths[media_id] = None
+        i = bisect.bisect_left(self._hashes, hash(filepath))
+        while self._ids[i] != media_id:
+            i += 1
+        del self._hashes[i]
+        del self._ids[i]
+        self._bytes -= sys.getsizeof(filepath)
+        return media_id
@@ -0,0 +1,113 @@
+# Background prefetch of the next image for each hole, decoded off the render thread
+# Used by program/display.py (run_display)
+# Depends on program/surface_cache.py for the shared surface cache
+# Depends on program/video.py (videos are streamed by the video engine, not prefetched)
+# Decoded-ahead pixels are held to budget_bytes (set by program/memory.py); a hole that doesn't fit waits
+# until an earlier decode has been swapped in
+
+from concurrent.futures import ThreadPoolExecutor
+
+from surface_cache import decode_scaled, to_surface
+from video import is_video
+
+
+class Prefetcher:
+    # Holds one decoded-ahead media item per hole until the display loop swaps it in
+
+    def __init__(self, surface_cache, workers=2, on_ready=None, budget_bytes=None):
+        self.surface_cache = surface_cache
+        self.on_ready = on_ready  # e.g. scene.wake, so a late swap happens as soon as the decode lands
+        self.on_decoded = None  # (hole_id, timings) -> None, called on the render thread when a decode is swapped in
+        self.budget_bytes = budget_bytes  # None = no limit
+        self.pending_bytes = 0
+        self.swaps = 0
+        self.missed_deadlines = 0
+        self.deferred = 0  # holes that had to wait for room, counted once per wait
+        self._waiting = set()  # hole ids currently waiting for room
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self._pending = {}  # hole_id -> (filepath, cache key, future or None, timings, estimated bytes)
+
+    def has_room(self, hole_id, size):
+        # Whether a decode for a hole of this size fits the budget; one decode is always allowed, so a
+        # budget smaller than a single hole slows swaps down instead of stopping them
+        nbytes = int(size[0]) * int(size[1]) * 4
+        if self.budget_bytes is None or self.pending_bytes == 0 or self.pending_bytes + nbytes <= self.budget_bytes:
+            self._waiting.discard(hole_id)
+            return True
+        if hole_id not in self._waiting:
+            self._waiting.add(hole_id)
+            self.deferred += 1
+        return False
+
+    def schedule(self, hole_id, filepath, size, shape='rect', fit='contain'):
+        key = self.surface_cache.make_key(filepath, size, shape, fit)
+        future = None
+        timings = {}
+        nbytes = 0
+        if key is not None and not is_video(filepath) and not self.surface_cache.contains(key):
+            # PIL releases the GIL while decoding and resizing
+            source, transform = self.surface_cache.source_for(key)
+            future = self._executor.submit(decode_scaled, source, key[2], transform, key[4], key[5], timings,
+                                           self.surface_cache.max_pixels)
+            if self.on_ready:
+                future.add_done_callback(lambda f: self.on_ready())
+            nbytes = key[2][0] * key[2][1] * 4
+            self.pending_bytes += nbytes
+        self._pending[hole_id] = (filepath, key, future, timings, nbytes)
+
+    def pending(self, hole_id):
+        return hole_id in self._pending
+
+    def pending_paths(self):
+        return {entry[0] for entry in list(self._pending.values())}
+
+    def ready(self, hole_id):
+        entry = self._pending.get(hole_id)
+        return entry is not None and (entry[2] is None or entry[2].done())
+
+    def check_deadline(self, hole_id):
+        # Called when a hole is due to swap; counts a miss if its next item isn't decoded yet
+        if self.ready(hole_id):
+            return True
+        self.missed_deadlines += 1
+        return False
+
+    def take(self, hole_id):
+        # Render thread only: converts the decoded pixels to display format and caches them
+        filepath, key, future, timings, nbytes = self._pending.pop(hole_id)
+        self._release(nbytes)
+        if future is not None:
+            try:
+                self.surface_cache.put(key, to_surface(future.result()))
+            except MemoryError:
+                self.surface_cache.memory_error(key)
+            except Exception as e:
+                # Not an image PIL can read (corrupt file); don't retry every frame
+                self.surface_cache.mark_failed(key, e)
+            else:
+                if self.on_decoded:
+                    self.on_decoded(hole_id, timings)
+        self.swaps += 1
+        return filepath
+
+    def discard(self, hole_id):
+        # The hole was resized or removed: its decode is the wrong size
+        self._waiting.discard(hole_id)
+        entry = self._pending.pop(hole_id, None)
+        if entry is not None and entry[2] is not None:
+            entry[2].cancel()
+            self._release(entry[4])
+
+    def clear(self):
+        for entry in self._pending.values():
+            if entry[2] is not None:
+                entry[2].cancel()
+        self._pending.clear()
+        self._waiting.clear()
+        self._release(self.pending_bytes)
+
+    def _release(self, nbytes):
+        # A deferred hole may fit now; wake the display loop to schedule it
+        self.pending_bytes -= nbytes
+        if nbytes and self._waiting and self.on_ready:
+            self.on_ready()
@@ -0,0 +1,255 @@
+# Upload-time derivative pipeline: EXIF-oriented renditions sized for each hole plus a web thumbnail.
+# The media row's rotation/crop metadata is baked into every rendition; originals are never rewritten.
+# Cover renditions are cropped to the hole's aspect ratio; the crop box is computed once here and stored.
+# Used by the web server (builds: program/library.py for uploads, backfill and new hole sizes, program/media_routes.py
+# for delete, rotate and /media_thumb)
+# Used by program/display.py to look up renditions (reload picks up ones the web server built)
+# Used by program/surface_cache.py and program/prefetch.py via SurfaceCache.resolve_source
+# Used by program/cluster.py: a hub builds renditions in the sizes its display nodes ask for (rendition_for)
+# Depends on config.cfg [paths] renditions_dir and the [renditions] section
+# Depends on program/database.py (the media table, through the shared db of program/settings.py)
+# Files live in renditions_dir/<media id>/<w>x<h>[-cover].jpg and are recorded as JSON in media.renditions
+
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from surface_cache import NO_TRANSFORM, apply_transform, cover_box, effective_fit, fit_image, open_image
+from video import is_video
+
+
+def size_name(size, fit='contain'):
+    name = f'{int(size[0])}x{int(size[1])}'
+    return name + '-cover' if fit == 'cover' else name
+
+
+def parse_size_name(name):
+    # ((w, h), fit) for a name made by size_name, None for anything else
+    base, fit = (name[:-len('-cover')], 'cover') if name.endswith('-cover') else (name, 'contain')
+    w, sep, h = base.partition('x')
+    if not (sep and w.isdigit() and h.isdigit()):
+        return None
+    return (int(w), int(h)), fit
+
+
+def transform_json(transform):
+    # Same shape json.loads gives back, so stored and current transforms compare equal
+    rotation, crop, fit, focal = transform
+    return [rotation, list(crop) if crop else None, fit, list(focal) if focal else None]
+
+
+class RenditionPipeline:
+    def __init__(self, db, renditions_dir, targets, thumb_size=320, quality=85, workers=1, max_pixels=None):
+        # db: program/database.py Database; targets: ((w, h), default fit mode) for each hole
+        self.db = db
+        self.renditions_dir = renditions_dir
+        self.targets = []
+        self.set_targets(targets)
+        self.thumb_size = thumb_size
+        self.quality = quality
+        self.max_pixels = max_pixels  # see surface_cache.open_image
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='renditions')
+        # filepath -> {'mtime': ..., 'transform': [...], 'sizes': {'WxH[-cover]': path}, 'boxes': {'WxH-cover': box}, 'thumb': path}
+        self._index = {}
+        self._queued = set()
+        self._lock = threading.Lock()
+        self.on_built = None  # filepath -> None, called after a file's renditions are written
+        self.originals = True  # False on a cluster node, which has renditions but no originals to fall back to
+        os.makedirs(renditions_dir, exist_ok=True)
+
+    def set_targets(self, targets):
+        # New hole layout; returns True if it has sizes or fit modes without renditions yet (see backfill)
+        targets = sorted({((int(w), int(h)), fit) for (w, h), fit in targets}, reverse=True)
+        added = not set(targets) <= set(self.targets)
+        self.targets = targets
+        return added
+
+    def load_index(self):
+        # Read what earlier runs already built
+        rows = self.db.query('SELECT filepath, renditions FROM media WHERE renditions IS NOT NULL')
+        with self._lock:
+            for filepath, data in rows:
+                try:
+                    self._index[filepath] = json.loads(data)
+                except ValueError:
+                    pass
+
+    def _current(self, filepath, mtime=None, transform=NO_TRANSFORM):
+        # Index entry for filepath, or None if missing, built from an older version of the file,
+        # or built with different rotation/crop metadata
+        entry = self._index.get(filepath)
+        if entry is None or entry.get('transform') != transform_json(transform):
+            return None
+        if mtime is None:
+            try:
+                mtime = os.path.getmtime(filepath)
+            except OSError:
+                return None
+        return entry if entry['mtime'] == mtime else None
+
+    def source_for(self, filepath, size, mtime=None, transform=NO_TRANSFORM, fit='contain'):
+        # Smallest file to decode for a hole of this size and (effective) fit: its rendition if built, else the original
+        with self._lock:
+            entry = self._current(filepath, mtime, transform)
+        if entry is not None:
+            path = entry['sizes'].get(size_name(size, fit))
+            if path and os.path.exists(path):
+                return path
+            if not self.originals:
+                # Until the node has this size (new hole layout), the largest one it has is scaled instead
+                existing = [path for path in entry['sizes'].values() if os.path.exists(path)]
+                if existing:
+                    return max(existing, key=os.path.getsize)
+        return filepath
+
+    def reload(self, filepath):
+        # Pick up renditions another process built (or discarded) for this file
+        row = self.db.query_one('SELECT renditions FROM media WHERE filepath = ?', (filepath,))
+        with self._lock:
+            try:
+                self._index[filepath] = json.loads(row[0])
+            except (TypeError, ValueError):
+                self._index.pop(filepath, None)
+
+    def thumb_for(self, filepath, transform=NO_TRANSFORM):
+        with self._lock:
+            entry = self._current(filepath, transform=transform)
+        if entry is not None and entry.get('thumb') and os.path.exists(entry['thumb']):
+            return entry['thumb']
+        return filepath
+
+    def submit(self, filepath):
+        if is_video(filepath):
+            return
+        with self._lock:
+            if filepath in self._queued:
+                return
+            self._queued.add(filepath)
+        self._executor.submit(self._build, filepath)
+
+    def backfill(self, filepaths, transform_for=None):
+        # Queue renditions for files that have none, only stale ones, or none for a hole size added since
+        for filepath in filepaths:
+            transform = transform_for(filepath) if transform_for else NO_TRANSFORM
+            with self._lock:
+                entry = self._current(filepath, transform=transform)
+            missing = entry is None or any(size_name(size, effective_fit(transform, fit)) not in entry['sizes']
+                                           for size, fit in self.targets)
+            if missing:
+                self.submit(filepath)
+
+    def close(self):
+        # Finish the queued builds and stop the workers
+        self._executor.shutdown(wait=True)
+
+    def discard(self, filepath, media_id=None):
+        # Forget renditions for a deleted or rewritten file; files are removed when the id is known
+        with self._lock:
+            self._index.pop(filepath, None)
+        if media_id is not None:
+            shutil.rmtree(os.path.join(self.renditions_dir, str(media_id)), ignore_errors=True)
+
+    def _media_row(self, filepath):
+        # (media id, (rotation, crop, fit, focal)) for the file, or None if it is not in the library
+        row = self.db.query_one('SELECT id, rotation, crop_x, crop_y, crop_w, crop_h, fit, focal_x, focal_y FROM media '
+                                'WHERE filepath = ?', (filepath,))
+        if not row:
+            return None
+        crop = tuple(row[2:6]) if None not in row[2:6] else None
+        focal = tuple(row[7:9]) if None not in row[7:9] else None
+        return row[0], (row[1] or 0, crop, row[6], focal)
+
+    def _build(self, filepath):
+        with self._lock:
+            self._queued.discard(filepath)
+        try:
+            mtime = os.path.getmtime(filepath)
+            row = self._media_row(filepath)
+            if row is None:
+                return
+            media_id, transform = row
+            out_dir = os.path.join(self.renditions_dir, str(media_id))
+            os.makedirs(out_dir, exist_ok=True)
+
+            # Decoded only as large as the biggest target needs (JPEG draft), so a 50 MP photo doesn't
+            # cost 200 MB here
+            largest = (max([size[0] for size, _ in self.targets] + [self.thumb_size]),
+                       max([size[1] for size, _ in self.targets] + [self.thumb_size]))
+            img, reduced = self._decode(filepath, largest, transform)
+            ext = '.png' if img.mode == 'RGBA' else '.jpg'
+
+            entry = {'mtime': mtime, 'transform': transform_json(transform), 'sizes': {}, 'boxes': {}, 'thumb': None}
+            for size, hole_fit in self.targets:
+                fit = effective_fit(transform, hole_fit)
+                name = size_name(size, fit)
+                if name in entry['sizes']:
+                    continue  # another hole of the same size and fit
+                if fit == 'cover':
+                    # In pixels of the full-size (transformed) image, whatever size it was decoded at
+                    box = cover_box(img.width, img.height, size[0], size[1], transform[3])
+                    entry['boxes'][name] = [round(v * reduced, 2) for v in box]
+                out = fit_image(img, size, fit, transform[3])
+                path = os.path.join(out_dir, name + ext)
+                self._save(out, path)
+                entry['sizes'][name] = path
+            thumb = img.copy()
+            thumb.thumbnail((self.thumb_size, self.thumb_size), Image.LANCZOS)
+            entry['thumb'] = os.path.join(out_dir, 'thumb' + ext)
+            self._save(thumb, entry['thumb'])
+
+            self.db.execute('UPDATE media SET renditions = ? WHERE id = ?', (json.dumps(entry), media_id))
+            with self._lock:
+                self._index[filepath] = entry
+            if self.on_built:
+                self.on_built(filepath)
+        except FileNotFoundError:
+            pass  # deleted before its turn in the queue
+        except Exception as e:
+            print(f"Rendition error for {filepath}: {e}")
+
+    def rendition_for(self, filepath, size, fit):
+        # Path of a rendition of one size and (effective) fit, built now if this frame's own holes don't use
+        # it; for cluster nodes with other hole sizes. None if the file is not in the library
+        row = self._media_row(filepath)
+        if row is None:
+            return None
+        media_id, transform = row
+        name = size_name(size, fit)
+        with self._lock:
+            entry = self._current(filepath, transform=transform)
+        path = entry['sizes'].get(name) if entry is not None else None
+        if path and os.path.exists(path):
+            return path
+        img, _ = self._decode(filepath, size, transform)
+        out_dir = os.path.join(self.renditions_dir, str(media_id))
+        os.makedirs(out_dir, exist_ok=True)
+        path = os.path.join(out_dir, name + ('.png' if img.mode == 'RGBA' else '.jpg'))
+        self._save(fit_image(img, size, fit, transform[3]), path)
+        data = None
+        with self._lock:
+            entry = self._current(filepath, transform=transform)
+            if entry is not None:
+                # Recorded so the next node asking for this size gets the file; a rebuild (rotate) forgets it
+                entry['sizes'][name] = path
+                data = json.dumps(entry)
+        if data is not None:
+            self.db.execute('UPDATE media SET renditions = ? WHERE id = ?', (data, media_id))
+        return path
+
+    def _decode(self, filepath, size, transform):
+        # Oriented, rotated and cropped image, decoded no larger than size needs; and the draft reduction
+        img, reduced = open_image(filepath, size, transform, self.max_pixels)
+        return apply_transform(img, transform), reduced
+
+    def _save(self, img, path):
+        # Write to a temp name first so readers never see a half-written file
+        tmp = path + '.tmp'
+        if path.endswith('.png'):
+            img.save(tmp, 'PNG')
+        else:
+            img.save(tmp, 'JPEG', quality=self.quality)
+        os.replace(tmp, path)
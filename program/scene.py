@@ -0,0 +1,246 @@
+# Retained scene model for the pygame display: only dirty hole rectangles are redrawn
+# Used by program/display.py (run_display, layout changes and the messages that change media)
+# Depends on program/surface_cache.py for pre-scaled hole surfaces (already cut to oval/circle holes)
+# Depends on program/video.py for holes that are playing a video
+# Depends on program/settings.py for hole geometry (hole_box)
+
+import threading
+
+import pygame
+
+from settings import hole_box
+from surface_cache import MASKED_SHAPES
+from video import is_video
+
+BACKGROUND = (0, 0, 0)
+MATTE_KEY = (255, 0, 255)  # colorkey for the see-through part of a video matte
+GRID_COLOR = (64, 64, 64)
+HOLE_COLOR = (255, 255, 0)  # Yellow
+LABEL_COLOR = (255, 0, 0)
+
+# Posted from other threads to wake the display loop out of pygame.event.wait
+WAKE_EVENT = pygame.event.custom_type()
+
+
+def hole_rect(hole):
+    return pygame.Rect(hole_box(hole))
+
+
+class HoleView:
+    # One cut-out on screen and the media file currently shown in it
+
+    def __init__(self, hole):
+        self.hole = hole
+        self.filepath = None
+        self.player = None  # VideoPlayer while a video is assigned
+        self.dirty = True
+
+
+class Scene:
+    def __init__(self, holes, surface_cache, video_engine=None):
+        self.views = [HoleView(hole) for hole in holes]
+        self.surface_cache = surface_cache
+        self.video_engine = video_engine
+        self.screen = None
+        self.font = None
+        self.overlay = None  # (surface, pos) kept on top of the holes, e.g. the QR code
+        self.debug = None  # (surface, pos) of the debug overlay, see program/overlay.py
+        self._debug_changed = False
+        self.mode = None
+        self._full_redraw = True
+        self._stale_paths = set()
+        self._wake_pending = False
+        self._mattes = {}  # (shape, size) -> surface covering the corners outside an oval/circle hole
+        self._lock = threading.Lock()
+
+    def attach(self, screen, font, overlay=None):
+        self.screen = screen
+        self.font = font
+        self.overlay = overlay
+        self._full_redraw = True
+
+    def set_holes(self, holes, reshaped=()):
+        # New layout snapshot: holes that only moved keep their file and video player, reshaped ones
+        # (ids in reshaped) start over
+        views = {view.hole['id']: view for view in self.views}
+        new_views = []
+        for hole in holes:
+            view = views.pop(hole['id'], None)
+            if view is None or hole['id'] in reshaped:
+                if view is not None:
+                    self._assign(view, None)
+                view = HoleView(hole)
+            view.hole = hole
+            new_views.append(view)
+        for view in views.values():
+            self._assign(view, None)  # hole removed from the layout
+        self.views = new_views
+        self.request_redraw()
+
+    def invalidate_all(self):
+        # Layout, mode or window changed: repaint everything on the next render
+        self._full_redraw = True
+
+    def request_redraw(self):
+        self.invalidate_all()
+        self.wake()
+
+    def set_overlay(self, overlay):
+        # (surface, pos) or None, e.g. the QR code once it has been made
+        self.overlay = overlay
+        self.request_redraw()
+
+    def set_debug(self, surface, pos=None):
+        # New debug overlay contents (same size each time, drawn on the next render), or None to take it
+        # off the screen
+        if surface is None:
+            if self.debug is not None:
+                self.debug = None
+                self.request_redraw()  # repaint whatever it covered
+            return
+        self.debug = (surface, pos)
+        self._debug_changed = True
+
+    def invalidate_path(self, filepath):
+        # File contents changed on disk: redraw any hole showing it
+        with self._lock:
+            self._stale_paths.add(filepath)
+        self.wake()
+
+    def wake(self):
+        # Coalesced: at most one WAKE_EVENT is queued until the next render
+        if self._wake_pending or self.screen is None or not pygame.display.get_init():
+            return
+        self._wake_pending = True
+        try:
+            pygame.event.post(pygame.event.Event(WAKE_EVENT))
+        except pygame.error:
+            self._wake_pending = False
+
+    def render(self, mode, assignments):
+        # assignments maps hole id -> filepath (or None); returns the rects to push with display.update
+        self._wake_pending = False
+        with self._lock:
+            stale, self._stale_paths = self._stale_paths, set()
+        full = self._full_redraw or mode != self.mode
+        self._full_redraw = False
+        self.mode = mode
+
+        if full:
+            self.screen.fill(BACKGROUND)
+            if mode == 'calibrate':
+                self._draw_calibration()
+            for view in self.views:
+                view.dirty = True
+
+        rects = []
+        if mode == 'media':
+            for view in self.views:
+                if view.filepath in stale and view.player is not None:
+                    self._assign(view, None)  # restart the decoder so it picks up a new rotation, crop or fit mode
+                self._assign(view, assignments.get(view.hole['id']))
+                if view.filepath in stale or (view.player and view.player.has_new_frame()):
+                    view.dirty = True
+            rects = self._draw_dirty_holes()
+        else:
+            # Nothing is shown in the holes, so stop any video decoders
+            for view in self.views:
+                self._assign(view, None)
+
+        debug_changed, self._debug_changed = self._debug_changed, False
+        for overlay in (self.overlay, self.debug):
+            if overlay is None:
+                continue
+            surface, pos = overlay
+            overlay_rect = surface.get_rect(topleft=pos)
+            if full or overlay_rect.collidelist(rects) != -1 or (overlay is self.debug and debug_changed):
+                self.screen.blit(surface, pos)
+                rects.append(overlay_rect)
+
+        if full:
+            return [self.screen.get_rect()]
+        return rects
+
+    def _assign(self, view, filepath):
+        if filepath == view.filepath:
+            return
+        if view.player is not None:
+            self.video_engine.close(view.player)
+            view.player = None
+        view.filepath = filepath
+        view.dirty = True
+        if filepath is not None and self.video_engine is not None and is_video(filepath):
+            fit, focal = self.surface_cache.fit_for(filepath, view.hole['fit'])
+            rotation, crop = self.surface_cache.transform_for(filepath)[:2]
+            view.player = self.video_engine.open(filepath, hole_rect(view.hole).size, fit, focal, rotation, crop)
+
+    def _draw_dirty_holes(self):
+        screen_rect = self.screen.get_rect()
+        dirty_rects = [hole_rect(view.hole) for view in self.views if view.dirty]
+        rects = []
+        for view in self.views:
+            rect = hole_rect(view.hole)
+            # Clean holes overlapping a dirty one are repainted to keep the stacking order
+            if view.dirty or rect.collidelist(dirty_rects) != -1:
+                self._draw_hole(view, rect)
+                rects.append(rect.clip(screen_rect))
+            view.dirty = False
+        return rects
+
+    def _draw_hole(self, view, rect):
+        self.screen.fill(BACKGROUND, rect)
+        if view.player is not None:
+            # Video frames change every tick, so they are cut to shape by a cached colorkey matte
+            view.player.blit_to(self.screen, rect)
+            matte = self._matte(view.hole['type'], rect.size)
+            if matte is not None:
+                self.screen.blit(matte, rect)
+            return
+        if view.filepath is None:
+            return
+        img = self.surface_cache.get(view.filepath, rect.size, view.hole['type'], view.hole['fit'])
+        if img is None:
+            return  # Skip if can't load
+        # Center in hole
+        self.screen.blit(img, img.get_rect(center=rect.center))
+
+    def _matte(self, shape, size):
+        if shape not in MASKED_SHAPES:
+            return None
+        matte = self._mattes.get((shape, size))
+        if matte is None:
+            matte = pygame.Surface(size)
+            matte.fill(BACKGROUND)
+            w, h = size
+            if shape == 'circle':
+                d = min(w, h)
+                box = ((w - d) // 2, (h - d) // 2, d, d)
+            else:
+                box = (0, 0, w, h)
+            pygame.draw.ellipse(matte, MATTE_KEY, box)
+            matte = matte.convert()
+            matte.set_colorkey(MATTE_KEY, pygame.RLEACCEL)
+            self._mattes[(shape, size)] = matte
+        return matte
+
+    def _draw_calibration(self):
+        width, height = self.screen.get_size()
+        # Draw grid background
+        for x in range(0, width, 20):
+            pygame.draw.line(self.screen, GRID_COLOR, (x, 0), (x, height))
+        for y in range(0, height, 20):
+            pygame.draw.line(self.screen, GRID_COLOR, (0, y), (width, y))
+
+        # Draw holes
+        for view in self.views:
+            hole = view.hole
+            x, y, w, h = hole['x_px'], hole['y_px'], hole['w_px'], hole['h_px']
+            if hole['type'] == 'rect':
+                pygame.draw.rect(self.screen, HOLE_COLOR, (x - w/2, y - h/2, w, h), 2)
+            elif hole['type'] == 'circle':
+                pygame.draw.circle(self.screen, HOLE_COLOR, (int(x), int(y)), int(min(w, h)/2), 2)
+            else:  # oval
+                pygame.draw.ellipse(self.screen, HOLE_COLOR, (x - w/2, y - h/2, w, h), 2)
+            # Draw number
+            text = self.font.render(str(hole['id']), True, LABEL_COLOR)
+            self.screen.blit(text, (x - w/2 + 5, y - h/2 + 5))
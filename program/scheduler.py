@@ -0,0 +1,164 @@
+# Decides what each hole shows next and when it changes
+# Used by program/display.py (run_display, handle_message)
+# Depends on program/media_index.py for the library, and each item's mtime, uploader and favourite flag
+# Works on media ids: the decks are compact arrays, paths are looked up in the index when a card is drawn
+# Shuffled-deck sampling without replacement: every item is shown once before anything repeats, in an
+# order weighted by recency, uploader and favourites. An item that is on screen (or queued for another
+# hole) is passed over, so two holes never show the same file while the library has enough items.
+# Each hole changes on its own interval; due times are kept in a heap.
+# Decks are dealt off the render thread: the first by set_library (called from the loader and message threads),
+# the next one by a background thread once half of the current deck has been drawn.
+# Settings come from [schedule], [interval] (seconds per hole) and [user_weight] in config.cfg
+
+import heapq
+import random
+import threading
+import time
+from array import array
+
+
+class Scheduler:
+    def __init__(self, holes, media_index, new_boost=1.0, new_half_life_days=30.0, favourite_weight=1.0,
+                 user_weights=None):
+        self.media_index = media_index
+        self.new_boost = new_boost  # weight of a brand-new item, decaying to 1 with the half-life below
+        self.new_half_life_days = new_half_life_days
+        self.favourite_weight = favourite_weight
+        self.user_weights = user_weights or {}  # uploader -> weight; 0 leaves their files out
+        self._deck = array('q')  # media ids, next card at the end
+        self._next = None  # the deck after this one, once the background deal has finished
+        self._dealing = False
+        self._late = []  # media ids added since the library was copied for the next deck
+        self._generation = 0  # bumped by set_library so a deck dealt from an older library is thrown away
+        self._due = []  # heap of (monotonic due time, hole id)
+        self._intervals = {}
+        self._lock = threading.Lock()  # library changes arrive on the message thread
+        self.start(holes)
+
+    def start(self, holes, now=None):
+        # (Re)start the clocks, staggered so holes with the same interval don't all change together
+        now = time.monotonic() if now is None else now
+        self._intervals = {hole['id']: max(0.1, hole['interval']) for hole in holes}
+        due = [(now + self._intervals[hole['id']] * (i + 1) / len(holes), hole['id']) for i, hole in enumerate(holes)]
+        heapq.heapify(due)
+        self._due = due
+
+    def next_due(self):
+        due = self._due
+        return due[0][0] if due else None
+
+    def due(self, now):
+        # Holes whose interval has elapsed; each is rescheduled one interval from now
+        holes = []
+        while self._due and self._due[0][0] <= now:
+            _, hole_id = heapq.heappop(self._due)
+            holes.append(hole_id)
+            heapq.heappush(self._due, (now + self._intervals[hole_id], hole_id))
+        return holes
+
+    def neutral(self):
+        # Every item weighs 1: dealing is a plain shuffle
+        return (self.new_boost == 1.0 and self.favourite_weight == 1.0
+                and all(weight == 1.0 for weight in self.user_weights.values()))
+
+    def weight(self, media_id):
+        weight = 1.0
+        if self.user_weights:
+            weight = float(self.user_weights.get(self.media_index.user_of(media_id), 1.0))
+        if self.favourite_weight != 1.0 and self.media_index.favourite_of(media_id):
+            weight *= self.favourite_weight
+        mtime = self.media_index.mtime_of(media_id) if self.new_boost != 1.0 else None
+        if mtime:
+            age_days = max(0.0, (time.time() - mtime) / 86400)
+            weight *= 1 + (self.new_boost - 1) * 0.5 ** (age_days / self.new_half_life_days)
+        return weight
+
+    def set_library(self, ids):
+        # Full reload with a freshly dealt deck; dealt here, on the caller's thread
+        deck = self._deal(ids)
+        with self._lock:
+            self._deck = deck
+            self._next = None
+            self._late = []
+            self._generation += 1
+
+    def add(self, ids):
+        # Items new to the index go on top of the deck so an upload appears soon
+        with self._lock:
+            for media_id in ids:
+                self._late.append(media_id)
+                if self.weight(media_id) > 0:
+                    self._deck.append(media_id)
+
+    def _deal(self, library):
+        # Weighted shuffle (Efraimidis-Spirakis): order by random() ** (1 / weight), so heavier items
+        # tend to come early but everything is dealt once
+        if self.neutral():
+            deck = array('q', library)
+            random.shuffle(deck)
+            return deck
+        keyed = []
+        for media_id in library:
+            weight = self.weight(media_id)
+            if weight > 0:
+                keyed.append((random.random() ** (1.0 / weight), media_id))
+        keyed.sort()
+        return array('q', (media_id for _, media_id in keyed))
+
+    def _deal_next(self):
+        # Background thread: deal the deck that follows the current one from a copy of the library
+        with self._lock:
+            library = self.media_index.ids()
+            generation = self._generation
+            self._late = []
+        deck = self._deal(library)
+        with self._lock:
+            if generation == self._generation:
+                self._next = deck
+            self._dealing = False
+
+    def _next_deck(self):
+        # Caller holds the lock. The deck dealt in the background, topped up with items added since its
+        # library was copied (under it: they were just put on top of the current deck); dealt here only if
+        # the background deal hasn't finished
+        deck, self._next = self._next, None
+        if deck is None:
+            deck = self._deal(self.media_index.ids())
+            self._generation += 1  # a deal still running started from an older copy
+        else:
+            deck[0:0] = array('q', (media_id for media_id in reversed(self._late)
+                                    if self.media_index.path_for(media_id) is not None and self.weight(media_id) > 0))
+        self._late = []
+        return deck
+
+    def pick(self, exclude=()):
+        # Next card (a media id) that isn't in exclude; constant time unless the background deal of the
+        # next deck hasn't finished when this one runs out. Passed-over cards go back under the deck.
+        # Returns None only when nothing can be shown.
+        with self._lock:
+            skipped = []
+            dealt = False
+            while True:
+                if not self._deck:
+                    if dealt or not len(self.media_index):
+                        break
+                    self._deck = self._next_deck()
+                    skipped = []  # they are in the new deck
+                    dealt = True
+                    continue
+                if not self._dealing and self._next is None and len(self._deck) * 2 <= len(self.media_index):
+                    self._dealing = True
+                    threading.Thread(target=self._deal_next, name='deal', daemon=True).start()
+                media_id = self._deck.pop()
+                if self.media_index.path_for(media_id) is None:
+                    continue  # removed since the deck was dealt
+                if media_id in exclude:
+                    skipped.append(media_id)
+                    continue
+                self._deck[0:0] = array('q', reversed(skipped))
+                return media_id
+            # Fewer items than holes: a repeat is unavoidable
+            if skipped:
+                self._deck[0:0] = array('q', reversed(skipped[1:]))
+                return skipped[0]
+            return None
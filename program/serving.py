@@ -0,0 +1,76 @@
+# How the web server is run and how media files are sent
+# Used by program/web.py (serve), program/media_routes.py and program/cluster_routes.py (send_media)
+# Settings come from the [server] section of config.cfg (wsgi, threads)
+# waitress is optional (pip install waitress); without it the Werkzeug development server is used
+
+import calendar
+import mimetypes
+import os
+
+from flask import request, send_file, Response
+
+
+def serve(app, host, port, wsgi='waitress', threads=16):
+    # waitress: a pool of worker threads, with file responses streamed by its I/O loop instead of a worker
+    if wsgi == 'waitress':
+        try:
+            from waitress import serve as waitress_serve
+        except ImportError:
+            print("Server: waitress not installed (pip install waitress), using the development server")
+        else:
+            waitress_serve(app, host=host, port=port, threads=threads)
+            return
+    app.run(host=host, port=port, debug=False, use_reloader=False, threaded=True)
+
+
+def if_range_matches(filepath, version):
+    # A range may only be served against the representation the client already has: no If-Range header,
+    # the same ETag, or the same Last-Modified date to the second. Anything else (another ETag, another or
+    # unparseable date) means the full file
+    if 'If-Range' not in request.headers:
+        return True
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == version
+    if if_range.date is not None:
+        return calendar.timegm(if_range.date.utctimetuple()) == int(os.path.getmtime(filepath))
+    return False
+
+
+def send_range(filepath, version, start, stop, size, file_wrapper):
+    # The file is positioned at the range start and Content-Length stops it at the range end, which
+    # waitress (and gunicorn's sendfile) honour, so no worker thread copies the bytes
+    f = open(filepath, 'rb')
+    f.seek(start)
+    response = Response(file_wrapper(f), 206, mimetype=mimetypes.guess_type(filepath)[0] or 'application/octet-stream',
+                        direct_passthrough=True)
+    response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    response.headers['Content-Length'] = str(stop - start)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.set_etag(version)
+    response.last_modified = int(os.path.getmtime(filepath))
+    return response
+
+
+def send_media(filepath, version, immutable):
+    # Strong ETag from the content version; versioned URLs never change so they can be cached forever.
+    # Byte ranges (phones scrubbing a <video>) go through the server's wsgi.file_wrapper.
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    byte_range = request.range
+    if (file_wrapper is not None and byte_range is not None and len(byte_range.ranges) == 1
+            and not request.if_none_match.contains(version)
+            and if_range_matches(filepath, version)):
+        size = os.path.getsize(filepath)
+        bounds = byte_range.range_for_length(size)
+        if bounds is None:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return response
+        response = send_range(filepath, version, bounds[0], bounds[1], size, file_wrapper)
+    else:
+        response = send_file(filepath, etag=version, conditional=True)
+    if immutable:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
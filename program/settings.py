@@ -0,0 +1,167 @@
+# Settings shared by the display and the web server, read from config.cfg
+# Used by program/app.py, program/display.py, program/web.py and its route modules
+# init_db creates/upgrades the media table used by program/media_index.py and program/renditions.py
+# Depends on program/layout.py for the hole layout, which is reloaded when config.cfg changes
+# Depends on program/database.py for the shared SQLite connections (db) and migrations
+
+import configparser
+import json
+import os
+
+from database import Database
+from layout import LayoutService
+
+base_dir = os.path.join(os.path.dirname(__file__), '..')
+
+
+def resolve_path(path):
+    # Paths in config.cfg are relative to the project directory
+    return path if os.path.isabs(path) else os.path.join(base_dir, path)
+
+
+# Load config; TVFRAME_CONFIG points at another file (e.g. the throwaway one of program/benchmark.py)
+config = configparser.ConfigParser()
+config_path = os.environ.get('TVFRAME_CONFIG') or os.path.join(base_dir, 'config.cfg')
+config.read(config_path)
+
+
+# Layout snapshot (holes, scale, offset, video flags), replaced when config.cfg changes on disk
+layout_service = LayoutService(config, config_path,
+                               poll_seconds=config.getfloat('reload', 'poll_seconds', fallback=2.0)
+                               if config.getboolean('reload', 'enabled', fallback=True) else 0,
+                               save_delay=config.getfloat('reload', 'save_delay_seconds', fallback=2.0))
+
+
+def save_config():
+    layout_service.save()
+
+
+def hole_box(hole):
+    # (left, top, width, height) in whole screen pixels
+    w, h = int(hole['w_px']), int(hole['h_px'])
+    return int(hole['x_px'] - w / 2), int(hole['y_px'] - h / 2), w, h
+
+
+def rendition_targets(holes):
+    # ((w, h), fit) per hole for program/renditions.py
+    return [(hole_box(hole)[2:], hole['fit']) for hole in holes]
+
+
+# Server settings
+username = config['server']['username']
+password_hash = config['server']['password_hash']
+# Larger uploads are rejected (413) while the body is read
+max_upload_bytes = config.getint('server', 'max_upload_mb', fallback=500) * 1024 * 1024
+
+# User management
+users_file = os.path.join(base_dir, 'users.json')
+
+def load_users():
+    if os.path.exists(users_file):
+        with open(users_file) as f:
+            return json.load(f)
+    return []
+
+def save_users(users):
+    with open(users_file, 'w') as f:
+        json.dump(users, f, indent=4)
+
+
+# Cluster mode, see program/cluster.py: token lets other frames show this frame's library (hub);
+# hub_url makes this frame a display node of another frame's library
+cluster_token = config.get('cluster', 'token', fallback='').strip()
+cluster_hub_url = config.get('cluster', 'hub_url', fallback='').strip().rstrip('/')
+cluster_cache_dir = resolve_path(config.get('cluster', 'cache_dir', fallback='./cluster_cache'))
+cluster_options = {
+    'token': cluster_token,
+    'cache_bytes': config.getint('cluster', 'cache_mb', fallback=2048) * 1024 * 1024,
+    'poll_seconds': config.getfloat('cluster', 'poll_seconds', fallback=300.0),
+    'retry_seconds': config.getfloat('cluster', 'retry_seconds', fallback=30.0),
+    'timeout': config.getfloat('cluster', 'timeout_seconds', fallback=30.0),
+}
+
+# Paths; a node's library and renditions are the copies in its cluster cache
+uploads_dir = resolve_path(config['paths']['uploads_dir'])
+renditions_dir = resolve_path(config['paths'].get('renditions_dir', './renditions'))
+if cluster_hub_url:
+    uploads_dir = os.path.join(cluster_cache_dir, 'library')
+    renditions_dir = os.path.join(cluster_cache_dir, 'renditions')
+os.makedirs(uploads_dir, exist_ok=True)
+
+# Unix socket between the display and web processes when they run separately
+ipc_socket = resolve_path(config.get('ipc', 'socket_path', fallback='./display.sock'))
+
+# Images over this many pixels (after JPEG draft reduction) are refused rather than decoded, in both processes
+max_decode_pixels = int(config.getfloat('memory', 'max_decode_megapixels', fallback=50) * 1e6)
+
+# Rendition pipeline options, the same in both processes
+renditions_options = {
+    'thumb_size': config.getint('renditions', 'thumb_size', fallback=320),
+    'quality': config.getint('renditions', 'quality', fallback=85),
+    'workers': config.getint('renditions', 'workers', fallback=1),
+    'max_pixels': max_decode_pixels,
+}
+
+# Memory budgets for program/memory.py (display process)
+memory_options = {
+    'prefetch_bytes': config.getint('memory', 'prefetch_mb', fallback=32) * 1024 * 1024,
+    'index_bytes': config.getint('memory', 'index_mb', fallback=16) * 1024 * 1024,
+    'min_available_bytes': config.getint('memory', 'min_available_mb', fallback=64) * 1024 * 1024,
+    'check_seconds': config.getfloat('memory', 'check_seconds', fallback=5.0),
+}
+
+# Playlist weighting for program/scheduler.py
+schedule_options = {
+    'new_boost': config.getfloat('schedule', 'new_boost', fallback=1.0),
+    'new_half_life_days': config.getfloat('schedule', 'new_half_life_days', fallback=30.0),
+    'favourite_weight': config.getfloat('schedule', 'favourite_weight', fallback=1.0),
+    'user_weights': {user: float(weight) for user, weight in config['user_weight'].items()}
+                    if config.has_section('user_weight') else {},
+}
+
+# Database: one shared access layer per process, see program/database.py
+db_path = resolve_path(config['paths'].get('database', './media.db'))
+if cluster_hub_url:
+    db_path = os.path.join(cluster_cache_dir, 'media.db')  # the node's mirror of the hub's media table
+db = Database(db_path,
+              cache_kb=config.getint('database', 'cache_kb', fallback=4096),
+              mmap_mb=config.getint('database', 'mmap_mb', fallback=64),
+              busy_timeout_ms=config.getint('database', 'busy_timeout_ms', fallback=5000))
+
+
+def _media_v1(conn):
+    # The media table as it was before migrations were numbered; older databases may have any subset
+    # of the later columns
+    conn.execute('''CREATE TABLE IF NOT EXISTS media (
+        id INTEGER PRIMARY KEY,
+        filepath TEXT UNIQUE,
+        user TEXT,
+        rotation INTEGER,
+        crop_x REAL, crop_y REAL, crop_w REAL, crop_h REAL,
+        frames TEXT
+    )''')
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(media)')]
+    for column, typ in [('renditions', 'TEXT'), ('mtime', 'REAL'), ('size', 'INTEGER'),
+                        ('fit', 'TEXT'), ('focal_x', 'REAL'), ('focal_y', 'REAL'), ('sha256', 'TEXT')]:
+        if column not in columns:
+            conn.execute(f'ALTER TABLE media ADD COLUMN {column} {typ}')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_media_mtime ON media (mtime)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_media_size ON media (size)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_media_user ON media (user)')
+    # Content hash: the same photo uploaded again (by anyone) is recognised instead of stored twice
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_media_sha256 ON media (sha256)')
+
+
+# Schema history; append (next version, [SQL statements]) to add columns or indexes, never edit old entries
+MIGRATIONS = [
+    (1, _media_v1),
+    (2, ['ALTER TABLE media ADD COLUMN favourite INTEGER NOT NULL DEFAULT 0']),
+    # Files whose content is already in the media table under another path (e.g. copied in twice);
+    # one of them takes over when the indexed file goes away
+    (3, ['CREATE TABLE IF NOT EXISTS duplicates (filepath TEXT PRIMARY KEY, sha256 TEXT NOT NULL, mtime REAL)',
+         'CREATE INDEX IF NOT EXISTS idx_duplicates_sha256 ON duplicates (sha256)']),
+]
+
+
+def init_db():
+    db.migrate(MIGRATIONS)
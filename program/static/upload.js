@@ -0,0 +1,102 @@
+// Resumable chunked uploads for the media page (served by Flask from program/static)
+// Used by the media page in program/web.py; talks to the /upload routes there (program/uploads.py)
+// The file is sent in checksummed chunks, a few at a time; after a dropped connection or a reload
+// the same file continues with the chunks the server does not have yet.
+
+const PARALLEL_CHUNKS = 3;
+const MAX_RETRIES = 6;
+
+let crcTable = null;
+
+function crc32(bytes) {
+    // Used when crypto.subtle is missing (plain http on the local network is not a secure context)
+    if (!crcTable) {
+        crcTable = new Uint32Array(256);
+        for (let n = 0; n < 256; n++) {
+            let c = n;
+            for (let k = 0; k < 8; k++) c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+            crcTable[n] = c >>> 0;
+        }
+    }
+    let crc = 0xFFFFFFFF;
+    for (let i = 0; i < bytes.length; i++) crc = crcTable[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+    return (crc ^ 0xFFFFFFFF) >>> 0;
+}
+
+async function chunkChecksum(buf) {
+    if (window.crypto && crypto.subtle) {
+        let digest = new Uint8Array(await crypto.subtle.digest('SHA-256', buf));
+        return ['X-Chunk-SHA256', Array.from(digest, b => b.toString(16).padStart(2, '0')).join('')];
+    }
+    return ['X-Chunk-CRC32', crc32(new Uint8Array(buf)).toString(16)];
+}
+
+function sleep(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
+}
+
+async function sendChunk(upload, file, index) {
+    let buf = await file.slice(index * upload.chunk_size, (index + 1) * upload.chunk_size).arrayBuffer();
+    let [header, value] = await chunkChecksum(buf);
+    for (let attempt = 0; ; attempt++) {
+        let r = null;
+        try {
+            r = await fetch(`/upload/${upload.id}/${index}`, {method: 'PUT', headers: {[header]: value}, body: buf});
+        } catch (e) {
+            // network error: retry below
+        }
+        if (r && r.ok) return;
+        if (r && [401, 404, 413].includes(r.status)) throw new Error(`upload ${r.status}`);
+        if (attempt >= MAX_RETRIES) throw new Error(`chunk ${index} failed`);
+        await sleep(1000 * 2 ** attempt);  // flaky Wi-Fi: back off and send the same chunk again
+    }
+}
+
+async function uploadFile(file, onProgress) {
+    let key = `upload:${file.name}:${file.size}:${file.lastModified}`;
+    let upload = null;
+    let id = localStorage.getItem(key);
+    if (id) {
+        let r = await fetch(`/upload/${id}`);
+        if (r.ok) upload = await r.json();
+    }
+    if (!upload) {
+        let r = await fetch('/upload', {method: 'POST', headers: {'Content-Type': 'application/json'},
+                                        body: JSON.stringify({filename: file.name, size: file.size})});
+        if (!r.ok) throw new Error(await r.text() || `upload ${r.status}`);
+        upload = await r.json();
+        localStorage.setItem(key, upload.id);
+    }
+    let done = new Set(upload.received);
+    let todo = [];
+    for (let i = 0; i < upload.chunks; i++) {
+        if (!done.has(i)) todo.push(i);
+    }
+    onProgress(done.size / upload.chunks);
+    async function worker() {
+        while (todo.length) {
+            let index = todo.shift();
+            await sendChunk(upload, file, index);
+            done.add(index);
+            onProgress(done.size / upload.chunks);
+        }
+    }
+    await Promise.all(Array.from({length: PARALLEL_CHUNKS}, worker));
+    let r = await fetch(`/upload/${upload.id}/complete`, {method: 'POST'});
+    if (!r.ok) throw new Error(`upload ${r.status}`);
+    localStorage.removeItem(key);
+    return r.json();
+}
+
+function startUpload(form) {
+    // Form onsubmit: the plain multipart post stays as the fallback for old browsers
+    if (!window.fetch || !window.Blob || !Blob.prototype.arrayBuffer) return true;
+    let input = form.querySelector('input[type="file"]');
+    let status = document.getElementById('uploadStatus');
+    if (!input.files.length) return false;
+    let file = input.files[0];
+    uploadFile(file, p => { status.textContent = `${Math.round(p * 100)}%`; })
+        .then(result => { status.textContent = result.duplicate ? 'Already in the library' : 'Uploaded'; form.reset(); })
+        .catch(e => { status.textContent = `Upload stopped (${e.message}), submit again to resume`; });
+    return false;
+}
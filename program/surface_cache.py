@@ -0,0 +1,306 @@
+# Decoded-surface cache for the pygame display loop
+# Used by program/display.py (run_display and library change messages)
+# Used by program/prefetch.py to store surfaces decoded in the background
+# Used by program/renditions.py (fit_image, apply_transform, effective_fit)
+# Used by program/scene.py (MASKED_SHAPES for the video matte)
+# Budget comes from [display] surface_cache_mb in config.cfg
+# resolve_source is set by program/display.py to decode renditions (program/renditions.py) instead of originals
+# resolve_transform is set by program/display.py to read rotation/crop metadata (program/media_index.py)
+# Oval and circle holes get their alpha mask baked into the cached surface (hole_mask)
+# JPEGs are decoded at a reduced scale (PIL draft) when the hole needs fewer pixels; images still over
+# [memory] max_decode_megapixels are refused instead of decoded. The budget is managed by program/memory.py.
+# PIL is imported by the functions that decode, so the display's first frame doesn't wait for it
+
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+import pygame
+
+# (rotation in degrees clockwise, crop (x, y, w, h) as fractions or None,
+#  fit mode overriding the hole's or None, focal point (x, y) as fractions or None)
+NO_TRANSFORM = (0, None, None, None)
+FIT_MODES = ('contain', 'cover')  # contain letterboxes, cover fills the hole and crops around the focal point
+
+
+EXIF_ORIENTATION = 0x0112
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)  # EXIF orientations that swap width and height
+
+MASKED_SHAPES = ('oval', 'circle')  # hole types from config.cfg [holes] that are not plain rectangles
+MASK_SUPERSAMPLE = 4  # masks are drawn larger and scaled down for a smooth edge
+
+
+@lru_cache(maxsize=64)
+def hole_mask(shape, size):
+    # Alpha mask ('L') for a hole's cut-out, built once per shape and size; None for rectangles
+    if shape not in MASKED_SHAPES:
+        return None
+    from PIL import Image, ImageDraw
+    w, h = size
+    big = Image.new('L', (w * MASK_SUPERSAMPLE, h * MASK_SUPERSAMPLE), 0)
+    if shape == 'circle':
+        d = min(w, h) * MASK_SUPERSAMPLE
+        left, top = (big.width - d) // 2, (big.height - d) // 2
+        box = (left, top, left + d - 1, top + d - 1)
+    else:
+        box = (0, 0, big.width - 1, big.height - 1)
+    ImageDraw.Draw(big).ellipse(box, fill=255)
+    return big.resize(size, Image.LANCZOS)
+
+
+def fit_size(img_w, img_h, hole_w, hole_h):
+    # Scale to fit while keeping aspect ratio
+    scale = min(hole_w / img_w, hole_h / img_h)
+    return max(1, int(img_w * scale)), max(1, int(img_h * scale))
+
+
+def effective_fit(transform, hole_fit):
+    # A fit mode stored on the media item wins over the hole's default
+    return transform[2] or hole_fit or 'contain'
+
+
+def cover_box(img_w, img_h, hole_w, hole_h, focal=None):
+    # Largest box with the hole's aspect ratio, centered on the focal point as far as the image allows
+    fx, fy = focal or (0.5, 0.5)
+    scale = max(hole_w / img_w, hole_h / img_h)
+    w, h = min(img_w, hole_w / scale), min(img_h, hole_h / scale)
+    left = min(max(fx * img_w - w / 2, 0), img_w - w)
+    top = min(max(fy * img_h - h / 2, 0), img_h - h)
+    return left, top, left + w, top + h
+
+
+def fit_image(img, size, fit='contain', focal=None):
+    # Scale for a hole: letterboxed (contain) or cropped to exactly the hole size (cover)
+    from PIL import Image
+    if fit == 'cover':
+        return img.resize(tuple(size), Image.LANCZOS, box=cover_box(img.width, img.height, size[0], size[1], focal),
+                          reducing_gap=3.0)
+    return img.resize(fit_size(img.width, img.height, size[0], size[1]), Image.LANCZOS, reducing_gap=3.0)
+
+
+def apply_transform(img, transform):
+    # Rotation and crop come from media table metadata; the original file is never rewritten
+    rotation, crop = transform[:2]
+    if rotation:
+        img = img.rotate(-rotation, expand=True)
+    if crop:
+        x, y, w, h = crop
+        img = img.crop((round(x * img.width), round(y * img.height),
+                        round((x + w) * img.width), round((y + h) * img.height)))
+    return img
+
+
+def draft_size(size, transform=NO_TRANSFORM, orientation=1):
+    # Smallest stored image size that still covers size at 1:1 once EXIF orientation, rotation and crop
+    # are applied; contain and cover both scale down from there
+    w, h = size
+    rotation, crop = transform[:2]
+    if crop:
+        w, h = w / crop[2], h / crop[3]
+    if rotation % 90:
+        w = h = max(w, h)  # a free angle needs the whole diagonal either way
+    elif (rotation % 180 == 90) != (orientation in TRANSPOSED_ORIENTATIONS):
+        w, h = h, w
+    return max(1, math.ceil(w)), max(1, math.ceil(h))
+
+
+def open_image(filepath, size=None, transform=NO_TRANSFORM, max_pixels=None):
+    # Decoded, EXIF-oriented RGB or RGBA image and the factor it was reduced by while decoding (1 for
+    # full size). With size, JPEGs decode at 1/2, 1/4 or 1/8 scale when that still covers size.
+    # Raises ValueError for images over max_pixels after that reduction.
+    from PIL import Image, ImageOps
+    with Image.open(filepath) as img:
+        full_width = img.width
+        if size is not None:
+            img.draft(None, draft_size(size, transform, img.getexif().get(EXIF_ORIENTATION, 1)))
+        if max_pixels and img.width * img.height > max_pixels:
+            raise ValueError(f"{img.width}x{img.height} is over the decode limit of {max_pixels / 1e6:.0f} megapixels")
+        reduced = full_width / img.width
+        img = ImageOps.exif_transpose(img)
+        mode = 'RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB'
+        return img.convert(mode), reduced
+
+
+def apply_mask(img, size, mask):
+    # Center the fitted image on a transparent hole-sized canvas and cut it to the hole's shape
+    from PIL import Image, ImageChops
+    canvas = Image.new('RGBA', size, (0, 0, 0, 0))
+    canvas.paste(img.convert('RGBA'), ((size[0] - img.width) // 2, (size[1] - img.height) // 2))
+    canvas.putalpha(ImageChops.multiply(canvas.getchannel('A'), mask))
+    return canvas
+
+
+def decode_scaled(filepath, size, transform=NO_TRANSFORM, shape='rect', fit='contain', timings=None, max_pixels=None):
+    # Decode with PIL (EXIF orientation, metadata transform, fit to size, hole mask); safe off the render thread.
+    # fit is the effective mode (see effective_fit); the focal point comes from the transform.
+    # timings, if given, receives 'decode' and 'scale' seconds
+    start = time.perf_counter()
+    img, _ = open_image(filepath, size, transform, max_pixels)
+    mode = img.mode
+    decoded = time.perf_counter()
+    img = fit_image(apply_transform(img, transform), size, fit, transform[3])
+    mask = hole_mask(shape, tuple(size))
+    if mask is not None:
+        img, mode = apply_mask(img, tuple(size), mask), 'RGBA'
+    if timings is not None:
+        timings['decode'] = decoded - start
+        timings['scale'] = time.perf_counter() - decoded
+    return img.tobytes(), img.size, mode
+
+
+def to_surface(decoded):
+    # Render thread only: convert decoded pixels to the display's pixel format
+    data, size, mode = decoded
+    surface = pygame.image.frombuffer(data, size, mode)
+    return surface.convert_alpha() if mode == 'RGBA' else surface.convert()
+
+
+class SurfaceCache:
+    # LRU cache of pre-scaled surfaces keyed by (path, mtime, hole size, transform, hole shape, fit mode)
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.max_pixels = None  # decode limit, see open_image
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self._entries = OrderedDict()  # key -> (surface, nbytes)
+        self._failed = set()  # keys that could not be decoded (videos, corrupt files)
+        self._lock = threading.Lock()
+        self.resolve_source = None  # (filepath, size, mtime, transform, fit) -> path to decode
+        self.resolve_transform = None  # filepath -> (rotation, crop, fit, focal)
+        self.resolve_mtime = None  # filepath -> mtime, when the original is not on this machine (cluster node)
+        self.on_decoded = None  # timings -> None, for decodes on a miss (they hold up the frame being drawn)
+        self.on_memory_error = None  # called when a decode runs out of memory (see program/memory.py)
+
+    def transform_for(self, filepath):
+        return self.resolve_transform(filepath) if self.resolve_transform else NO_TRANSFORM
+
+    def fit_for(self, filepath, hole_fit):
+        # (fit mode, focal point) a hole with default hole_fit uses for this file
+        transform = self.transform_for(filepath)
+        return effective_fit(transform, hole_fit), transform[3]
+
+    def make_key(self, filepath, size, shape='rect', fit='contain'):
+        if self.resolve_mtime is not None:
+            mtime = self.resolve_mtime(filepath)
+            if mtime is None:
+                return None
+        else:
+            try:
+                mtime = os.path.getmtime(filepath)
+            except OSError:
+                return None
+        transform = self.transform_for(filepath)
+        if shape not in MASKED_SHAPES:
+            shape = 'rect'  # unmasked shapes share one entry
+        return (filepath, mtime, (int(size[0]), int(size[1])), transform, shape, effective_fit(transform, fit))
+
+    def source_for(self, key):
+        # (path to decode, transform still to apply); renditions already have the transform and fit crop baked in
+        if self.resolve_source is not None:
+            source = self.resolve_source(key[0], key[2], key[1], key[3], key[5])
+            if source != key[0]:
+                return source, NO_TRANSFORM
+        return key[0], key[3]
+
+    def get(self, filepath, size, shape='rect', fit='contain'):
+        # Returns the cached surface, decoding on a miss; None if the file can't be loaded
+        key = self.make_key(filepath, size, shape, fit)
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if key in self._failed:
+                return None
+            self.misses += 1
+        timings = {}
+        try:
+            source, transform = self.source_for(key)
+            surface = to_surface(decode_scaled(source, key[2], transform, key[4], key[5], timings, self.max_pixels))
+        except MemoryError:
+            # Not the file's fault: try again once memory has been freed
+            self.memory_error(key)
+            return None
+        except Exception as e:
+            # Not an image PIL can read (corrupt file); don't retry every frame
+            self.mark_failed(key, e)
+            return None
+        if self.on_decoded:
+            self.on_decoded(timings)
+        self.put(key, surface)
+        return surface
+
+    def contains(self, key):
+        with self._lock:
+            return key in self._entries or key in self._failed
+
+    def memory_error(self, key):
+        print(f"Out of memory decoding {key[0]}")
+        if self.on_memory_error:
+            self.on_memory_error()
+
+    def mark_failed(self, key, error=None):
+        if error is not None:
+            print(f"Decode error for {key[0]}: {error}")
+        with self._lock:
+            self._failed.add(key)
+            self.failures += 1
+
+    def put(self, key, surface):
+        nbytes = surface.get_pitch() * surface.get_height()
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.used_bytes -= old[1]
+            self._entries[key] = (surface, nbytes)
+            self.used_bytes += nbytes
+            self._evict()
+
+    def set_budget(self, budget_bytes):
+        # Lower or raise the budget; a lower one evicts at once
+        with self._lock:
+            self.budget_bytes = budget_bytes
+            self._evict()
+
+    def _evict(self):
+        # Drop least recently used entries until under budget, always keeping the newest
+        while self.used_bytes > self.budget_bytes and len(self._entries) > 1:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.used_bytes -= nbytes
+
+    def invalidate(self, filepath):
+        # Forget every rendition of a file (deleted, rotated or replaced)
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == filepath]:
+                self.used_bytes -= self._entries.pop(key)[1]
+            self._failed = {k for k in self._failed if k[0] != filepath}
+
+    def discard_sizes(self, sizes):
+        # Forget surfaces decoded for hole sizes the layout no longer has
+        sizes = set(sizes)
+        with self._lock:
+            for key in [k for k in self._entries if k[2] in sizes]:
+                self.used_bytes -= self._entries.pop(key)[1]
+            self._failed = {k for k in self._failed if k[2] not in sizes}
+
+    def retain(self, known):
+        # Drop entries for files that are no longer in the media library; known(filepath) is None for those
+        with self._lock:
+            for key in [k for k in self._entries if known(k[0]) is None]:
+                self.used_bytes -= self._entries.pop(key)[1]
+            self._failed = {k for k in self._failed if known(k[0]) is not None}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._failed.clear()
+            self.used_bytes = 0
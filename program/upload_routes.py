@@ -0,0 +1,103 @@
+# Resumable chunked upload routes (program/static/upload.js): start, status, checksummed chunks, complete
+# Used by program/web.py (registered as a blueprint; the media page's form upload stays there)
+# Depends on program/uploads.py for the chunk storage and program/library.py (add_upload) for adding the
+# finished file to the library
+# Chunk size and expiry come from the [uploads] section of config.cfg, the size limit from [server] max_upload_mb
+
+from flask import Blueprint, request, session
+from settings import config, uploads_dir, max_upload_bytes
+from uploads import UploadRequest, ChunkedUploads, prepare_incoming
+from library import add_upload
+
+blueprint = Blueprint('uploads', __name__)
+
+# Multipart parts and chunked uploads are kept next to uploads_dir, so storing them is a link or a rename
+UploadRequest.incoming_dir = prepare_incoming(uploads_dir)
+
+# Resumable uploads for large files from phones: checksummed chunks, assembled once complete
+chunked_uploads = ChunkedUploads(
+    UploadRequest.incoming_dir,
+    chunk_size=config.getint('uploads', 'chunk_kb', fallback=4096) * 1024,
+    max_bytes=max_upload_bytes,
+    expire_seconds=config.getint('uploads', 'expire_hours', fallback=24) * 3600)
+
+@blueprint.route('/upload', methods=['POST'])
+def upload_start():
+    # Resumable upload: {"filename", "size"} -> {"id", "chunk_size", "chunks", "received": [...]}
+    if not session.get('logged_in'):
+        return '', 401
+    info = request.get_json(silent=True) or {}
+    try:
+        filename, size = str(info['filename']), int(info['size'])
+    except (KeyError, ValueError, TypeError):
+        return '', 400
+    if size < 0:
+        return '', 400
+    try:
+        return chunked_uploads.start(session['username'], filename, size)
+    except ValueError:
+        return upload_too_large(None)
+
+@blueprint.route('/upload/<upload_id>', methods=['GET', 'DELETE'])
+def upload_status(upload_id):
+    # GET lists the chunks the server already has, so an interrupted upload only sends the rest
+    if not session.get('logged_in'):
+        return '', 401
+    try:
+        if request.method == 'DELETE':
+            chunked_uploads.abort(upload_id, session['username'])
+            return '', 204
+        return chunked_uploads.status(upload_id, session['username'])
+    except KeyError:
+        return '', 404
+
+@blueprint.route('/upload/<upload_id>/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    # Raw chunk body with an X-Chunk-SHA256 or X-Chunk-CRC32 (hex) header; chunks may arrive in parallel
+    if not session.get('logged_in'):
+        return '', 401
+    sha256 = request.headers.get('X-Chunk-SHA256')
+    crc32 = request.headers.get('X-Chunk-CRC32')
+    if not sha256 and not crc32:
+        return 'Missing chunk checksum', 400
+    try:
+        chunked_uploads.write_chunk(upload_id, session['username'], index, request.stream, sha256, crc32)
+    except KeyError:
+        return '', 404
+    except ValueError as e:
+        return f'Bad chunk ({e})', 400
+    return '', 204
+
+@blueprint.route('/upload/<upload_id>/complete', methods=['POST'])
+def upload_complete(upload_id):
+    # Assemble into the uploads layout; only now does the file join the media table
+    if not session.get('logged_in'):
+        return '', 401
+    user = session['username']
+    try:
+        status = chunked_uploads.status(upload_id, user)
+        sha256 = chunked_uploads.digest(upload_id, user)
+    except KeyError:
+        return '', 404
+    if sha256 is None:
+        return status, 409
+    try:
+        media_id, duplicate = add_upload(user, status['filename'], sha256,
+                                         lambda filepath: chunked_uploads.complete(upload_id, user, filepath))
+    except KeyError:
+        return '', 404  # completed or aborted by a concurrent request
+    except ValueError:
+        return '', 409  # chunks went missing since the digest
+    if media_id is None:
+        return '', 500
+    if duplicate:
+        try:
+            chunked_uploads.abort(upload_id, user)
+        except KeyError:
+            pass  # already assembled and dropped by add_upload
+    return {'id': media_id, 'duplicate': duplicate}
+
+@blueprint.app_errorhandler(413)
+def upload_too_large(e):
+    limit = max_upload_bytes // (1024 * 1024)
+    return f'Upload too large (limit {limit} MB)', 413
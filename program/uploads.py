@@ -0,0 +1,226 @@
+# Streamed upload storage: multipart file parts are written straight to disk next to uploads_dir
+# and linked into place, so the web server never holds a whole upload in memory or copies it twice.
+# Parts are hashed (SHA-256) as they are written, so duplicates are found without reading them again.
+# ChunkedUploads adds resumable uploads: checksummed chunks, sent in any order and in parallel,
+# are verified, written at their offset and assembled into place once all have arrived.
+# Used by program/web.py (request_class of the Flask app, the media_page upload) and program/upload_routes.py
+# Used by program/static/upload.js through those routes
+# The size limit is [server] max_upload_mb in config.cfg, enforced by Flask's MAX_CONTENT_LENGTH
+# while the body is read; chunk size and expiry come from the [uploads] section
+# Depends on program/media_index.py (file_sha256)
+
+import hashlib
+import json
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+
+from flask import Request
+
+from media_index import file_sha256
+
+INCOMING_DIR = '.incoming'  # hidden, so program/watcher.py and MediaIndex.reconcile skip it
+SESSIONS_DIR = 'sessions'  # resumable uploads, kept across restarts until they expire
+UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+READ_SIZE = 64 * 1024
+
+
+class HashingFile:
+    # File object for one multipart part that hashes the bytes as Werkzeug writes them
+
+    def __init__(self, file):
+        self.file = file
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+
+class UploadRequest(Request):
+    incoming_dir = None  # set by program/upload_routes.py; None keeps Werkzeug's default in-memory/spooled parts
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.incoming_dir is None:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        # Same filesystem as the final location, so storing it is a hard link instead of a copy
+        return HashingFile(tempfile.NamedTemporaryFile(dir=self.incoming_dir, prefix='part-'))
+
+
+def prepare_incoming(uploads_dir):
+    # Create the part directory and drop multipart parts left behind by a crash
+    directory = os.path.join(uploads_dir, INCOMING_DIR)
+    os.makedirs(os.path.join(directory, SESSIONS_DIR), exist_ok=True)
+    for name in os.listdir(directory):
+        if name.startswith('part-'):
+            os.remove(os.path.join(directory, name))
+    return directory
+
+
+def upload_sha256(file):
+    # Hex SHA-256 of an uploaded part; only parts kept in memory by Werkzeug are read again for it
+    stream = file.stream
+    if isinstance(stream, HashingFile):
+        return stream.digest.hexdigest()
+    digest = hashlib.sha256()
+    for block in iter(lambda: stream.read(READ_SIZE), b''):
+        digest.update(block)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def store_upload(file, filepath):
+    # Put an uploaded part at filepath; the temp file itself is removed when the request closes it
+    stream = file.stream
+    name = getattr(stream, 'name', None)
+    if isinstance(name, str) and UploadRequest.incoming_dir and os.path.dirname(name) == UploadRequest.incoming_dir:
+        stream.flush()
+        try:
+            os.link(name, filepath)
+            return
+        except OSError:
+            pass  # no hard links on this filesystem (e.g. FAT on a USB stick)
+    file.save(filepath)
+
+
+class ChunkedUploads:
+    # One directory per upload under <incoming>/sessions/<id>: meta.json, the data file
+    # (chunks are written at their offset) and an empty marker file per verified chunk
+
+    def __init__(self, incoming_dir, chunk_size=4 * 1024 * 1024, max_bytes=None, expire_seconds=24 * 3600):
+        self.root = os.path.join(incoming_dir, SESSIONS_DIR)
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.expire_seconds = expire_seconds
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def _dir(self, upload_id):
+        if not UPLOAD_ID.match(upload_id or ''):
+            raise KeyError(upload_id)
+        return os.path.join(self.root, upload_id)
+
+    def _meta(self, upload_id, user):
+        # Raises KeyError for unknown uploads and for uploads started by someone else
+        try:
+            with open(os.path.join(self._dir(upload_id), 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            raise KeyError(upload_id)
+        if meta['user'] != user:
+            raise KeyError(upload_id)
+        return meta
+
+    def chunk_count(self, meta):
+        return max(1, -(-meta['size'] // meta['chunk_size']))
+
+    def start(self, user, filename, size):
+        if self.max_bytes is not None and size > self.max_bytes:
+            raise ValueError('size')
+        self.expire()
+        upload_id = secrets.token_hex(16)
+        directory = os.path.join(self.root, upload_id)
+        os.makedirs(os.path.join(directory, 'chunks'))
+        with open(os.path.join(directory, 'data'), 'wb') as f:
+            f.truncate(size)  # sparse; chunks fill it in any order
+        meta = {'user': user, 'filename': filename, 'size': size, 'chunk_size': self.chunk_size, 'created': time.time()}
+        with open(os.path.join(directory, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        return self.status(upload_id, user)
+
+    def status(self, upload_id, user):
+        meta = self._meta(upload_id, user)
+        try:
+            received = sorted(int(name) for name in os.listdir(os.path.join(self._dir(upload_id), 'chunks')))
+        except FileNotFoundError:
+            raise KeyError(upload_id)  # completed or aborted since meta.json was read
+        return {'id': upload_id, 'filename': meta['filename'], 'size': meta['size'],
+                'chunk_size': meta['chunk_size'], 'chunks': self.chunk_count(meta), 'received': received}
+
+    def write_chunk(self, upload_id, user, index, stream, sha256=None, crc32=None):
+        # Reads one chunk (at most chunk_size bytes) into a buffer and writes it at its offset only once
+        # its length and checksum match, so a bad resend never overwrites a chunk that was already good
+        meta = self._meta(upload_id, user)
+        if not 0 <= index < self.chunk_count(meta):
+            raise ValueError('index')
+        offset = index * meta['chunk_size']
+        expected = min(meta['chunk_size'], meta['size'] - offset)
+        directory = self._dir(upload_id)
+        digest = hashlib.sha256() if sha256 else None
+        crc = 0
+        buffer = bytearray()
+        while True:
+            data = stream.read(READ_SIZE)
+            if not data:
+                break
+            if len(buffer) + len(data) > expected:
+                raise ValueError('length')
+            buffer += data
+            if digest:
+                digest.update(data)
+            if crc32:
+                crc = zlib.crc32(data, crc)
+        if len(buffer) != expected:
+            raise ValueError('length')
+        if (digest and digest.hexdigest() != sha256.lower()) or (crc32 and crc != int(crc32, 16)):
+            raise ValueError('checksum')
+        try:
+            fd = os.open(os.path.join(directory, 'data'), os.O_WRONLY)
+        except FileNotFoundError:
+            raise KeyError(upload_id)  # completed or aborted while the chunk was being read
+        try:
+            os.pwrite(fd, buffer, offset)
+        finally:
+            os.close(fd)
+        try:
+            open(os.path.join(directory, 'chunks', str(index)), 'w').close()
+        except FileNotFoundError:
+            raise KeyError(upload_id)
+
+    def digest(self, upload_id, user):
+        # SHA-256 of the assembled file, or None while chunks are missing. Chunks arrive out of order,
+        # so this is one sequential read of data that was just written (usually still in the page cache).
+        status = self.status(upload_id, user)
+        if len(status['received']) != status['chunks']:
+            return None
+        try:
+            return file_sha256(os.path.join(self._dir(upload_id), 'data'))
+        except FileNotFoundError:
+            raise KeyError(upload_id)
+
+    def complete(self, upload_id, user, filepath):
+        # Move the assembled file to filepath once every chunk is in; returns False if some are missing
+        with self._lock:
+            status = self.status(upload_id, user)
+            if len(status['received']) != status['chunks']:
+                return False
+            directory = self._dir(upload_id)
+            os.replace(os.path.join(directory, 'data'), filepath)
+            shutil.rmtree(directory, ignore_errors=True)
+        return True
+
+    def abort(self, upload_id, user):
+        self._meta(upload_id, user)
+        shutil.rmtree(self._dir(upload_id), ignore_errors=True)
+
+    def expire(self):
+        # Forget uploads nobody has resumed for expire_seconds
+        cutoff = time.time() - self.expire_seconds
+        for name in os.listdir(self.root):
+            directory = os.path.join(self.root, name)
+            try:
+                if os.path.getmtime(os.path.join(directory, 'chunks')) < cutoff:
+                    shutil.rmtree(directory, ignore_errors=True)
+            except OSError:
+                shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,233 @@
+# In-window video playback for the pygame display
+# Each hole playing a video gets its own ffmpeg subprocess piping raw RGB frames
+# at the hole's size into a reusable double buffer.
+# Used by program/scene.py (video holes), program/prefetch.py and program/display.py; program/library.py uses is_video
+# Depends on the ffmpeg binary (ffplay for audio when [video] mute = false)
+
+import os
+import shutil
+import subprocess
+import threading
+
+import pygame
+
+VIDEO_EXTENSIONS = ('.mp4', '.webm', '.ogg', '.mov', '.m4v')
+# Clockwise rotation -> ffmpeg filters (each ending in a comma)
+TRANSPOSE = {90: 'transpose=clock,', 180: 'hflip,vflip,', 270: 'transpose=cclock,'}
+
+
+def is_video(filepath):
+    return os.path.splitext(filepath)[1].lower() in VIDEO_EXTENSIONS
+
+
+class VideoPlayer:
+    # Streams one video into a w x h RGB buffer; the newest complete frame is kept in front
+
+    def __init__(self, engine, filepath, size, fit='contain', focal=None, rotation=0, crop=None):
+        self.engine = engine
+        self.filepath = filepath
+        self.size = (max(1, int(size[0])), max(1, int(size[1])))
+        self.fit = fit
+        self.focal = focal or (0.5, 0.5)
+        self.rotation = rotation  # degrees clockwise, from the media row like the still images
+        self.crop = crop  # (x, y, w, h) fractions of the rotated frame
+        self.frame_bytes = self.size[0] * self.size[1] * 3
+        self._front = bytearray(self.frame_bytes)
+        self._back = bytearray(self.frame_bytes)
+        self._has_frame = False
+        self._new_frame = False
+        self._lock = threading.Lock()
+        self._proc = None
+        self._stopped = False
+        self.threads = 1  # ffmpeg decoder threads, set by the engine when the player starts
+
+    def command(self):
+        w, h = self.size
+        cmd = [self.engine.ffmpeg, '-loglevel', 'error', '-nostdin', '-filter_threads', '1', '-re']
+        if self.engine.loop:
+            cmd += ['-stream_loop', '-1']
+        # Rotate, crop and scale inside ffmpeg so frames arrive at hole size, transformed and fitted
+        # the same way as the still images
+        vf = f'fps={self.engine.fps},' + TRANSPOSE.get(self.rotation % 360, '')
+        if self.crop:
+            x, y, cw, ch = self.crop
+            vf += f'crop=iw*{cw}:ih*{ch}:iw*{x}:ih*{y},'
+        if self.fit == 'cover':
+            fx, fy = self.focal
+            vf += (f'scale={w}:{h}:force_original_aspect_ratio=increase,'
+                   f'crop={w}:{h}:max(0\\,min(iw-{w}\\,{fx}*iw-{w}/2)):max(0\\,min(ih-{h}\\,{fy}*ih-{h}/2))')
+        else:
+            vf += (f'scale={w}:{h}:force_original_aspect_ratio=decrease,'
+                   f'pad={w}:{h}:(ow-iw)/2:(oh-ih)/2')
+        cmd += ['-threads', str(self.threads), '-i', self.filepath, '-an', '-vf', vf,
+                '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-']
+        return cmd
+
+    def start(self):
+        if self._stopped:
+            return
+        try:
+            self._proc = subprocess.Popen(self.command(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                          bufsize=self.frame_bytes)
+        except OSError as e:
+            print(f"Video error: {e}")
+            self.engine.release(self)
+            return
+        if self._stopped:
+            self._proc.kill()  # stopped while the process was starting
+        threading.Thread(target=self._read_frames, args=(self._proc,), daemon=True).start()
+
+    def _read_frames(self, proc):
+        view = memoryview(self._back)
+        while not self._stopped:
+            filled = 0
+            while filled < self.frame_bytes:
+                n = proc.stdout.readinto(view[filled:])
+                if not n:
+                    break
+                filled += n
+            if filled < self.frame_bytes:
+                break  # EOF (not looping) or process killed; keep showing the last frame
+            with self._lock:
+                if self._new_frame:
+                    self.engine.frame_dropped()  # the previous frame was never drawn
+                self._front, self._back = self._back, self._front
+                self._has_frame = True
+                self._new_frame = True
+            view = memoryview(self._back)
+            self.engine.frame_ready()
+        proc.stdout.close()
+        proc.wait()
+        self.engine.release(self)
+
+    def has_new_frame(self):
+        return self._new_frame
+
+    def blit_to(self, screen, rect):
+        # Render thread: draws the front buffer without copying it into a new surface
+        with self._lock:
+            self._new_frame = False
+            if not self._has_frame:
+                return
+            frame = pygame.image.frombuffer(self._front, self.size, 'RGB')
+            screen.blit(frame, frame.get_rect(center=rect.center))
+
+    def stop(self):
+        self._stopped = True
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+        self.engine.release(self)
+
+
+class VideoEngine:
+    # Hands out players and shares max_decoders ffmpeg decoder threads (the core count by default) between them.
+    # Each player gets a fixed share sized for one video per hole, so running players never need restarting;
+    # players that don't fit in the budget wait (their hole stays blank) until a running one stops
+
+    def __init__(self, loop=True, mute=False, fps=25, max_decoders=0, on_frame=None):
+        self.ffmpeg = shutil.which('ffmpeg')
+        self.ffplay = shutil.which('ffplay')
+        self.loop = loop
+        self.mute = mute
+        self.fps = fps
+        self.max_decoders = max_decoders or os.cpu_count() or 1
+        self.slots = 1  # holes that can show a video, set by program/display.py from the layout
+        self.on_frame = on_frame  # e.g. scene.wake
+        self._running = set()
+        self._waiting = []  # players past the thread budget, started oldest first as threads come free
+        self._threads_used = 0
+        self._audio = None  # (player, ffplay process) for the one audible video
+        self._lock = threading.Lock()
+        self.dropped_frames = 0
+        if not self.ffmpeg:
+            print("Video error: ffmpeg not found, videos will not play on the display")
+
+    @property
+    def available(self):
+        return self.ffmpeg is not None
+
+    def open(self, filepath, size, fit='contain', focal=None, rotation=0, crop=None):
+        player = VideoPlayer(self, filepath, size, fit, focal, rotation, crop)
+        if not self.available:
+            return player
+        with self._lock:
+            self._waiting.append(player)
+            ready = self._grant()
+        self._launch(ready)
+        return player
+
+    def close(self, player):
+        player.stop()
+
+    def release(self, player):
+        # Called when a player stops or its stream ends
+        with self._lock:
+            if player in self._waiting:
+                self._waiting.remove(player)
+                return
+            if player not in self._running:
+                return
+            self._running.discard(player)
+            self._threads_used -= player.threads
+            ready = self._grant()
+        self._stop_audio(player)
+        self._launch(ready)
+
+    def _grant(self):
+        # Under the lock: move waiting players into the budget; returns the ones to start
+        share = max(1, self.max_decoders // max(1, min(self.slots, self.max_decoders)))
+        ready = []
+        while self._waiting and self._threads_used + share <= self.max_decoders:
+            player = self._waiting.pop(0)
+            player.threads = share
+            self._threads_used += share
+            self._running.add(player)
+            ready.append(player)
+        return ready
+
+    def _launch(self, players):
+        for player in players:
+            player.start()
+            self._start_audio(player)
+
+    def frame_ready(self):
+        if self.on_frame:
+            self.on_frame()
+
+    def frame_dropped(self):
+        with self._lock:
+            self.dropped_frames += 1
+
+    def _start_audio(self, player):
+        # Only the most recently started video is audible
+        if self.mute or not self.ffplay:
+            return
+        cmd = [self.ffplay, '-nodisp', '-autoexit', '-loglevel', 'quiet']
+        if self.loop:
+            cmd += ['-loop', '0']
+        cmd.append(player.filepath)
+        with self._lock:
+            previous, self._audio = self._audio, None
+        if previous is not None:
+            previous[1].kill()
+        try:
+            proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            print(f"Video error: {e}")
+            return
+        with self._lock:
+            self._audio = (player, proc)
+
+    def _stop_audio(self, player):
+        with self._lock:
+            if self._audio is None or self._audio[0] is not player:
+                return
+            _, proc = self._audio
+            self._audio = None
+        proc.kill()
+
+    def stop_all(self):
+        with self._lock:
+            players = list(self._running) + self._waiting
+        for player in players:
+            player.stop()
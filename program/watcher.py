@@ -0,0 +1,235 @@
+# Filesystem watcher for uploads_dir: picks up files copied in by rsync, Samba, SD cards, etc.
+# Uses inotify (through ctypes, Linux only) and falls back to polling directory mtimes.
+# Events are debounced and handed over in batches: on_batch(changed_paths, removed_paths)
+# Used by program/library.py (ingest_batch feeds program/media_index.py and program/renditions.py)
+# Settings come from the [watcher] section of config.cfg
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def is_hidden(name):
+    # Temp files from rsync/Samba/editors are dot-files until they are renamed into place
+    return name.startswith('.')
+
+
+class Watcher:
+    # Shared debounce logic; subclasses feed _note_changed/_note_removed from their own thread
+
+    def __init__(self, root, on_batch, debounce_seconds=2.0, max_delay_seconds=30.0, on_overflow=None):
+        self.root = root
+        self.on_batch = on_batch
+        self.on_overflow = on_overflow  # called when events were lost and a full reconcile is needed
+        self.debounce_seconds = debounce_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self._changed = set()
+        self._removed = set()
+        self._first_event = None
+        self._last_event = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _note_changed(self, path):
+        self._removed.discard(path)
+        self._changed.add(path)
+        self._touch()
+
+    def _note_removed(self, path):
+        self._changed.discard(path)
+        self._removed.add(path)
+        self._touch()
+
+    def _touch(self):
+        now = time.monotonic()
+        if self._first_event is None:
+            self._first_event = now
+        self._last_event = now
+
+    def _flush_due(self):
+        # Flush once events have been quiet for debounce_seconds, or a burst has run for max_delay_seconds
+        if self._first_event is None:
+            return False
+        now = time.monotonic()
+        return (now - self._last_event >= self.debounce_seconds
+                or now - self._first_event >= self.max_delay_seconds)
+
+    def _next_timeout(self, idle_timeout):
+        if self._first_event is None:
+            return idle_timeout
+        return max(0.05, self._last_event + self.debounce_seconds - time.monotonic())
+
+    def _flush(self):
+        changed, removed = sorted(self._changed), sorted(self._removed)
+        self._changed, self._removed = set(), set()
+        self._first_event = self._last_event = None
+        try:
+            self.on_batch(changed, removed)
+        except Exception as e:
+            print(f"Watcher error: {e}")
+
+
+class InotifyWatcher(Watcher):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._dirs = {}  # watch descriptor -> directory path
+        self._add_tree(self.root, report=False)
+
+    def _add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            print(f"Watcher error: cannot watch {directory} (errno {ctypes.get_errno()})")
+            return
+        self._dirs[wd] = directory
+
+    def _add_tree(self, directory, report=True):
+        # Watch a directory and everything below it; report files already inside (copied before the watch existed)
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [d for d in dirs if not is_hidden(d)]
+            self._add_watch(root)
+            if report:
+                for file in files:
+                    if not is_hidden(file):
+                        self._note_changed(os.path.join(root, file))
+
+    def _run(self):
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._fd], [], [], self._next_timeout(1.0))
+            if ready:
+                try:
+                    data = os.read(self._fd, 64 * 1024)
+                except BlockingIOError:
+                    data = b''
+                self._handle(data)
+            if self._flush_due():
+                self._flush()
+        os.close(self._fd)
+
+    def _handle(self, data):
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='surrogateescape')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped by the kernel; only a reconcile can catch up
+                if self.on_overflow:
+                    self.on_overflow()
+                continue
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None or not name or is_hidden(name):
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_tree(path)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._note_removed(path)  # treated as a prefix by the ingest
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE):
+                # IN_CREATE alone for hard links and files never written through an open handle; a file still
+                # being written is noted again by its IN_CLOSE_WRITE, and the debounce usually merges the two
+                self._note_changed(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._note_removed(path)
+
+
+class PollingWatcher(Watcher):
+    # Fallback: re-lists only directories whose mtime changed, so in-place edits are not seen
+
+    def __init__(self, *args, poll_seconds=10.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.poll_seconds = poll_seconds
+        self._dirs = {}  # directory -> (mtime, set of file names, set of subdirectory names)
+        self._scan_dir(self.root, report=False)
+
+    def _scan_dir(self, directory, report=True):
+        try:
+            mtime = os.stat(directory).st_mtime
+            entries = list(os.scandir(directory))
+        except OSError:
+            return
+        files = {e.name for e in entries if not is_hidden(e.name) and e.is_file()}
+        subdirs = {e.name for e in entries if not is_hidden(e.name) and e.is_dir()}
+        old = self._dirs.get(directory)
+        self._dirs[directory] = (mtime, files, subdirs)
+        old_files, old_subdirs = (old[1], old[2]) if old else (set(), set())
+        if report:
+            for name in files - old_files:
+                self._note_changed(os.path.join(directory, name))
+            for name in old_files - files:
+                self._note_removed(os.path.join(directory, name))
+            for name in old_subdirs - subdirs:
+                self._forget_tree(os.path.join(directory, name))
+        for name in subdirs - old_subdirs:
+            self._scan_dir(os.path.join(directory, name), report)
+
+    def _forget_tree(self, directory):
+        for path in [d for d in self._dirs if d == directory or d.startswith(directory + os.sep)]:
+            del self._dirs[path]
+        self._note_removed(directory)
+
+    def _poll(self):
+        for directory, (mtime, _, _) in list(self._dirs.items()):
+            if directory not in self._dirs:
+                continue  # forgotten while iterating
+            try:
+                current = os.stat(directory).st_mtime
+            except OSError:
+                continue  # the parent's rescan will notice it has gone
+            if current != mtime:
+                self._scan_dir(directory)
+
+    def _run(self):
+        next_poll = time.monotonic()
+        while not self._stop.is_set():
+            if time.monotonic() >= next_poll:
+                self._poll()
+                next_poll = time.monotonic() + self.poll_seconds
+            if self._flush_due():
+                self._flush()
+            self._stop.wait(min(self._next_timeout(self.poll_seconds), max(0.05, next_poll - time.monotonic())))
+
+
+def create_watcher(root, on_batch, backend='auto', **kwargs):
+    # inotify where available, polling otherwise (or when backend = poll)
+    poll_seconds = kwargs.pop('poll_seconds', 10.0)
+    if backend in ('auto', 'inotify'):
+        try:
+            return InotifyWatcher(root, on_batch, **kwargs)
+        except (OSError, AttributeError) as e:
+            print(f"Watcher: inotify unavailable ({e}), polling every {poll_seconds}s")
+    return PollingWatcher(root, on_batch, poll_seconds=poll_seconds, **kwargs)
@@ -0,0 +1,478 @@
+# Flask web server for 80s TV Frame: app setup, login, calibration and the media page
+# Run by program/app.py, either next to program/display.py in one process or on its own (--role web)
+# Depends on config.cfg through program/settings.py; pages read the layout snapshot of program/layout.py
+# Depends on program/library.py for the media library, its change notifications and the display link
+# Depends on program/media_routes.py, program/upload_routes.py, program/event_routes.py and
+# program/cluster_routes.py for the rest of the routes (blueprints)
+# Depends on program/serving.py for the WSGI server and program/uploads.py for streamed form uploads
+
+from flask import Flask, request, render_template_string, redirect, url_for, session, flash, g
+from datetime import timedelta
+import hashlib
+import json
+import time
+from flask_session import Session
+from settings import config, save_config, layout_service, username, password_hash, load_users, save_users, \
+    max_upload_bytes
+from serving import serve as serve_app
+from uploads import UploadRequest, store_upload, upload_sha256
+from library import metrics, notify, current_media_info, add_upload
+import media_routes
+import upload_routes
+import event_routes
+import cluster_routes
+
+app = Flask(__name__)
+app.secret_key = 'supersecretkey'  # Change in production
+app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
+app.config['SESSION_TYPE'] = 'filesystem'
+Session(app)
+
+# Uploads are streamed to disk as they arrive (program/upload_routes.py sets up where) and rejected (413)
+# once over the limit
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = max_upload_bytes
+
+for routes in (media_routes, upload_routes, event_routes, cluster_routes):
+    app.register_blueprint(routes.blueprint)
+
+users = load_users()
+
+# Display mode
+display_mode = config['display'].get('mode', 'calibrate')  # 'calibrate' or 'media'
+# Debug overlay next to the QR code on the TV, see /debug_overlay
+overlay_on = config.getboolean('metrics', 'overlay', fallback=False)
+
+def serve():
+    serve_app(app, '0.0.0.0', 8000,
+              wsgi=config.get('server', 'wsgi', fallback='waitress'),
+              threads=config.getint('server', 'threads', fallback=16))
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    start = g.get('request_start')
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('http_request_seconds', time.perf_counter() - start, route=route, method=request.method)
+        metrics.inc('http_requests_total', route=route, status=str(response.status_code))
+    return response
+
+@app.route('/', methods=['GET', 'POST'])
+def login():
+    if request.method == 'POST':
+        user = request.form['username']
+        pwd = request.form['password']
+        pwd_hash = hashlib.sha256(pwd.encode()).hexdigest()
+        # Check users first
+        user_found = None
+        for u in users:
+            if u['username'] == user and u['password_hash'] == pwd_hash:
+                user_found = u
+                break
+        if user_found:
+            session['logged_in'] = True
+            session['username'] = user
+            session.permanent = True
+            if display_mode == 'media':
+                return redirect(url_for('media_page'))
+            else:
+                return redirect(url_for('calibrate'))
+        # If no users, allow config
+        elif not users and user == username and pwd_hash == password_hash:
+            session['logged_in'] = True
+            session['username'] = user
+            return redirect(url_for('add_user'))
+        else:
+            flash('Invalid credentials')
+    return render_template_string('''
+    <!DOCTYPE html>
+    <html>
+    <head><title>Login</title></head>
+    <body>
+    <h1>Login to 80s TV Frame</h1>
+    <form method="post">
+        Username: <input type="text" name="username"><br>
+        Password: <input type="password" name="password"><br>
+        <input type="submit" value="Login">
+    </form>
+    {% with messages = get_flashed_messages() %}
+        {% if messages %}
+            <ul>
+            {% for message in messages %}
+                <li>{{ message }}</li>
+            {% endfor %}
+            </ul>
+        {% endif %}
+    {% endwith %}
+    </body>
+    </html>
+    ''')
+
+@app.route('/add_user', methods=['GET', 'POST'])
+def add_user():
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    if request.method == 'POST':
+        new_user = request.form['username']
+        new_pwd = request.form['password']
+        # Check if user exists
+        if any(u['username'] == new_user for u in users):
+            flash('User already exists')
+        else:
+            users.append({'username': new_user, 'password_hash': hashlib.sha256(new_pwd.encode()).hexdigest(), 'role': 'admin'})
+            save_users(users)
+            session['logged_in'] = True
+            session['username'] = new_user
+            session.permanent = True
+            flash('Admin user added successfully')
+            return redirect(url_for('calibrate'))
+    return render_template_string('''
+    <!DOCTYPE html>
+    <html>
+    <head><title>Add Admin User</title></head>
+    <body>
+    <h1>Add New Admin User</h1>
+    <form method="post">
+        Username: <input type="text" name="username" required><br>
+        Password: <input type="password" name="password" required><br>
+        <input type="submit" value="Add User">
+    </form>
+    {% with messages = get_flashed_messages() %}
+        {% if messages %}
+            <ul>
+            {% for message in messages %}
+                <li>{{ message }}</li>
+            {% endfor %}
+            </ul>
+        {% endif %}
+    {% endwith %}
+    </body>
+    </html>
+    ''')
+
+@app.route('/calibrate')
+def calibrate():
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    # Calibration page: smaller view with move controls
+    scale = 0.5  # smaller view
+    layout = layout_service.current
+    screen_width_px, screen_height_px = layout.screen_size
+    offset_x, offset_y = layout.offset
+    html = f'''
+    <!DOCTYPE html>
+    <html>
+    <head><title>Calibration</title><style>
+    body {{ margin: 20px; }}
+    .container {{ position: relative; width: {screen_width_px * scale}px; height: {screen_height_px * scale}px; background: repeating-linear-gradient(0deg, #f0f0f0, #f0f0f0 10px, #e0e0e0 10px, #e0e0e0 20px), repeating-linear-gradient(90deg, #f0f0f0, #f0f0f0 10px, #e0e0e0 10px, #e0e0e0 20px); border: 1px solid black; }}
+    .hole {{ position: absolute; background: yellow; border: 2px solid red; display: flex; align-items: center; justify-content: center; font-weight: bold; font-size: 12px; }}
+    .controls {{ margin-top: 20px; }}
+    button {{ margin: 5px; padding: 10px; }}
+    </style></head>
+    <body>
+    <h1>Calibration Mode</h1>
+    <p>Adjust the layout to align with the physical frame. Current offset: <span id="offset">X={offset_x}, Y={offset_y}</span></p>
+    <div class="container">
+    <div id="holes" style="position: absolute; left: 0; top: 0; width: 100%; height: 100%; transform: translate({offset_x * scale}px, {offset_y * scale}px);">
+    '''
+    for hole in layout.holes:
+        x = (hole["x_px"] - offset_x) * scale
+        y = (hole["y_px"] - offset_y) * scale
+        w = hole["w_px"] * scale
+        h = hole["h_px"] * scale
+        html += f'<div class="hole" style="left: {x - w/2}px; top: {y - h/2}px; width: {w}px; height: {h}px;">{hole["id"]}</div>'
+    html += '''
+    </div>
+    </div>
+    <div class="controls">
+    <button onclick="adjust(0,-1)">Up 1px</button>
+    <button onclick="adjust(0,-10)">Up 10px</button><br>
+    <button onclick="adjust(-1,0)">Left 1px</button>
+    <button onclick="adjust(1,0)">Right 1px</button><br>
+    <button onclick="adjust(0,1)">Down 1px</button>
+    <button onclick="adjust(0,10)">Down 10px</button><br>
+    <button onclick="adjust(0,0,true)">Reset to 0</button>
+    </div>
+    <br><button onclick="commit()">Commit Calibration</button>
+    <br><a href="/switch_mode/media">Switch to Media Mode</a> | <a href="/media">Admin Media Upload</a>
+    '''
+    html += f'''| <a href="/debug_overlay/{'off' if overlay_on else 'on'}">{'Hide' if overlay_on else 'Show'} Debug Overlay</a>
+    <script>const SCALE = {scale};</script>
+    '''
+    html += '''
+    <script>
+    // The TV moves as soon as the server has the nudge; the page moves its holes instead of reloading.
+    // Replies can arrive out of order when clicking fast, so only the newest one is shown.
+    let sent = 0, shown = 0;
+    function adjust(dx, dy, reset=false) {
+        let seq = ++sent;
+        fetch(reset ? '/adjust_offset?reset=1' : `/adjust_offset?dx=${dx}&dy=${dy}`)
+        .then(r => r.json())
+        .then(data => {
+            if (seq < shown) return;
+            shown = seq;
+            showOffset(data.offset);
+        });
+    }
+    function showOffset(offset) {
+        document.getElementById('offset').textContent = `X=${offset[0]}, Y=${offset[1]}`;
+        document.getElementById('holes').style.transform = `translate(${offset[0] * SCALE}px, ${offset[1] * SCALE}px)`;
+    }
+    function commit() {
+        if (confirm('Commit current calibration and switch to media mode?')) {
+            fetch('/commit_calibration').then(() => location.href='/media');
+        }
+    }
+    </script>
+    </body></html>
+    '''
+    return html
+
+@app.route('/adjust_offset')
+def adjust_offset():
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    # Applied in memory at once (a new layout snapshot, sent on to the display by layout_changed) and
+    # written to config.cfg when the nudges stop
+    if 'reset' in request.args:
+        offset = layout_service.set_offset(0, 0)
+    else:
+        offset = layout_service.nudge_offset(int(request.args.get('dx', 0)), int(request.args.get('dy', 0)))
+    return {'offset': list(offset)}
+
+@app.route('/switch_mode/<mode>')
+def switch_mode(mode):
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    global display_mode
+    if mode in ['calibrate', 'media']:
+        display_mode = mode
+        config.set('display', 'mode', display_mode)
+        save_config()
+        notify({'type': 'mode', 'mode': display_mode})
+    return redirect(request.referrer or url_for('calibrate'))
+
+@app.route('/commit_calibration')
+def commit_calibration():
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    global display_mode
+    display_mode = 'media'
+    config.set('display', 'mode', 'media')
+    save_config()
+    notify({'type': 'mode', 'mode': display_mode})
+    return redirect(url_for('media_page'))
+
+@app.route('/media', methods=['GET', 'POST'])
+def media_page():
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    if request.method == 'POST':
+        file = request.files['file']
+        if file:
+            add_upload(session['username'], file.filename, upload_sha256(file),
+                       lambda filepath: store_upload(file, filepath))
+    # Display page
+    # Fixed scale for phone
+    phone_scale = 0.3
+    layout = layout_service.current
+    screen_width_px, screen_height_px = layout.screen_size
+    html = f'''
+    <!DOCTYPE html>
+    <html>
+    <head><title>Media Mode</title><meta name="viewport" content="width=device-width, initial-scale=1.0, user-scalable=no"><style>
+    body {{ margin: 0; background: black; color: white; font-family: Arial, sans-serif; overflow: hidden; }}
+    .upload-form {{ position: fixed; top: 0; left: 0; right: 0; background: rgba(0,0,0,0.9); padding: 10px; z-index: 10; display: none; }}
+    .upload-form select, .upload-form input[type="file"], .upload-form input[type="submit"] {{ margin: 5px; padding: 8px; font-size: 16px; }}
+    .logout {{ position: absolute; top: 10px; right: 10px; }}
+    .tv-layout {{ position: relative; width: {screen_width_px * phone_scale}px; height: {screen_height_px * phone_scale}px; margin: 50px auto; background: #111; border: 2px solid white; }}
+    .hole {{ position: absolute; }}
+    .hole img, .hole video {{ width: 100%; height: 100%; object-fit: contain; }}
+    .hole.oval, .hole.circle {{ border-radius: 50%; overflow: hidden; }}
+    .hole.favourite::after {{ content: '\\2605'; position: absolute; top: 2px; right: 4px; color: gold; }}
+    .show-upload {{ position: fixed; top: 10px; left: 10px; z-index: 11; }}
+    @media (orientation: landscape) {{ body {{ /* landscape styles */ }} }}
+    </style></head>
+    <body>
+    <button class="show-upload" onclick="toggleUpload()">Upload Media</button>
+    <a href="/logout" class="logout">Logout</a>
+    <div class="upload-form" id="uploadForm">
+    <h2>Upload Media</h2>
+    <form method="post" enctype="multipart/form-data" onsubmit="return startUpload(this)">
+        File: <input type="file" name="file" accept="image/*,video/*">
+        <input type="submit" value="Upload">
+        <span id="uploadStatus"></span>
+    </form>
+    <a href="/debug_overlay/{'off' if overlay_on else 'on'}">{'Hide' if overlay_on else 'Show'} debug overlay on the TV</a>
+    </div>
+    <div class="tv-layout" id="tvLayout">
+    '''
+    for hole in layout.holes:
+        x = hole['x_px'] * phone_scale
+        y = hole['y_px'] * phone_scale
+        w = hole['w_px'] * phone_scale
+        h = hole['h_px'] * phone_scale
+        html += f'<div id="hole-{hole["id"]}" class="hole {hole["type"]}" data-fit="{hole["fit"]}" style="left: {x - w/2}px; top: {y - h/2}px; width: {w}px; height: {h}px;"></div>'
+    html += f'''
+    </div>
+    <div style="text-align: center; margin-top: 10px;">
+    <a href="/switch_mode/calibrate">Reconfigure Layout</a>
+    </div>
+    <script src="/static/upload.js"></script>
+    <script>
+    let longPressTimer;
+    let longPressed = false;
+    let startX, startY;
+
+    function toggleUpload() {{
+        let form = document.getElementById('uploadForm');
+        form.style.display = form.style.display === 'none' ? 'block' : 'none';
+    }}
+
+    function deleteMedia(mediaId) {{
+        if (confirm('Delete this media?')) {{
+            fetch(`/delete_media/${{mediaId}}`);
+        }}
+    }}
+
+    function rotateLeft(mediaId) {{
+        fetch(`/rotate_media/${{mediaId}}`);
+    }}
+
+    function rotateRight(mediaId) {{
+        fetch(`/rotate_right/${{mediaId}}`);
+    }}
+
+    function toggleFavourite(holeId) {{
+        let hole = document.getElementById('hole-' + holeId);
+        let mediaId = hole.dataset.mediaId;
+        if (!mediaId) return;
+        let off = hole.classList.contains('favourite') ? '?off=1' : '';
+        fetch(`/favourite_media/${{mediaId}}${{off}}`);
+    }}
+
+    function showMedia(holeId, item) {{
+        // URLs are versioned, so an unchanged src means nothing to download
+        let hole = document.getElementById('hole-' + holeId);
+        hole.classList.toggle('favourite', !!(item && item.favourite));
+        let src = item ? item.src : '';
+        if (hole.dataset.src === src) return;
+        hole.dataset.src = src;
+        hole.dataset.mediaId = item ? item.id : '';
+        if (!item) {{
+            hole.innerHTML = '';
+            return;
+        }} else if (item.video) {{
+            hole.innerHTML = `<video controls src="${{item.src}}"></video>`;
+        }} else {{
+            hole.innerHTML = `<img src="${{item.thumb}}">`;
+        }}
+        // Same fit as the TV: the item's own mode, else the hole's
+        let el = hole.firstElementChild;
+        el.style.objectFit = item.fit || hole.dataset.fit;
+        if (item.focal) el.style.objectPosition = `${{item.focal[0] * 100}}% ${{item.focal[1] * 100}}%`;
+    }}
+
+    function updateFrames() {{
+        fetch('/current_media')
+        .then(r => r.json())
+        .then(showAll);
+    }}
+
+    function handleTouchStart(event, holeId) {{
+        startX = event.touches[0].clientX;
+        startY = event.touches[0].clientY;
+        longPressed = false;
+        longPressTimer = setTimeout(() => {{
+            longPressed = true;
+        }}, 500);
+    }}
+
+    function handleTouchMove(event) {{
+        if (!longPressed) return;
+        event.preventDefault();
+    }}
+
+    function handleTouchEnd(event, holeId) {{
+        clearTimeout(longPressTimer);
+        if (!longPressed) return;
+        let endX = event.changedTouches[0].clientX;
+        let endY = event.changedTouches[0].clientY;
+        let dx = endX - startX;
+        let dy = endY - startY;
+        let mediaId = document.getElementById('hole-' + holeId).dataset.mediaId;
+        if (!mediaId) return;
+        if (Math.abs(dx) > Math.abs(dy)) {{
+            if (dx > 50) {{
+                rotateRight(mediaId);
+            }} else if (dx < -50) {{
+                rotateLeft(mediaId);
+            }}
+        }} else {{
+            if (dy > 50) {{
+                deleteMedia(mediaId);
+            }} else if (dy < -50) {{
+                // further options, for now rotate 180
+                fetch(`/rotate_media/${{mediaId}}`).then(() => fetch(`/rotate_media/${{mediaId}}`));
+            }}
+        }}
+    }}
+
+    function showAll(current) {{
+        for (let holeId in current) {{
+            showMedia(holeId, current[holeId]);
+        }}
+    }}
+
+    showAll({json.dumps(current_media_info())});
+
+    // Add listeners to holes
+    {''.join([f"document.getElementById('hole-{hole['id']}').addEventListener('touchstart', (e) => handleTouchStart(e, {hole['id']})); document.getElementById('hole-{hole['id']}').addEventListener('touchmove', handleTouchMove); document.getElementById('hole-{hole['id']}').addEventListener('touchend', (e) => handleTouchEnd(e, {hole['id']})); document.getElementById('hole-{hole['id']}').addEventListener('dblclick', () => toggleFavourite({hole['id']}));" for hole in layout.holes])}
+
+    // The server pushes each hole swap; polling is only the fallback for browsers without EventSource
+    if (window.EventSource) {{
+        let events = new EventSource('/events');
+        // Holes resized, added or removed (config.cfg changed); a calibration nudge only moves them
+        events.addEventListener('layout', () => location.reload());
+        events.addEventListener('offset', (e) => {{
+            let offset = JSON.parse(e.data).offset;
+            let dx = (offset[0] - {layout.offset[0]}) * {phone_scale}, dy = (offset[1] - {layout.offset[1]}) * {phone_scale};
+            for (let hole of document.querySelectorAll('.hole')) hole.style.transform = `translate(${{dx}}px, ${{dy}}px)`;
+        }});
+        events.addEventListener('snapshot', (e) => showAll(JSON.parse(e.data)));
+        events.addEventListener('hole', (e) => {{
+            let update = JSON.parse(e.data);
+            showMedia(update.hole, update.media);
+        }});
+    }} else {{
+        setInterval(updateFrames, 5000);
+    }}
+    </script>
+    </body></html>'''
+    return html
+
+
+@app.route('/logout')
+def logout():
+    session.pop('logged_in', None)
+    session.pop('username', None)
+    return redirect(url_for('login'))
+
+@app.route('/debug_overlay/<state>')
+def debug_overlay(state):
+    # Frame, decode and cache figures drawn on the TV next to the QR code
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    global overlay_on
+    if state in ['on', 'off']:
+        overlay_on = state == 'on'
+        if not config.has_section('metrics'):
+            config.add_section('metrics')  # config.cfg from before [metrics] existed
+        config.set('metrics', 'overlay', 'true' if overlay_on else 'false')
+        save_config()
+        notify({'type': 'overlay', 'on': overlay_on})
+    return redirect(request.referrer or url_for('media_page'))
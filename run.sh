@@ -1,2 +1,26 @@
 #!/bin/bash
-python3 program/app.py
\ No newline at end of file
+# ./run.sh           display and web server in one process
+# ./run.sh split     display and web server as separate processes
+# ./run.sh display   only the display process
+# ./run.sh web       only the web server process
+# ./run.sh bench     headless display benchmark (./run.sh bench --help for options)
+# With [cluster] hub_url set in config.cfg, ./run.sh runs this frame as a display node of that hub
+
+case "$1" in
+    split)
+        python3 program/app.py --role display &
+        display_pid=$!
+        trap 'kill $display_pid 2>/dev/null' EXIT
+        python3 program/app.py --role web
+        ;;
+    bench)
+        shift
+        python3 program/benchmark.py "$@"
+        ;;
+    display|web)
+        python3 program/app.py --role "$1"
+        ;;
+    *)
+        python3 program/app.py
+        ;;
+esac